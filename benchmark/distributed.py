@@ -0,0 +1,92 @@
+"""Distributed training benchmark
+
+在同一台機器上以多個 process 模擬 mnist-training-model 的多個 replica：先執行一次 preprocess，
+再分別以 1 個與 N 個 worker 執行 training，每個 worker 只讀取自己的 shard，並透過共用的
+FakeMinio 目錄 (或 --minio-endpoint 指定的 S3 相容服務) 交換並平均模型參數。
+CPU 核心會平均分給各 worker，比較不同 worker 數量的 images/s。
+
+Usage:
+    python -m benchmark.distributed --workers 4
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from benchmark.harness import REPO_ROOT
+from benchmark.run import parse_result, spawn_stage, stage_command
+
+
+def run_training(args, num_workers: int):
+    """同時啟動 num_workers 個 training worker，回傳整體耗時與各 worker 的量測結果
+
+    Args:
+        args (argparse.Namespace): 命令列參數
+        num_workers (int): worker 數量
+    """
+
+    # 每次訓練使用新的 run ID，參數交換的 object 才不會混到之前的結果
+    args.run_id = uuid.uuid4().hex
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    started = time.perf_counter()
+    processes = [
+        subprocess.Popen(stage_command("training", args,
+                                       "--worker-index", str(index),
+                                       "--num-workers", str(num_workers),
+                                       "--intra-op-threads", str(threads)),
+                         cwd=REPO_ROOT,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL if args.quiet else None,
+                         text=True)
+        for index in range(num_workers)
+    ]
+    outputs = [process.communicate()[0] for process in processes]
+    seconds = time.perf_counter() - started
+
+    for index, process in enumerate(processes):
+        if process.returncode != 0:
+            raise RuntimeError(f"training worker {index}/{num_workers} exited with {process.returncode}")
+    return seconds, [parse_result("training", output) for output in outputs]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark multi-worker training with local processes")
+    parser.add_argument("--workers", type=int, default=2, help="number of training workers")
+    parser.add_argument("--train-samples", type=int, default=6000, help="number of synthetic training images")
+    parser.add_argument("--test-samples", type=int, default=1000, help="number of synthetic test images")
+    parser.add_argument("--storage", help="directory backing the fake MinIO (default: a temporary directory)")
+    parser.add_argument("--minio-endpoint", help="use a real S3-compatible endpoint instead of the fake MinIO")
+    parser.add_argument("--quiet", action="store_true", help="hide handler logs")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.run_id = uuid.uuid4().hex
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args.storage = args.storage or tmp_dir
+        spawn_stage("preprocess", args)
+
+        results = []
+        for num_workers in sorted({1, args.workers}):
+            seconds, workers = run_training(args, num_workers)
+            results.append((num_workers, seconds, workers))
+
+    baseline = args.train_samples / results[0][1]
+    print(f"{'workers':>8}{'wall s':>10}{'images/s':>11}{'speedup':>10}{'down MiB/worker':>17}")
+    for num_workers, seconds, workers in results:
+        images_per_second = args.train_samples / seconds
+        downloaded = max(worker["bytes_downloaded"] or 0 for worker in workers) / (1024 * 1024)
+        print(f"{num_workers:>8}{seconds:>10.2f}{images_per_second:>11.0f}"
+              f"{images_per_second / baseline:>10.2f}{downloaded:>17.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import threading
+
+from minio.datatypes import Object
+from minio.error import S3Error
+
+
+class FakeResponse(io.BytesIO):
+    """模擬 get_object 回傳的 urllib3 response"""
+
+    def stream(self, amt: int = 64 * 1024):
+        while True:
+            chunk = self.read(amt)
+            if not chunk:
+                break
+            yield chunk
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    """以本機檔案系統模擬 Minio client，並統計傳輸的位元組數
+
+    只實作 handler 會用到的 API，bucket 對應到 root 底下的目錄，object 對應到檔案，
+    所以不同 process 之間 (例如 benchmark 的每個 stage) 可以共用同一份資料。
+    """
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root (str): 存放 bucket 的目錄
+        """
+
+        self.root = root
+        self.lock = threading.Lock()
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.requests = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, bucket_name: str, object_name: str = ""):
+        return os.path.join(self.root, bucket_name, object_name)
+
+    def _count(self, uploaded: int = 0, downloaded: int = 0):
+        with self.lock:
+            self.requests += 1
+            self.bytes_uploaded += uploaded
+            self.bytes_downloaded += downloaded
+
+    def _no_such_key(self, bucket_name: str, object_name: str):
+        return S3Error(response=None,
+                       code="NoSuchKey",
+                       message="The specified key does not exist.",
+                       resource=f"/{bucket_name}/{object_name}",
+                       request_id=None,
+                       host_id=None,
+                       bucket_name=bucket_name,
+                       object_name=object_name)
+
+    def _stat(self, bucket_name: str, object_name: str):
+        path = self._path(bucket_name, object_name)
+        if not os.path.isfile(path):
+            raise self._no_such_key(bucket_name, object_name)
+
+        with open(f"{path}.etag", 'r') as f:
+            etag = f.read()
+        stat = os.stat(path)
+        return Object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      last_modified=datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc),
+                      etag=etag,
+                      size=stat.st_size)
+
+    def bucket_exists(self, bucket_name: str):
+        self._count()
+        return os.path.isdir(self._path(bucket_name))
+
+    def make_bucket(self, bucket_name: str, *args, **kwargs):
+        self._count()
+        os.makedirs(self._path(bucket_name), exist_ok=True)
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, part_size: int = 0, **kwargs):
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # 先寫到暫存檔再 rename，讓其他 process 看不到寫到一半的 object
+        digest = hashlib.md5()
+        size = 0
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            while length < 0 or size < length:
+                chunk_size = part_size or 1024 * 1024
+                if length >= 0:
+                    chunk_size = min(chunk_size, length - size)
+                chunk = data.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        if length >= 0 and size != length:
+            os.remove(tmp_path)
+            raise ValueError(f"expected {length} bytes for {bucket_name}/{object_name}, got {size}")
+
+        with open(f"{path}.etag", 'w') as f:
+            f.write(digest.hexdigest())
+        os.replace(tmp_path, path)
+        self._count(uploaded=size)
+
+    def fput_object(self, bucket_name: str, object_name: str, file_path: str, **kwargs):
+        with open(file_path, 'rb') as f:
+            self.put_object(bucket_name, object_name, f, os.path.getsize(file_path), **kwargs)
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0, **kwargs):
+        path = self._path(bucket_name, object_name)
+        if not os.path.isfile(path):
+            raise self._no_such_key(bucket_name, object_name)
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length) if length else f.read()
+        self._count(downloaded=len(data))
+        return FakeResponse(data)
+
+    def fget_object(self, bucket_name: str, object_name: str, file_path: str, **kwargs):
+        response = self.get_object(bucket_name, object_name)
+        with open(file_path, 'wb') as f:
+            f.write(response.read())
+
+    def stat_object(self, bucket_name: str, object_name: str, **kwargs):
+        self._count()
+        return self._stat(bucket_name, object_name)
+
+    def list_objects(self, bucket_name: str, prefix: str = None, recursive: bool = False, **kwargs):
+        self._count()
+        base = self._path(bucket_name)
+        objects = []
+        for dir_path, _, filenames in os.walk(base):
+            for filename in filenames:
+                if filename.endswith((".etag", ".tmp")):
+                    continue
+                object_name = os.path.relpath(os.path.join(dir_path, filename), base).replace(os.sep, "/")
+                if prefix and not object_name.startswith(prefix):
+                    continue
+                if not recursive and "/" in object_name[len(prefix or ""):]:
+                    continue
+                objects.append(self._stat(bucket_name, object_name))
+        return iter(sorted(objects, key=lambda obj: obj.object_name))
+
+    def remove_object(self, bucket_name: str, object_name: str, **kwargs):
+        self._count()
+        path = self._path(bucket_name, object_name)
+        for file_path in (path, f"{path}.etag"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def copy_object(self, bucket_name: str, object_name: str, source, **kwargs):
+        self._count()
+        source_path = self._path(source.bucket_name, source.object_name)
+        if not os.path.isfile(source_path):
+            raise self._no_such_key(source.bucket_name, source.object_name)
+
+        path = self._path(bucket_name, object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(f"{source_path}.etag", f"{path}.etag")
+        shutil.copyfile(source_path, path)
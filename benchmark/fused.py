@@ -0,0 +1,207 @@
+"""Fused MNIST pipeline
+
+在同一個 process 中依序執行 preprocess、training 與 evaluate，stage 之間直接以記憶體中的
+numpy.ndarray 與模型交接，不經過 MinIO 下載與 gateway 觸發。原本 stage 之間的 artifact
+(mnist-pipeline.yml 中各 stage 的 bucket) 只作為 checkpoint，在背景非同步寫入 MinIO，
+所以之後仍然可以從任何一個 stage 接回一般的 pipeline。適合小資料集的開發與重新訓練。
+
+Usage:
+    python -m benchmark.fused
+    python -m benchmark.fused --storage /tmp/minio --train-samples 6000 --test-samples 1000
+"""
+
+import argparse
+import json
+import sys
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.fake_minio import FakeMinio
+from benchmark.harness import function_environment, install_stubs, load_handler, set_environment, synthetic_mnist
+
+
+PREPROCESS_FUNCTION = "mnist-preprocess"
+TRAINING_FUNCTION = "mnist-training-model"
+EVALUATE_FUNCTION = "mnist-model-evaluate"
+
+
+class CheckpointWriter:
+    """在背景依序寫入 stage checkpoint，不阻塞下一個 stage 的計算
+
+    只用一個 thread，checkpoint 會依照 stage 順序寫入；每個 checkpoint 內部的平行上傳
+    仍由各 stage 的 TransferManager 負責。
+    """
+
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled (bool): 是否寫入 checkpoint
+        """
+
+        self.enabled = enabled
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.futures = []
+
+    def submit(self, name: str, fn, *args, **kwargs):
+        """排入一個 checkpoint
+
+        Args:
+            name (str): checkpoint 名稱
+            fn (callable): 寫入 checkpoint 的函式
+        """
+
+        if not self.enabled:
+            return
+
+        def write():
+            started = time.perf_counter()
+            result = fn(*args, **kwargs)
+            print(f"[Checkpoint] {name}: {time.perf_counter() - started:.2f}s")
+            return result
+
+        self.futures.append((name, self.executor.submit(write)))
+
+    def wait(self):
+        """等待所有 checkpoint 寫入完成，回傳 {checkpoint 名稱: 結果}"""
+
+        results = {name: future.result() for name, future in self.futures}
+        self.executor.shutdown(wait=True)
+        return results
+
+
+def load_stage(function_name: str, overrides: dict = None, client=None, dataset=None):
+    """以 function 在 stack 檔案中的環境變數載入 handler module
+
+    Args:
+        function_name (str): OpenFaaS function 名稱
+        overrides (dict): 要覆寫的環境變數
+        client: 取代 connect_minio() 回傳值的 MinIO client
+        dataset: 取代 mnist.load_data() 回傳值的資料集
+    """
+
+    set_environment(function_name, overrides)
+    module = load_handler(function_name)
+    install_stubs(module, client=client, dataset=dataset)
+    return module
+
+
+def run_fused(run_id: str, overrides: dict = None, client=None, dataset=None, checkpoints: bool = True):
+    """在同一個 process 中執行整個 pipeline
+
+    Args:
+        run_id (str): pipeline 執行的 run ID
+        overrides (dict): 要覆寫的環境變數
+        client: 取代 connect_minio() 回傳值的 MinIO client，None 表示連接 stack 檔案中的 MinIO
+        dataset: 取代 mnist.load_data() 回傳值的資料集
+        checkpoints (bool): 是否在背景寫入 stage checkpoint
+    """
+
+    preprocess = load_stage(PREPROCESS_FUNCTION, overrides, client, dataset)
+    training = load_stage(TRAINING_FUNCTION, overrides, client)
+    evaluate = load_stage(EVALUATE_FUNCTION, overrides, client)
+
+    # 三個 stage 共用同一個 MinIO 連線設定
+    minioClient = preprocess.connect_minio() if checkpoints else None
+    writer = CheckpointWriter(enabled=checkpoints)
+    reports = [preprocess.RunReport(run_id), training.RunReport(run_id), evaluate.RunReport(run_id)]
+    preprocess_report, training_report, evaluate_report = reports
+
+    # preprocess
+    preprocess_env = function_environment(PREPROCESS_FUNCTION)
+    preprocess_env.update(overrides or {})
+    compact = preprocess_env.get("compact_artifacts", "false") == "true"
+    preprocess_buckets = preprocess_env["bucket_names"].split(",")
+    cache_key = preprocess.artifact_cache_key(compact)
+    with preprocess_report.phase("preprocess"):
+        preprocessed = preprocess.data_preprocess(compact)
+    artifacts = preprocess.build_artifacts(preprocess_buckets, cache_key, compact, *preprocessed)
+    if checkpoints:
+        preprocess.create_buckets(minioClient, preprocess_buckets)
+    writer.submit(PREPROCESS_FUNCTION, preprocess.upload_artifacts,
+                  minioClient, preprocess_buckets, cache_key, artifacts)
+
+    # training，artifact 的 JSON header 屬性 (scale、num_classes) 直接在記憶體中交接
+    X_Train4D, X_Test4D, y_Train, y_Test = preprocessed
+    image_header, label_header = artifacts[0][3], artifacts[2][3]
+    with training_report.phase("model_build"):
+        model = training.model_build()
+    with training_report.phase("fit"):
+        trained_model, _ = training.training_model(model=model,
+                                                   normalize_data=X_Train4D,
+                                                   onehot_data=y_Train,
+                                                   normalize_header=image_header,
+                                                   onehot_header=label_header,
+                                                   callbacks=[training.EpochReportCallback(training_report)])
+    training_buckets = function_environment(TRAINING_FUNCTION)["bucket_names"].split(",")
+    if checkpoints:
+        training.create_buckets(minioClient, training_buckets)
+    writer.submit(TRAINING_FUNCTION, training.upload_model_to_bucket,
+                  client=minioClient,
+                  bucket_name=training_buckets[0],
+                  object_name=training.TRAINED_MODEL_KERAS_FILENAME,
+                  model=trained_model)
+
+    # evaluate
+    metrics = evaluate.run_evaluation(evaluate_report, trained_model, X_Test4D, image_header, y_Test, label_header)
+    metrics["model"] = training.TRAINED_MODEL_KERAS_FILENAME
+    evaluate_buckets = function_environment(EVALUATE_FUNCTION)["bucket_names"].split(",")
+    if checkpoints:
+        evaluate.create_buckets(minioClient, evaluate_buckets)
+    writer.submit(EVALUATE_FUNCTION, evaluate.write_metrics, minioClient, evaluate_buckets[0], run_id, metrics)
+
+    with preprocess_report.phase("checkpoint_wait"):
+        results = writer.wait()
+
+    if checkpoints:
+        preprocess.write_run_report(minioClient, preprocess_report)
+        training.write_run_report(minioClient, training_report)
+        evaluate.write_run_report(minioClient, evaluate_report)
+
+    return {
+        "run_id": run_id,
+        "checkpoints": {
+            PREPROCESS_FUNCTION: bool(results.get(PREPROCESS_FUNCTION)) and all(results[PREPROCESS_FUNCTION]),
+            TRAINING_FUNCTION: bool(results.get(TRAINING_FUNCTION)),
+        } if checkpoints else {},
+        "stages": [report.to_dict() for report in reports],
+        "metrics": metrics,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the MNIST pipeline stages in a single process")
+    parser.add_argument("--storage", help="directory backing a fake MinIO instead of the MinIO in the stack file")
+    parser.add_argument("--minio-endpoint", help="override the MinIO endpoint from the stack file")
+    parser.add_argument("--train-samples", type=int, help="use a synthetic dataset with this many training images")
+    parser.add_argument("--test-samples", type=int, default=1000, help="synthetic test images")
+    parser.add_argument("--no-checkpoints", action="store_true", help="do not write stage checkpoints to MinIO")
+    parser.add_argument("--run-id", default=uuid.uuid4().hex, help="pipeline run ID")
+    parser.add_argument("--output", help="write the run summary as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    overrides = {"metrics_port": "0"}
+    if args.minio_endpoint:
+        overrides["minio_api_endpoint"] = args.minio_endpoint
+    client = FakeMinio(args.storage) if args.storage else None
+    dataset = synthetic_mnist(args.train_samples, args.test_samples) if args.train_samples else None
+
+    started = time.perf_counter()
+    summary = run_fused(args.run_id, overrides, client=client, dataset=dataset, checkpoints=not args.no_checkpoints)
+    summary["seconds"] = time.perf_counter() - started
+    print(f"fused pipeline {args.run_id} completed in {summary['seconds']:.2f}s, checkpoints {summary['checkpoints']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    return 0 if all(summary["checkpoints"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import importlib.util
+import os
+import types
+
+import numpy as np
+import yaml
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIPELINE_FILE = os.path.join(REPO_ROOT, "mnist-pipeline.yml")
+GATEWAY_ENDPOINT = "gateway.benchmark.local:8080"
+
+
+class StubGateway:
+    """取代 HTTP session 的 OpenFaaS gateway stub，只記錄被觸發的 function"""
+
+    def __init__(self):
+        self.calls = []
+
+    def _call(self, method: str, url: str, **kwargs):
+        self.calls.append({"method": method, "url": url, "json": kwargs.get("json")})
+        return types.SimpleNamespace(status_code=202, ok=True, text="", json=lambda: {},
+                                     raise_for_status=lambda: None)
+
+    def get(self, url: str, **kwargs):
+        return self._call("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self._call("POST", url, **kwargs)
+
+
+def function_environment(function_name: str, pipeline_file: str = PIPELINE_FILE):
+    """從 OpenFaaS stack 檔案取得 function 的環境變數
+
+    Args:
+        function_name (str): OpenFaaS function 名稱
+        pipeline_file (str): OpenFaaS stack 檔案路徑
+    """
+
+    with open(pipeline_file, 'r') as f:
+        stack = yaml.safe_load(f)
+
+    environment = stack["functions"][function_name].get("environment") or {}
+    # faas-cli 會把 YAML 的 boolean 轉成小寫字串
+    return {
+        name: str(value).lower() if isinstance(value, bool) else str(value)
+        for name, value in environment.items()
+    }
+
+
+def load_handler(function_name: str):
+    """以獨立的 module 名稱載入 function 的 handler.py
+
+    Args:
+        function_name (str): OpenFaaS function 名稱 (也是 handler 目錄名稱)
+    """
+
+    module_name = f"{function_name.replace('-', '_')}_handler"
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, function_name, "handler.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_mnist(train_samples: int, test_samples: int, seed: int = 10):
+    """產生與 keras.datasets.mnist.load_data() 相同格式的合成資料
+
+    每個類別的影像有不同的亮度，模型可以學得起來，準確率才有比較的意義。
+
+    Args:
+        train_samples (int): 訓練資料筆數
+        test_samples (int): 測試資料筆數
+        seed (int): 亂數種子
+    """
+
+    rng = np.random.default_rng(seed)
+
+    def make(samples: int):
+        labels = rng.integers(0, 10, samples).astype('uint8')
+        noise = rng.integers(0, 64, (samples, 28, 28), dtype='uint8')
+        images = (noise + labels[:, None, None] * 19).astype('uint8')
+        return images, labels
+
+    return make(train_samples), make(test_samples)
+
+
+def install_stubs(module, client=None, gateway: StubGateway = None, dataset=None):
+    """將 handler 的外部相依 (MinIO、gateway、mnist 資料集) 換成本機的 stand-in
+
+    Args:
+        module: handler module
+        client: 取代 connect_minio() 回傳值的 MinIO client，None 表示使用真正的 MinIO
+        gateway (StubGateway): 取代 get_http_session() 回傳值的 gateway stub
+        dataset: 取代 mnist.load_data() 回傳值的資料集
+    """
+
+    if client is not None and hasattr(module, "connect_minio"):
+        module.connect_minio = lambda: client
+    if gateway is not None and hasattr(module, "get_http_session"):
+        module.get_http_session = lambda: gateway
+    if dataset is not None and hasattr(module, "mnist"):
+        module.mnist = types.SimpleNamespace(load_data=lambda: dataset)
+
+
+def set_environment(function_name: str, overrides: dict = None):
+    """設定 function 在 stack 檔案中的環境變數，再套用 overrides
+
+    Args:
+        function_name (str): OpenFaaS function 名稱
+        overrides (dict): 要覆寫的環境變數
+    """
+
+    environment = function_environment(function_name)
+    environment["openfaas_gateway_endpoint"] = GATEWAY_ENDPOINT
+    environment.update(overrides or {})
+    os.environ.update(environment)
+    return environment
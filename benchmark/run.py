@@ -0,0 +1,283 @@
+"""MNIST pipeline benchmark
+
+在本機以 process 內呼叫的方式依序執行四個 function 的 handle，MinIO 以檔案系統的 FakeMinio
+(或 --minio-endpoint 指定的 S3 相容服務) 取代，gateway 以 StubGateway 取代，資料集為合成的
+MNIST 格式資料。每個 stage 在獨立的 process 中執行，量測 latency、throughput (images/s)、
+peak RSS 與傳輸量，並與 baseline 比較。
+
+Usage:
+    python -m benchmark.run
+    python -m benchmark.run --update-baseline
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from benchmark.fake_minio import FakeMinio
+from benchmark.harness import REPO_ROOT, StubGateway, install_stubs, load_handler, set_environment, synthetic_mnist
+
+
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+RESULT_PREFIX = "BENCHMARK_RESULT "
+
+# (stage 名稱, OpenFaaS function 名稱)，依照 pipeline 的執行順序
+STAGES = [
+    ("preprocess", "mnist-preprocess"),
+    ("training", "mnist-training-model"),
+    ("evaluate", "mnist-model-evaluate"),
+    ("trigger", "mnist-faas-trigger"),
+]
+# 數值越大越差的指標，用來和 baseline 比較
+REGRESSION_METRICS = ["latency_seconds", "peak_rss_bytes", "bytes_transferred"]
+# 毫秒等級的 latency 抖動很大，低於此值的差異不算退步
+LATENCY_NOISE_SECONDS = 0.05
+
+
+def stage_samples(stage: str, args):
+    """取得 stage 處理的影像數量，用來計算 images/s
+
+    Args:
+        stage (str): stage 名稱
+        args (argparse.Namespace): 命令列參數
+    """
+
+    return {
+        "preprocess": args.train_samples + args.test_samples,
+        "training": args.train_samples,
+        "evaluate": args.test_samples,
+        "trigger": 0,
+    }[stage]
+
+
+def run_stage(stage: str, function_name: str, args):
+    """在目前的 process 中執行單一 stage，回傳量測結果
+
+    Args:
+        stage (str): stage 名稱
+        function_name (str): OpenFaaS function 名稱
+        args (argparse.Namespace): 命令列參數
+    """
+
+    overrides = {
+        # 每次都要真的執行 preprocess，不能被 artifact cache 跳過
+        "artifact_cache": "false",
+        "metrics_port": "0",
+    }
+    if args.minio_endpoint:
+        overrides["minio_api_endpoint"] = args.minio_endpoint
+    set_environment(function_name, overrides)
+
+    # startup 算到背景 preload 完成為止，延遲 import 的時間才不會被算進 latency
+    started = time.perf_counter()
+    module = load_handler(function_name)
+    for thread in threading.enumerate():
+        if thread.name.startswith("preload-"):
+            thread.join()
+    startup_seconds = time.perf_counter() - started
+    if args.intra_op_threads and hasattr(module, "tf"):
+        module.tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+
+    client = None if args.minio_endpoint else FakeMinio(args.storage)
+    gateway = StubGateway()
+    dataset = synthetic_mnist(args.train_samples, args.test_samples) if stage == "preprocess" else None
+    install_stubs(module, client=client, gateway=gateway, dataset=dataset)
+
+    request = {"run_id": args.run_id}
+    if args.num_workers > 1:
+        request.update(worker_index=args.worker_index, num_workers=args.num_workers)
+    if stage == "trigger":
+        request["next_stage"] = "mnist-preprocess"
+
+    # handler 的輸出導到 stderr，stdout 只留給量測結果
+    with contextlib.redirect_stdout(sys.stderr):
+        started = time.perf_counter()
+        module.handle(json.dumps(request))
+        latency_seconds = time.perf_counter() - started
+
+    samples = stage_samples(stage, args)
+    return {
+        "stage": stage,
+        "function": function_name,
+        "startup_seconds": startup_seconds,
+        "latency_seconds": latency_seconds,
+        "images_per_second": samples / latency_seconds if samples else None,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "bytes_uploaded": client.bytes_uploaded if client else None,
+        "bytes_downloaded": client.bytes_downloaded if client else None,
+        "bytes_transferred": client.bytes_uploaded + client.bytes_downloaded if client else None,
+        "minio_requests": client.requests if client else None,
+        "gateway_calls": len(gateway.calls),
+    }
+
+
+def stage_command(stage: str, args, *extra: str):
+    """組出在獨立 process 中執行單一 stage 的命令
+
+    Args:
+        stage (str): stage 名稱
+        args (argparse.Namespace): 命令列參數
+        extra (str): 額外的命令列參數
+    """
+
+    command = [sys.executable, "-m", "benchmark.run",
+               "--stage", stage,
+               "--storage", args.storage,
+               "--run-id", args.run_id,
+               "--train-samples", str(args.train_samples),
+               "--test-samples", str(args.test_samples)]
+    if args.minio_endpoint:
+        command += ["--minio-endpoint", args.minio_endpoint]
+    return command + list(extra)
+
+
+def parse_result(stage: str, stdout: str):
+    """從 stage process 的輸出取得量測結果
+
+    Args:
+        stage (str): stage 名稱
+        stdout (str): stage process 的 stdout
+    """
+
+    for line in reversed(stdout.splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"stage {stage} did not report a result")
+
+
+def spawn_stage(stage: str, args):
+    """在獨立的 process 中執行單一 stage，讓 peak RSS 與 cold start 互不影響
+
+    Args:
+        stage (str): stage 名稱
+        args (argparse.Namespace): 命令列參數
+    """
+
+    completed = subprocess.run(stage_command(stage, args),
+                               cwd=REPO_ROOT,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL if args.quiet else None,
+                               text=True,
+                               check=True)
+    return parse_result(stage, completed.stdout)
+
+
+def compare_with_baseline(results: list, baseline: dict, tolerance: float):
+    """與 baseline 比較，回傳退步的指標
+
+    Args:
+        results (list): 本次的量測結果
+        baseline (dict): baseline 的量測結果
+        tolerance (float): 允許的退步比例
+    """
+
+    baseline_stages = {result["stage"]: result for result in baseline.get("stages", [])}
+    regressions = []
+    for result in results:
+        expected = baseline_stages.get(result["stage"])
+        if expected is None:
+            continue
+        for metric in REGRESSION_METRICS:
+            current, previous = result.get(metric), expected.get(metric)
+            if current is None or not previous:
+                continue
+            slack = LATENCY_NOISE_SECONDS if metric == "latency_seconds" else 0
+            if current > previous * (1 + tolerance) + slack:
+                regressions.append(f"{result['stage']}.{metric}: {current:.4g} > {previous:.4g} "
+                                   f"(+{(current / previous - 1) * 100:.1f}%)")
+    return regressions
+
+
+def print_results(results: list):
+    """印出量測結果表格
+
+    Args:
+        results (list): 量測結果
+    """
+
+    def mib(value):
+        return "-" if value is None else f"{value / (1024 * 1024):.1f}"
+
+    print(f"{'stage':<12}{'startup s':>11}{'latency s':>11}{'images/s':>11}{'peak RSS MiB':>14}"
+          f"{'up MiB':>9}{'down MiB':>10}")
+    for result in results:
+        images_per_second = result["images_per_second"]
+        print(f"{result['stage']:<12}{result['startup_seconds']:>11.2f}{result['latency_seconds']:>11.2f}"
+              f"{'-' if images_per_second is None else f'{images_per_second:.0f}':>11}"
+              f"{mib(result['peak_rss_bytes']):>14}{mib(result['bytes_uploaded']):>9}{mib(result['bytes_downloaded']):>10}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MNIST OpenFaaS pipeline locally")
+    parser.add_argument("--train-samples", type=int, default=6000, help="number of synthetic training images")
+    parser.add_argument("--test-samples", type=int, default=1000, help="number of synthetic test images")
+    parser.add_argument("--storage", help="directory backing the fake MinIO (default: a temporary directory)")
+    parser.add_argument("--minio-endpoint", help="use a real S3-compatible endpoint instead of the fake MinIO")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE, help="baseline results file")
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression ratio")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--quiet", action="store_true", help="hide handler logs")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--run-id", default=uuid.uuid4().hex, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-index", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--num-workers", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--intra-op-threads", type=int, default=0, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.stage:
+        function_name = dict(STAGES)[args.stage]
+        print(RESULT_PREFIX + json.dumps(run_stage(args.stage, function_name, args)))
+        return 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args.storage = args.storage or tmp_dir
+        results = [spawn_stage(stage, args) for stage, _ in STAGES]
+
+    report = {
+        "train_samples": args.train_samples,
+        "test_samples": args.test_samples,
+        "stages": results,
+    }
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --update-baseline to create one")
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    if (baseline.get("train_samples"), baseline.get("test_samples")) != (args.train_samples, args.test_samples):
+        print("baseline was recorded with a different dataset size, skip comparison")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"[Regression] {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Batch scoring benchmark
+
+在 FakeMinio 中產生合成的 28x28 影像 object 與一個未訓練的模型，以 process 內呼叫的方式執行
+mnist-batch-scoring 的 handle，量測 images/s。第一次執行會推論所有 shard，接著以同一個 job ID
+再執行一次，確認已經完成的 shard 都會被略過。
+
+Usage:
+    python -m benchmark.scoring
+    python -m benchmark.scoring --images 200000 --images-per-object 100 --env model_backend=tflite
+"""
+
+import argparse
+import io
+import json
+import sys
+import tempfile
+
+import numpy as np
+
+from benchmark.fake_minio import FakeMinio
+from benchmark.harness import install_stubs, load_handler, set_environment, synthetic_mnist
+
+
+SCORING_FUNCTION = "mnist-batch-scoring"
+TRAINING_FUNCTION = "mnist-training-model"
+
+
+def upload_model(client, overrides: dict):
+    """以 training handler 建立未訓練的模型並上傳到 mnist-training-model bucket
+
+    Args:
+        client: 取代 connect_minio() 回傳值的 MinIO client
+        overrides (dict): 要覆寫的環境變數
+    """
+
+    set_environment(TRAINING_FUNCTION, dict(overrides, metrics_port="0"))
+    training = load_handler(TRAINING_FUNCTION)
+    install_stubs(training, client=client)
+    training.create_buckets(client, ["mnist-training-model"])
+    training.upload_model_to_bucket(client=client,
+                                    bucket_name="mnist-training-model",
+                                    object_name=training.TRAINED_MODEL_KERAS_FILENAME,
+                                    model=training.model_build())
+
+
+def upload_images(client, bucket_name: str, prefix: str, images: int, images_per_object: int):
+    """將合成的 uint8 影像以 .npy object 上傳，每個 object 包含 images_per_object 張
+
+    Args:
+        client: 取代 connect_minio() 回傳值的 MinIO client
+        bucket_name (str): 輸入的 MinIO Bucket 名稱
+        prefix (str): 輸入 object 的 prefix
+        images (int): 影像總數
+        images_per_object (int): 每個 object 的影像數量
+    """
+
+    (pixels, _), _ = synthetic_mnist(images, 1)
+    client.make_bucket(bucket_name)
+    for index, start in enumerate(range(0, images, images_per_object)):
+        buffer = io.BytesIO()
+        np.save(buffer, pixels[start:start + images_per_object])
+        client.put_object(bucket_name, f"{prefix}{index:08d}.npy", io.BytesIO(buffer.getvalue()),
+                          len(buffer.getvalue()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the batch scoring job on a fake MinIO")
+    parser.add_argument("--images", type=int, default=50000, help="number of synthetic images to score")
+    parser.add_argument("--images-per-object", type=int, default=1, help="images stored in each .npy object")
+    parser.add_argument("--storage", help="directory backing the fake MinIO (default: a temporary directory)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="override an environment variable of the stack file")
+    parser.add_argument("--output", help="write the job summaries as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    overrides = dict(entry.split("=", 1) for entry in args.env)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client = FakeMinio(args.storage or tmp_dir)
+        upload_model(client, overrides)
+
+        environment = set_environment(SCORING_FUNCTION, overrides)
+        upload_images(client, environment["input_bucket"], environment["input_prefix"],
+                      args.images, args.images_per_object)
+        scoring = load_handler(SCORING_FUNCTION)
+        install_stubs(scoring, client=client)
+
+        summaries = []
+        for attempt in ("score", "resume"):
+            result = scoring.handle(json.dumps({"job_id": "benchmark"}))
+            if result["statusCode"] != 200:
+                raise RuntimeError(f"batch scoring {attempt} failed: {result['message']}")
+            summaries.append(dict(result["summary"], attempt=attempt))
+
+    print(f"{'attempt':<8}{'shards':>8}{'skipped':>9}{'images':>10}{'seconds':>10}{'images/s':>11}")
+    for summary in summaries:
+        print(f"{summary['attempt']:<8}{summary['shards']:>8}{summary['shards_skipped']:>9}{summary['images']:>10}"
+              f"{summary['seconds']:>10.2f}{summary['images_per_second']:>11.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    return 0 if summaries[-1]["images"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Cold start profile
+
+以獨立的 process 載入每個 function 的 handler.py (與 OpenFaaS template 的 index.py 相同)，
+量測 handler import 到可以接受請求的時間、背景 preload 完成的時間，並以 python -X importtime
+列出 import 最花時間的 module。
+
+Usage:
+    python -m benchmark.startup
+    python -m benchmark.startup --function mnist-model-evaluate --env model_backend=tflite
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+import yaml
+
+from benchmark.harness import GATEWAY_ENDPOINT, PIPELINE_FILE, REPO_ROOT, function_environment
+
+
+# 載入 handler.py 後再等待 preload thread，兩個時間點都從 process 開始載入 handler 起算
+LOAD_SCRIPT = """
+import sys, threading, time
+started = time.perf_counter()
+import importlib.util
+spec = importlib.util.spec_from_file_location("handler", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+import_seconds = time.perf_counter() - started
+for thread in threading.enumerate():
+    if thread.name.startswith("preload-"):
+        thread.join()
+print("STARTUP_RESULT " + __import__("json").dumps({
+    "import_seconds": import_seconds,
+    "ready_seconds": time.perf_counter() - started,
+}))
+"""
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+
+def pipeline_functions(pipeline_file: str = PIPELINE_FILE):
+    """取得 stack 檔案中所有 function 的名稱
+
+    Args:
+        pipeline_file (str): OpenFaaS stack 檔案路徑
+    """
+
+    with open(pipeline_file, 'r') as f:
+        return list(yaml.safe_load(f)["functions"])
+
+
+def load_handler_process(function_name: str, overrides: dict = None, importtime: bool = False):
+    """在新的 process 中載入 handler，回傳 (量測結果, stderr)
+
+    Args:
+        function_name (str): OpenFaaS function 名稱
+        overrides (dict): 要覆寫的環境變數
+        importtime (bool): 是否加上 python -X importtime
+    """
+
+    environment = dict(os.environ)
+    environment.update(function_environment(function_name))
+    environment.update(openfaas_gateway_endpoint=GATEWAY_ENDPOINT, metrics_port="0", TF_CPP_MIN_LOG_LEVEL="3")
+    environment.update(overrides or {})
+
+    function_dir = os.path.join(REPO_ROOT, function_name)
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + \
+        ["-c", LOAD_SCRIPT, os.path.join(function_dir, "handler.py")]
+    process = subprocess.run(command, cwd=function_dir, env=environment, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"load {function_name} handler exited with {process.returncode}:\n{process.stderr}")
+
+    for line in process.stdout.splitlines():
+        if line.startswith("STARTUP_RESULT "):
+            return json.loads(line[len("STARTUP_RESULT "):]), process.stderr
+    raise RuntimeError(f"load {function_name} handler did not report its startup time")
+
+
+def top_imports(stderr: str, top: int):
+    """從 -X importtime 的輸出取得累計耗時最長的最上層 module
+
+    Args:
+        stderr (str): -X importtime 的輸出
+        top (int): 回傳的 module 數量
+    """
+
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            entries.append((len(match.group(3)), match.group(4), int(match.group(2)) / 1e6))
+    if not entries:
+        return []
+
+    level = min(depth for depth, _, _ in entries)
+    modules = [(name, seconds) for depth, name, seconds in entries if depth == level]
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:top]
+
+
+def profile_function(function_name: str, overrides: dict = None, repeat: int = 3, top: int = 5):
+    """量測一個 function 的 cold start
+
+    import 與 ready 時間取 repeat 次中最短的一次，module 排名另外以 -X importtime 執行一次。
+
+    Args:
+        function_name (str): OpenFaaS function 名稱
+        overrides (dict): 要覆寫的環境變數
+        repeat (int): 重複量測的次數
+        top (int): 列出的 module 數量
+    """
+
+    runs = [load_handler_process(function_name, overrides)[0] for _ in range(repeat)]
+    _, stderr = load_handler_process(function_name, overrides, importtime=True)
+    return {
+        "function": function_name,
+        "import_seconds": min(run["import_seconds"] for run in runs),
+        "ready_seconds": min(run["ready_seconds"] for run in runs),
+        "top_imports": top_imports(stderr, top),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the cold start of every function handler")
+    parser.add_argument("--function", action="append", help="function to profile (default: all in the stack file)")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="override an environment variable of the stack file")
+    parser.add_argument("--repeat", type=int, default=3, help="measurements per function, the fastest is reported")
+    parser.add_argument("--top", type=int, default=5, help="number of slowest imports to list")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    overrides = dict(entry.split("=", 1) for entry in args.env)
+
+    results = [profile_function(function_name, overrides, args.repeat, args.top)
+               for function_name in args.function or pipeline_functions()]
+
+    print(f"{'function':<24}{'import s':>10}{'ready s':>10}  slowest imports (cumulative s)")
+    for result in results:
+        imports = ", ".join(f"{name} {seconds:.2f}" for name, seconds in result["top_imports"])
+        print(f"{result['function']:<24}{result['import_seconds']:>10.2f}{result['ready_seconds']:>10.2f}  {imports}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
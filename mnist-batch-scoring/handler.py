@@ -0,0 +1,792 @@
+import bisect
+import hashlib
+import importlib
+import io
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
+
+TRAINED_MODEL_KERAS_FILENAME = "trained_model.keras"
+TRAINED_MODEL_TFLITE_FILENAME = "trained_model.tflite"
+TRAINED_MODEL_BUCKET_NAME = "mnist-training-model"
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+PIXEL_SCALE = 255
+JOB_PREFIX = "jobs"
+INPUT_BUCKET = os.environ.get("input_bucket", "mnist-scoring-input")
+INPUT_PREFIX = os.environ.get("input_prefix", "")
+SCORING_BATCH_SIZE = int(os.environ.get("scoring_batch_size", "1024"))
+SHARD_OBJECTS = int(os.environ.get("shard_objects", "2048"))
+PREFETCH_OBJECTS = int(os.environ.get("prefetch_objects", "256"))
+DECODE_WORKERS = int(os.environ.get("decode_workers", "8"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+SAVE_PROBABILITIES = os.environ.get("save_probabilities", "false") == "true"
+# "tflite" 以 TFLite interpreter 執行 training 輸出的量化模型，沒有 TFLite 模型時使用 .keras 模型
+MODEL_BACKEND = os.environ.get("model_backend", "keras")
+
+# warm container 之間共用的 MinIO client 與已經確認存在的 bucket
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+KNOWN_BUCKETS = set()
+KNOWN_BUCKETS_LOCK = threading.Lock()
+
+# process 啟動後延遲 import 的 module 與耗時 (秒)
+STARTUP_PROFILE = {}
+
+# warm container 之間共用的模型，依照 object 的 ETag/version 判斷是否需要重新載入
+MODEL_CACHE = {}
+MODEL_CACHE_LOCK = threading.Lock()
+
+
+class LazyModule:
+    """第一次存取屬性時才 import 的 module
+
+    keras 的 import 需要 1 秒以上，延後到真的需要時才載入，使用 TFLite 模型時完全不會載入。
+    import 的耗時記錄在 STARTUP_PROFILE。
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): module 名稱
+        """
+
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """import module，之後直接回傳同一個 module"""
+
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                seconds = time.perf_counter() - started
+                STARTUP_PROFILE[f"import {self.name}"] = seconds
+                print(f"[Startup] import {self.name}: {seconds:.2f}s")
+        return self.module
+
+    def preload(self):
+        """在背景 thread 中 import module，與 process 啟動後的其他工作重疊"""
+
+        threading.Thread(target=self.load, name=f"preload-{self.name}", daemon=True).start()
+
+
+keras = LazyModule("keras")
+minio = LazyModule("minio")
+minio_error = LazyModule("minio.error")
+# 只有輸入包含 .npy 以外的影像檔時才需要 Pillow
+Image = LazyModule("PIL.Image")
+if MODEL_BACKEND == "keras":
+    # 列出輸入 object 的同時，keras 已經在背景載入
+    keras.preload()
+
+
+def handle(req):
+    """handle a request to the function
+
+    request body 可以指定 job_id、input_bucket、input_prefix，沒有指定的話使用環境變數的設定；
+    同一個 job_id 重新執行時，已經完成的 shard 會被略過。
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        job = get_job(json.loads(req) if req else {})
+    except (ValueError, TypeError) as err:
+        return response(400, f"invalid request body. Error: {err}")
+
+    minioClient = connect_minio()
+    create_buckets(minioClient, get_bucket_names())
+
+    try:
+        summary = run_job(minioClient, job)
+    except minio_error.S3Error as err:
+        print(f"batch scoring job {job['job_id']} occurs error. Error: {err}")
+        return response(500, f"batch scoring job {job['job_id']} failed. Error: {err}")
+
+    return response(200, f"batch scoring job {job['job_id']} completed, "
+                         f"{summary['images']} image(s) scored at {summary['images_per_second']:.0f} images/s",
+                    summary)
+
+
+def get_job(data: dict):
+    """從 request body 與環境變數取得 job 設定
+
+    沒有指定 job_id 時以輸入位置產生，對同一個 prefix 重新執行就會接續上一次的進度。
+
+    Args:
+        data (dict): request body
+    """
+
+    if not isinstance(data, dict):
+        raise TypeError(f"expected a JSON object, got {type(data).__name__}")
+
+    input_bucket = str(data.get("input_bucket", INPUT_BUCKET))
+    input_prefix = str(data.get("input_prefix", INPUT_PREFIX))
+    job_id = data.get("job_id") or hashlib.sha256(f"{input_bucket}/{input_prefix}".encode()).hexdigest()[:16]
+    if "/" in str(job_id):
+        raise ValueError(f"job_id must not contain '/', got {job_id}")
+
+    return {
+        "job_id": str(job_id),
+        "input_bucket": input_bucket,
+        "input_prefix": input_prefix,
+        "output_bucket": get_bucket_names()[0],
+    }
+
+
+def run_job(client, job: dict):
+    """對輸入 prefix 底下所有的 object 執行推論，以 shard 為單位寫回結果與進度
+
+    Args:
+        client: MinIO Client instance
+        job (dict): get_job 回傳的 job 設定
+    """
+
+    job_dir = f"{JOB_PREFIX}/{job['job_id']}"
+    manifest = load_manifest(client, job)
+    done = completed_shards(client, job)
+    pending = len(manifest["shards"]) - len(done)
+    print(f"batch scoring job {job['job_id']}: {len(manifest['shards'])} shard(s), {len(done)} already scored")
+
+    # images/s 只計算推論的部分，不包含模型載入
+    # 整個 job 使用同一個模型，其他 job 中途重新載入模型時也不影響進度標記記錄的模型
+    model, loaded_version = get_model(client) if pending else (None, None)
+    started = time.perf_counter()
+    images, failed = 0, 0
+    if pending:
+        with ObjectPrefetcher(client, job["input_bucket"], job["input_prefix"], manifest["shards"], done) as prefetcher:
+            scorer = None
+            for index, object_name, future in prefetcher:
+                if scorer is None:
+                    scorer = ShardScorer(model, index)
+
+                # shard 內的 object 都已經取出，推論剩下的影像並寫回結果
+                if object_name is None:
+                    progress = scorer.finish()
+                    write_shard(client, job, progress, scorer.to_npz(), loaded_version)
+                    images += progress["images"]
+                    failed += len(progress["failed"])
+                    scorer = None
+                    continue
+
+                try:
+                    scorer.add(object_name, future.result())
+                except (minio_error.S3Error, ValueError, OSError) as err:
+                    print(f"decode {job['input_bucket']}/{object_name} occurs error. Error: {err}")
+                    scorer.failed.append(object_name)
+    seconds = time.perf_counter() - started
+
+    summary = {
+        "job_id": job["job_id"],
+        "input": f"{job['input_bucket']}/{job['input_prefix']}",
+        "shards": len(manifest["shards"]),
+        "shards_skipped": len(done),
+        "images": images,
+        "failed_objects": failed,
+        "seconds": seconds,
+        "images_per_second": images / seconds if images else 0.0,
+    }
+    put_json_to_bucket(client, job["output_bucket"], f"{job_dir}/job.json", summary)
+    print(f"[Scoring] job {job['job_id']}: {images} images in {seconds:.2f}s "
+          f"({summary['images_per_second']:.0f} images/s), {failed} failed object(s)")
+    return summary
+
+
+def load_manifest(client, job: dict):
+    """取得 job 的 shard 切分方式，第一次執行時列出輸入 object 建立 manifest
+
+    manifest 只記錄每個 shard 第一個與最後一個 object 名稱，不保存所有 object 名稱；
+    重新執行時依照這些邊界把 object 分回原本的 shard，進度標記才會對應到同一批 object。
+
+    Args:
+        client: MinIO Client instance
+        job (dict): get_job 回傳的 job 設定
+    """
+
+    object_name = f"{JOB_PREFIX}/{job['job_id']}/manifest.json"
+    try:
+        return get_json_from_bucket(client, job["output_bucket"], object_name)
+    except minio_error.S3Error as err:
+        if err.code != "NoSuchKey":
+            raise
+
+    shards, first, last, count = [], None, None, 0
+    for name in list_input_objects(client, job["input_bucket"], job["input_prefix"]):
+        if count == 0:
+            first = name
+        last = name
+        count += 1
+        if count == SHARD_OBJECTS:
+            shards.append({"index": len(shards), "first": first, "last": last, "objects": count})
+            count = 0
+    if count:
+        shards.append({"index": len(shards), "first": first, "last": last, "objects": count})
+
+    manifest = {
+        "job_id": job["job_id"],
+        "input_bucket": job["input_bucket"],
+        "input_prefix": job["input_prefix"],
+        "created_at": time.time(),
+        "shards": shards,
+    }
+    put_json_to_bucket(client, job["output_bucket"], object_name, manifest)
+    return manifest
+
+
+def completed_shards(client, job: dict):
+    """取得已經寫入進度標記的 shard 編號
+
+    Args:
+        client: MinIO Client instance
+        job (dict): get_job 回傳的 job 設定
+    """
+
+    prefix = f"{JOB_PREFIX}/{job['job_id']}/progress/"
+    return {
+        int(os.path.splitext(obj.object_name[len(prefix):])[0])
+        for obj in client.list_objects(job["output_bucket"], prefix=prefix, recursive=True)
+    }
+
+
+def list_input_objects(client, bucket_name: str, prefix: str):
+    """依照名稱排序列出可以推論的輸入 object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): 輸入的 MinIO Bucket 名稱
+        prefix (str): 輸入 object 的 prefix
+    """
+
+    for obj in client.list_objects(bucket_name, prefix=prefix or None, recursive=True):
+        if not obj.is_dir and obj.object_name.lower().endswith((".npy", ".png", ".jpg", ".jpeg")):
+            yield obj.object_name
+
+
+def shard_of(shards: list, firsts: list, object_name: str):
+    """依照 manifest 的邊界取得 object 所屬的 shard，超出最後一個 shard 的 object 回傳 None
+
+    Args:
+        shards (list[dict]): manifest 中的 shard
+        firsts (list[str]): 每個 shard 第一個 object 的名稱
+        object_name (str): object 名稱
+    """
+
+    position = bisect.bisect_right(firsts, object_name) - 1
+    if position < 0 or object_name > shards[-1]["last"]:
+        return None
+    return shards[position]["index"]
+
+
+class ObjectPrefetcher:
+    """背景 thread 依序列出輸入 object，交給 thread pool 下載並解碼
+
+    queue 有大小上限，推論跟不上時列出 object 的 thread 就會停下來，記憶體中最多只有
+    max_prefetch 個 object。取出的順序與列出的順序相同，每個 shard 結束時會多取出一個
+    (shard 編號, None, None)。
+    """
+
+    def __init__(self, client, bucket_name: str, prefix: str, shards: list, skip: set,
+                 max_workers: int = DECODE_WORKERS, max_prefetch: int = PREFETCH_OBJECTS):
+        """
+        Args:
+            client: MinIO Client instance
+            bucket_name (str): 輸入的 MinIO Bucket 名稱
+            prefix (str): 輸入 object 的 prefix
+            shards (list[dict]): manifest 中的 shard
+            skip (set[int]): 已經完成、不需要再推論的 shard 編號
+            max_workers (int): 下載與解碼的 thread 數量
+            max_prefetch (int): 已經送出但還沒被取出的 object 數量上限
+        """
+
+        self.client = client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.shards = shards
+        self.skip = skip
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="decode")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.thread.join()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def run(self):
+        firsts = [shard["first"] for shard in self.shards]
+        current = None
+        try:
+            for object_name in list_input_objects(self.client, self.bucket_name, self.prefix):
+                index = shard_of(self.shards, firsts, object_name)
+                if index is None or index in self.skip:
+                    continue
+                if index != current:
+                    if current is not None:
+                        self.put((current, None, None))
+                    current = index
+                self.put((index, object_name, self.executor.submit(load_object, self.client, self.bucket_name,
+                                                                   object_name)))
+            if current is not None:
+                self.put((current, None, None))
+            self.put(None)
+        except Exception as err:
+            self.put(err)
+
+    def put(self, item):
+        # 取出的一方已經結束時不再等待 queue 的空位
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def load_object(client, bucket_name: str, object_name: str):
+    """下載並解碼一個輸入 object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): 輸入的 MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    return decode_crops(object_name, get_object_bytes(client, bucket_name, object_name))
+
+
+def decode_crops(object_name: str, data: bytes):
+    """將輸入 object 解碼成 (N, 28, 28) 的影像
+
+    .npy 可以包含一張或多張影像，uint8 為 0~255 的像素值，浮點數視為已經標準化到 0~1；
+    其他影像檔以 Pillow 轉成灰階的單張影像。
+
+    Args:
+        object_name (str): object 名稱
+        data (bytes): object 內容
+    """
+
+    if object_name.lower().endswith(".npy"):
+        images = np.load(io.BytesIO(data), allow_pickle=False)
+    else:
+        with Image.open(io.BytesIO(data)) as image:
+            images = np.asarray(image.convert("L"))
+
+    if images.ndim == 4 and images.shape[-1] == 1:
+        images = images[..., 0]
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    if images.ndim != 3 or images.shape[1:] != (28, 28):
+        raise ValueError(f"expected 28x28 images, got shape {images.shape}")
+    return images
+
+
+class ShardScorer:
+    """累計一個 shard 的影像，每湊滿 batch_size 張就向量化推論一次
+
+    影像在推論前才轉成標準化的 float32，等待推論的影像不會超過一個 batch。
+    結果以欄位 (columnar) 的方式保存，objects 只記錄一次 object 名稱，其他欄位每張影像一筆。
+    """
+
+    def __init__(self, model, index: int, batch_size: int = SCORING_BATCH_SIZE,
+                 save_probabilities: bool = SAVE_PROBABILITIES):
+        """
+        Args:
+            model (keras.models.Sequential | TFLiteModel): 訓練後的模型
+            index (int): shard 編號
+            batch_size (int): 每次推論的影像數量
+            save_probabilities (bool): 是否保存每個類別的機率
+        """
+
+        self.model = model
+        self.index = index
+        self.batch_size = batch_size
+        self.save_probabilities = save_probabilities
+        self.started = time.perf_counter()
+        self.objects = []
+        self.failed = []
+        self.pending = []
+        self.pending_images = 0
+        self.columns = {"object": [], "item": [], "class": [], "confidence": [], "probabilities": []}
+
+    def add(self, object_name: str, images):
+        """加入一個 object 解碼後的影像
+
+        Args:
+            object_name (str): object 名稱
+            images (numpy.ndarray): (N, 28, 28) 影像
+        """
+
+        self.columns["object"].append(np.full(len(images), len(self.objects), dtype='int32'))
+        self.columns["item"].append(np.arange(len(images), dtype='int32'))
+        self.objects.append(object_name)
+        self.pending.append(images)
+        self.pending_images += len(images)
+        if self.pending_images >= self.batch_size:
+            self.flush(final=False)
+
+    def flush(self, final: bool):
+        """推論等待中的影像，final 為 False 時只推論湊滿的 batch
+
+        Args:
+            final (bool): 是否推論剩下不滿一個 batch 的影像
+        """
+
+        if not self.pending_images:
+            return
+
+        images = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+        stop = len(images) if final else len(images) - len(images) % self.batch_size
+        for start in range(0, stop, self.batch_size):
+            self.predict(images[start:min(start + self.batch_size, stop)])
+
+        self.pending = [images[stop:]] if stop < len(images) else []
+        self.pending_images = len(images) - stop
+
+    def predict(self, images):
+        if images.dtype == np.uint8:
+            batch = images.astype('float32')
+            batch /= PIXEL_SCALE
+        else:
+            batch = images.astype('float32', copy=False)
+
+        probabilities = np.asarray(self.model.predict_on_batch(batch[..., np.newaxis]))
+        self.columns["class"].append(np.argmax(probabilities, axis=1).astype('uint8'))
+        self.columns["confidence"].append(np.max(probabilities, axis=1).astype('float32'))
+        if self.save_probabilities:
+            self.columns["probabilities"].append(probabilities.astype('float16'))
+
+    def finish(self):
+        """推論剩下的影像，回傳 shard 的進度標記"""
+
+        self.flush(final=True)
+        seconds = time.perf_counter() - self.started
+        images = sum(len(column) for column in self.columns["class"])
+        print(f"[Scoring] shard {self.index}: {images} images from {len(self.objects)} object(s) in {seconds:.2f}s "
+              f"({images / seconds if seconds else 0:.0f} images/s)")
+        return {
+            "shard": self.index,
+            "objects": len(self.objects),
+            "images": images,
+            "failed": self.failed,
+            "seconds": seconds,
+        }
+
+    def to_npz(self):
+        """將 shard 的推論結果寫成 .npz，每個欄位是一個陣列"""
+
+        columns = {
+            name: np.concatenate(values) for name, values in self.columns.items() if values
+        }
+        columns["objects"] = np.array(self.objects, dtype=str)
+        buffer = io.BytesIO()
+        np.savez(buffer, **columns)
+        return buffer.getvalue()
+
+
+def write_shard(client, job: dict, progress: dict, data: bytes, loaded_version: tuple):
+    """上傳 shard 的推論結果，再寫入進度標記
+
+    進度標記在結果上傳完成後才寫入，中途失敗的 shard 重新執行時會整個重新推論。
+
+    Args:
+        client: MinIO Client instance
+        job (dict): get_job 回傳的 job 設定
+        progress (dict): ShardScorer.finish 回傳的進度標記
+        data (bytes): ShardScorer.to_npz 回傳的推論結果
+        loaded_version (tuple): 推論使用的模型 (object 名稱, ETag/version)，由 get_model 回傳
+    """
+
+    job_dir = f"{JOB_PREFIX}/{job['job_id']}"
+    shard_name = f"{progress['shard']:05d}"
+    progress = dict(progress, output=f"{job_dir}/shards/{shard_name}.npz",
+                    model=loaded_version[0], model_version=loaded_version[1])
+    client.put_object(bucket_name=job["output_bucket"],
+                      object_name=progress["output"],
+                      data=io.BytesIO(data),
+                      length=len(data),
+                      content_type="application/octet-stream")
+    put_json_to_bucket(client, job["output_bucket"], f"{job_dir}/progress/{shard_name}.json", progress)
+
+
+def get_model(client):
+    """取得目前的模型與它的 (object 名稱, ETag/version)，只有 ETag/version 改變時才重新載入
+
+    Args:
+        client: MinIO Client instance
+    """
+
+    with MODEL_CACHE_LOCK:
+        object_name, version = model_version(client)
+        if not MODEL_CACHE or MODEL_CACHE["version"] != (object_name, version):
+            print(f"load model {TRAINED_MODEL_BUCKET_NAME}/{object_name} {version}")
+            if object_name == TRAINED_MODEL_TFLITE_FILENAME:
+                MODEL_CACHE["model"] = TFLiteModel(get_object_bytes(client, TRAINED_MODEL_BUCKET_NAME, object_name))
+            else:
+                MODEL_CACHE["model"] = load_model_from_bucket(client=client,
+                                                              bucket_name=TRAINED_MODEL_BUCKET_NAME,
+                                                              object_name=object_name)
+            MODEL_CACHE["version"] = (object_name, version)
+        return MODEL_CACHE["model"], MODEL_CACHE["version"]
+
+
+def model_version(client):
+    """依照 MODEL_BACKEND 取得要載入的模型 object 名稱與它的 ETag/version
+
+    Args:
+        client: MinIO Client instance
+    """
+
+    if MODEL_BACKEND == "tflite":
+        try:
+            return TRAINED_MODEL_TFLITE_FILENAME, object_version(client, TRAINED_MODEL_BUCKET_NAME,
+                                                                 TRAINED_MODEL_TFLITE_FILENAME)
+        except minio_error.S3Error as err:
+            if err.code != "NoSuchKey":
+                raise
+            print(f"{TRAINED_MODEL_TFLITE_FILENAME} not found, use {TRAINED_MODEL_KERAS_FILENAME}")
+    return TRAINED_MODEL_KERAS_FILENAME, object_version(client, TRAINED_MODEL_BUCKET_NAME, TRAINED_MODEL_KERAS_FILENAME)
+
+
+class TFLiteModel:
+    """以 TFLite interpreter 執行模型，提供 ShardScorer 用到的 predict_on_batch
+
+    interpreter 不是 thread-safe，get_model 會將同一個 instance 交給同時執行的 job，
+    所以每個 batch 的 resize、set_tensor、invoke 與 get_tensor 都在 lock 內完成。
+    """
+
+    def __init__(self, model_content: bytes):
+        """
+        Args:
+            model_content (bytes): TFLite 模型
+        """
+
+        self.interpreter = load_tflite_interpreter(model_content)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.allocated_batch_size = 0
+        self.lock = threading.Lock()
+
+    def predict_on_batch(self, images):
+        """預測一個 batch
+
+        Args:
+            images (numpy.ndarray): 標準化後的影像
+        """
+
+        images = np.asarray(images, dtype='float32')
+        with self.lock:
+            if len(images) != self.allocated_batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, list(images.shape))
+                self.interpreter.allocate_tensors()
+                self.allocated_batch_size = len(images)
+            self.interpreter.set_tensor(self.input_index, images)
+            self.interpreter.invoke()
+            # get_tensor 回傳複本，釋放 lock 之後不會被其他 job 覆寫
+            return self.interpreter.get_tensor(self.output_index)
+
+
+def load_tflite_interpreter(model_content: bytes):
+    """建立 TFLite interpreter，優先使用 LiteRT，沒有安裝時使用 TensorFlow 內建的 interpreter
+
+    Args:
+        model_content (bytes): TFLite 模型
+    """
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_content=model_content)
+
+
+def connect_minio():
+    """取得 process 共用的 MinIO client，第一次呼叫時才建立
+
+    warm container 的請求之間重複使用同一個 urllib3 connection pool 的 keep-alive 連線，
+    pool 的連線數量不少於平行傳輸的 thread 數量，連線才不會用完就被丟棄。
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+
+            http_client = PoolManager(
+                maxsize=max(MINIO_MAX_CONNECTIONS, DECODE_WORKERS),
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = minio.Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
+
+
+def get_bucket_names():
+    """從環境變數中取得 Minio Bucket 名稱"""
+
+    bucket_names = os.environ["bucket_names"]
+    return bucket_names.split(",")
+
+
+def create_buckets(client, bucket_names: list):
+    """建立 Minio Bucket
+
+    Args:
+        client: Minio Client instance
+        bucket_names (list[str]): 要建立的 Minio Bucket 名稱
+    """
+
+    with KNOWN_BUCKETS_LOCK:
+        for name in bucket_names:
+            # warm container 已經確認過的 bucket 不需要再詢問 MinIO
+            if name in KNOWN_BUCKETS:
+                continue
+            if client.bucket_exists(name):
+                print(f"Bucket {name} already exists")
+            else:
+                client.make_bucket(name)
+                print(f"Bucket {name} created")
+            KNOWN_BUCKETS.add(name)
+
+
+def object_version(client, bucket_name: str, object_name: str):
+    """以 HEAD 取得 object 的 ETag 與 version
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    stat = client.stat_object(bucket_name, object_name)
+    return stat.etag, stat.version_id
+
+
+def get_object_bytes(client, bucket_name: str, object_name: str):
+    """下載整個 object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def get_json_from_bucket(client, bucket_name: str, object_name: str):
+    """取得 MinIO Bucket 內的 JSON object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要取得的 object 名稱
+    """
+
+    return json.loads(get_object_bytes(client, bucket_name, object_name))
+
+
+def put_json_to_bucket(client, bucket_name: str, object_name: str, data: dict):
+    """上傳 JSON object 到 MinIO Bucket 內
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要上傳的 object 名稱
+        data (dict): 要上傳的資料
+    """
+
+    body = json.dumps(data).encode()
+    client.put_object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      data=io.BytesIO(body),
+                      length=len(body),
+                      content_type="application/json")
+
+
+def load_model_from_bucket(client, bucket_name: str, object_name: str):
+    """從 MinIO Bucket 串流下載並載入模型
+
+    Keras 只能從檔案載入模型，所以模型先寫到暫存目錄，不佔用 /home/app。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 模型的 object 名稱
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, object_name)
+        response = client.get_object(bucket_name, object_name)
+        try:
+            with open(file_path, 'wb') as f:
+                for chunk in response.stream(ARTIFACT_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+
+        return keras.models.load_model(file_path)
+
+
+def response(statusCode: int, message: str, summary: dict = None):
+    """Create an HTTP response.
+
+    Args:
+        statusCode (int): HTTP status code
+        message (str): response message
+        summary (dict): batch scoring job summary
+    """
+
+    body = {
+        "statusCode": statusCode,
+        "message": message,
+    }
+    if summary is not None:
+        body["summary"] = summary
+    return body
@@ -0,0 +1,169 @@
+import io
+import json
+import os
+
+import numpy as np
+import pytest
+
+from . import handler
+from .handler import (JOB_PREFIX, ShardScorer, completed_shards, decode_crops, get_job, handle, load_manifest,
+                      load_object, run_job, shard_of)
+
+# Test your handler here
+
+# To disable testing, you can set the build_arg `TEST_ENABLED=false` on the CLI or in your stack.yml
+# https://docs.openfaas.com/reference/yaml/#function-build-args-build-args
+
+
+def test_handle():
+    # assert handle("input") == "input"
+    pass
+
+
+INPUT_BUCKET = "mnist-scoring-input"
+OUTPUT_BUCKET = "mnist-batch-scoring"
+LOADED_VERSION = ("trained_model.keras", "etag-1")
+
+
+class DigitModel:
+    """把影像第一個像素 (0~9) 當成類別的模型，並記錄推論過的影像數量"""
+
+    def __init__(self):
+        self.images = 0
+
+    def predict_on_batch(self, images):
+        self.images += len(images)
+        classes = np.rint(images[:, 0, 0, 0] * handler.PIXEL_SCALE).astype(int) % 10
+        probabilities = np.full((len(images), 10), 0.01, dtype='float32')
+        probabilities[np.arange(len(images)), classes] = 0.91
+        return probabilities
+
+
+def digit_images(digits):
+    images = np.zeros((len(digits), 28, 28), dtype='uint8')
+    images[:, 0, 0] = digits
+    return images
+
+
+def npy_bytes(images):
+    buffer = io.BytesIO()
+    np.save(buffer, images)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """以 benchmark/fake_minio 模擬 MinIO，function 單獨 build 沒有 benchmark 目錄時略過"""
+
+    monkeypatch.syspath_prepend(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    fake_minio = pytest.importorskip("benchmark.fake_minio")
+    monkeypatch.setenv("bucket_names", OUTPUT_BUCKET)
+    client = fake_minio.FakeMinio(str(tmp_path))
+    client.make_bucket(INPUT_BUCKET)
+    return client
+
+
+def put_input(client, object_name: str, data: bytes):
+    client.put_object(INPUT_BUCKET, object_name, io.BytesIO(data), len(data))
+
+
+@pytest.mark.parametrize("images, shape", [
+    (digit_images([3])[0], (1, 28, 28)),
+    (digit_images([1, 2, 3]), (3, 28, 28)),
+    (digit_images([1, 2])[..., np.newaxis], (2, 28, 28)),
+    (np.zeros((2, 28, 28), dtype='float32'), (2, 28, 28)),
+])
+def test_decode_crops_from_npy_objects(client, images, shape):
+    put_input(client, "crops/a.npy", npy_bytes(images))
+
+    decoded = load_object(client, INPUT_BUCKET, "crops/a.npy")
+
+    assert decoded.shape == shape
+    assert decoded.dtype == images.dtype
+    np.testing.assert_array_equal(decoded.reshape(-1), images.reshape(-1))
+
+
+@pytest.mark.parametrize("images", [
+    np.zeros((28, 27), dtype='uint8'),
+    np.zeros((2, 28, 28, 3), dtype='uint8'),
+    np.zeros(784, dtype='uint8'),
+])
+def test_decode_crops_rejects_other_shapes(images):
+    with pytest.raises(ValueError, match="expected 28x28 images"):
+        decode_crops("a.npy", npy_bytes(images))
+
+
+def test_shard_of_uses_manifest_boundaries(client, monkeypatch):
+    monkeypatch.setattr(handler, "SHARD_OBJECTS", 2)
+    for name in ["b.npy", "c.npy", "e.npy", "f.npy", "g.npy"]:
+        put_input(client, name, npy_bytes(digit_images([0])))
+
+    shards = load_manifest(client, get_job({"input_bucket": INPUT_BUCKET}))["shards"]
+    firsts = [shard["first"] for shard in shards]
+
+    assert [(shard["first"], shard["last"], shard["objects"]) for shard in shards] == [
+        ("b.npy", "c.npy", 2), ("e.npy", "f.npy", 2), ("g.npy", "g.npy", 1)]
+    assert [shard_of(shards, firsts, name) for name in ["b.npy", "c.npy", "e.npy", "f.npy", "g.npy"]] == [0, 0, 1, 1, 2]
+    # manifest 建立後才新增的 object 依照名稱分到前一個 shard，早於第一個或晚於最後一個 object 的略過
+    assert shard_of(shards, firsts, "d.npy") == 0
+    assert shard_of(shards, firsts, "a.npy") is None
+    assert shard_of(shards, firsts, "h.npy") is None
+
+
+def test_shard_scorer_columns_line_up_with_objects():
+    model = DigitModel()
+    scorer = ShardScorer(model, 0, batch_size=4, save_probabilities=True)
+    digits = {"a.npy": [1, 2, 3], "b.npy": [4], "c.npy": [5, 6, 7, 8, 9, 0]}
+    for object_name, object_digits in digits.items():
+        scorer.add(object_name, digit_images(object_digits))
+
+    progress = scorer.finish()
+    with np.load(io.BytesIO(scorer.to_npz())) as data:
+        columns = {name: data[name] for name in data.files}
+
+    assert progress["objects"] == 3
+    assert progress["images"] == model.images == 10
+    assert columns["objects"].tolist() == list(digits)
+    assert all(len(columns[name]) == 10 for name in ["object", "item", "class", "confidence", "probabilities"])
+    rows = [(str(columns["objects"][obj]), int(item), int(digit))
+            for obj, item, digit in zip(columns["object"], columns["item"], columns["class"])]
+    assert rows == [(name, item, digit) for name, object_digits in digits.items() for item, digit in enumerate(object_digits)]
+    np.testing.assert_allclose(columns["confidence"], 0.91)
+    assert columns["probabilities"].shape == (10, 10)
+
+
+def test_run_job_skips_scored_shards_when_resumed(client, monkeypatch):
+    model = DigitModel()
+    monkeypatch.setattr(handler, "SHARD_OBJECTS", 2)
+    monkeypatch.setattr(handler, "get_model", lambda client: (model, LOADED_VERSION))
+    for number in range(5):
+        put_input(client, f"crops/{number:02d}.npy", npy_bytes(digit_images([number] * (number + 1))))
+    job = get_job({"job_id": "resume", "input_bucket": INPUT_BUCKET, "input_prefix": "crops/"})
+
+    summary = run_job(client, job)
+
+    assert (summary["shards"], summary["shards_skipped"], summary["images"]) == (3, 0, 15)
+    assert completed_shards(client, job) == {0, 1, 2}
+
+    # 模擬 shard 1 寫入進度標記前就中斷，重新執行時只推論 shard 1 的 object (02 與 03)
+    client.remove_object(OUTPUT_BUCKET, f"{JOB_PREFIX}/resume/progress/00001.json")
+    model.images = 0
+    downloaded = []
+
+    def recording_load_object(client, bucket_name: str, object_name: str):
+        downloaded.append(object_name)
+        return load_object(client, bucket_name, object_name)
+
+    monkeypatch.setattr(handler, "load_object", recording_load_object)
+
+    summary = run_job(client, job)
+
+    assert (summary["shards"], summary["shards_skipped"], summary["images"]) == (3, 2, 7)
+    assert sorted(downloaded) == ["crops/02.npy", "crops/03.npy"]
+    assert model.images == 7
+    progress = json.loads(client.get_object(OUTPUT_BUCKET, f"{JOB_PREFIX}/resume/progress/00001.json").read())
+    assert (progress["objects"], progress["images"], progress["failed"]) == (2, 7, [])
+    assert (progress["model"], progress["model_version"]) == LOADED_VERSION
+    with np.load(io.BytesIO(client.get_object(OUTPUT_BUCKET, progress["output"]).read())) as data:
+        assert data["objects"].tolist() == ["crops/02.npy", "crops/03.npy"]
+        assert data["class"].tolist() == [2, 2, 2, 3, 3, 3, 3]
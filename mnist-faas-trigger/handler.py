@@ -1,9 +1,121 @@
+import importlib
+import io
+import itertools
 import json
+import math
 import os
 import requests
 import threading
+import time
+import uuid
 
-OPENFAAS_GATEWAY_ENDPOINT = os.environ["openfaas_gateway_endpoint"]
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
+
+METRICS_PORT = int(os.environ.get("metrics_port", "8081"))
+# "sync" calls /function/<stage> in the background, "async" queues /async-function/<stage> on the gateway
+TRIGGER_INVOCATION = os.environ.get("trigger_invocation", "sync")
+TRIGGER_MAX_WORKERS = int(os.environ.get("trigger_max_workers", "8"))
+TRIGGER_MAX_RETRIES = int(os.environ.get("trigger_max_retries", "5"))
+TRIGGER_BACKOFF_SECONDS = float(os.environ.get("trigger_backoff_seconds", "0.5"))
+TRIGGER_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("trigger_connect_timeout_seconds", "5"))
+# A sync invocation returns only after the next stage finishes, so the read timeout follows the stage's exec timeout
+TRIGGER_READ_TIMEOUT_SECONDS = float(os.environ.get("trigger_read_timeout_seconds", "900"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+# Stages invoked once per worker, e.g. "mnist-training-model=4"
+FAN_OUT = os.environ.get("fan_out", "")
+# Hyperparameter sweep applied when its stage is triggered, a JSON object like the "sweep" request field
+SWEEP = os.environ.get("sweep", "")
+SWEEP_BUCKET = os.environ.get("sweep_bucket", "mnist-training-model")
+SWEEP_NEXT_STAGE = os.environ.get("sweep_next_stage", "mnist-model-evaluate")
+SWEEP_PREFIX = "sweeps"
+# Pipeline DAG run by "pipeline" requests, a JSON object like DEFAULT_PIPELINE; "" uses DEFAULT_PIPELINE
+PIPELINE = os.environ.get("pipeline", "")
+PIPELINE_BUCKET = os.environ.get("run_report_bucket", "mnist-run-reports")
+PIPELINE_STATE_FILENAME = "pipeline.json"
+# A running pipeline state refreshed within the lease belongs to a live scheduler, which refreshes it
+# every quarter of the lease while its stages run
+PIPELINE_LEASE_SECONDS = float(os.environ.get("pipeline_lease_seconds", "120"))
+DEFAULT_PIPELINE = {
+    "stages": [
+        {"name": "mnist-preprocess"},
+        {"name": "mnist-training-model", "after": ["mnist-preprocess"]},
+        {"name": "mnist-model-evaluate", "after": ["mnist-training-model"]},
+    ],
+}
+CHECKPOINT_PREFIX = "checkpoints"
+TRAINED_MODEL_KERAS_FILENAME = "trained_model.keras"
+TRAINED_MODEL_SETTINGS_FILENAME = "trained_model.json"
+TRAINED_MODEL_TFLITE_FILENAME = "trained_model.tflite"
+
+METRICS_REGISTRY = CollectorRegistry()
+TRIGGER_SECONDS = Histogram("mnist_pipeline_trigger_seconds", "Duration of each stage trigger through the gateway",
+                            ["stage"], registry=METRICS_REGISTRY)
+TRIGGER_FAILURES = Counter("mnist_pipeline_trigger_failures", "Stage triggers that failed after all retries",
+                           ["stage"], registry=METRICS_REGISTRY)
+METRICS_SERVER_STARTED = False
+METRICS_LOCK = threading.Lock()
+
+# Bounded pool for sync invocations, bursts wait in the executor queue instead of spawning threads
+TRIGGER_EXECUTOR = ThreadPoolExecutor(max_workers=TRIGGER_MAX_WORKERS, thread_name_prefix="trigger")
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+# MinIO client shared by warm invocations and the buckets it has already seen
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+KNOWN_BUCKETS = set()
+KNOWN_BUCKETS_LOCK = threading.Lock()
+
+# Pipeline runs scheduled by this process, a repeated trigger of one of them is a no-op
+ACTIVE_RUNS = set()
+ACTIVE_RUNS_LOCK = threading.Lock()
+
+# Modules imported on first use and their import time in seconds
+STARTUP_PROFILE = {}
+
+
+class LazyModule:
+    """A module imported on first attribute access
+
+    Only sweeps and pipeline runs talk to MinIO, so plain triggers never pay for importing the MinIO client.
+    Import times are recorded in STARTUP_PROFILE.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): module name
+        """
+
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """Import the module once and return it"""
+
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                seconds = time.perf_counter() - started
+                STARTUP_PROFILE[f"import {self.name}"] = seconds
+                print(f"[Startup] import {self.name}: {seconds:.2f}s")
+        return self.module
+
+
+minio = LazyModule("minio")
+minio_commonconfig = LazyModule("minio.commonconfig")
+minio_error = LazyModule("minio.error")
 
 
 def handle(req):
@@ -13,27 +125,750 @@ def handle(req):
         req (str): request body
     """
 
+    start_metrics_server()
+
     data = json.loads(req)
+    if data.get("pipeline"):
+        return start_pipeline(data)
+
     next_stage = data["next_stage"]
-    trigger_next_stage(next_stage)
+    run_id = data.get("run_id")
+
+    spec = get_sweep_spec(next_stage, data.get("sweep"))
+    if spec is not None:
+        # Trials are invoked synchronously in every invocation mode, the coordinator has to see them finish
+        sweep_id = run_id or uuid.uuid4().hex
+        threading.Thread(target=run_sweep, args=(next_stage, sweep_id, spec),
+                         name=f"sweep-{sweep_id}", daemon=True).start()
+        return response(202, f"next stage {next_stage} sweep {sweep_id} started...")
+
+    payloads = stage_payloads(next_stage, run_id)
+
+    if TRIGGER_INVOCATION == "async":
+        # The gateway only queues the request, so wait for it and report a lost hand-off to the caller
+        failed = [payload for payload in payloads if not invoke_stage(next_stage, payload, "async-function")]
+        if failed:
+            return response(502, f"next stage {next_stage} trigger failed for {len(failed)}/{len(payloads)} invocations...")
+        return response(202, f"next stage {next_stage} queued...")
+
+    if len(payloads) > TRIGGER_MAX_WORKERS:
+        return response(400, f"next stage {next_stage} fans out to {len(payloads)} workers, "
+                             f"more than trigger_max_workers {TRIGGER_MAX_WORKERS}...")
+
+    if len(payloads) == 1:
+        trigger_next_stage(next_stage, payloads[0])
+    else:
+        trigger_fan_out(next_stage, payloads)
 
     return response(200, f"next stage {next_stage} triggered...")
 
 
-def trigger_next_stage(stage: str):
-    """Trigger next stage
+def stage_payloads(stage: str, run_id: str = None):
+    """Build the request body of every invocation of a stage
+
+    A stage listed in fan_out is invoked once per worker, each with its worker_index and num_workers.
+
+    Args:
+        stage (str): stage name
+        run_id (str): pipeline run ID passed to the stage
+    """
+
+    num_workers = fan_out_workers(stage)
+    if num_workers <= 1:
+        return [{"run_id": run_id} if run_id else {}]
+
+    # Workers find each other through the run ID, so they must share one
+    payload = {"run_id": run_id or uuid.uuid4().hex}
+    return [dict(payload, worker_index=index, num_workers=num_workers) for index in range(num_workers)]
+
+
+def fan_out_workers(stage: str):
+    """Get the number of workers of a stage from the fan_out setting
+
+    Args:
+        stage (str): stage name
+    """
+
+    for entry in FAN_OUT.split(","):
+        name, _, workers = entry.strip().partition("=")
+        if name == stage and workers:
+            return int(workers)
+    return 1
+
+
+def get_sweep_spec(stage: str, spec: dict = None):
+    """Get the hyperparameter sweep of a stage, from the request or else the sweep setting
+
+    A sweep spec looks like
+    {"stage": "mnist-training-model", "grid": {"batch_size": [128, 300], "learning_rate": [0.001, 0.003]},
+     "min_epochs": 2, "max_epochs": 8, "reduction_factor": 2, "metric": "val_loss", "max_parallel": 4}
+    and may list "trials" (one hyperparameters object each) instead of, or in addition to, "grid".
+
+    Args:
+        stage (str): stage name
+        spec (dict): sweep spec from the request body
+    """
+
+    if spec is None and SWEEP:
+        spec = json.loads(SWEEP)
+        if spec.get("stage", "mnist-training-model") != stage:
+            return None
+    return spec
+
+
+def sweep_trials(spec: dict):
+    """Expand a sweep spec into the hyperparameters of every trial
+
+    Args:
+        spec (dict): sweep spec
+    """
+
+    trials = [dict(trial) for trial in spec.get("trials", [])]
+    grid = spec.get("grid", {})
+    names = sorted(grid)
+    # The product of no lists is one empty combination, which is not a trial of its own
+    if names:
+        for values in itertools.product(*(grid[name] for name in names)):
+            trials.append(dict(zip(names, values)))
+    if grid and not trials:
+        raise ValueError("sweep grid has an empty list of values")
+    return trials or [{}]
+
+
+def sweep_rungs(spec: dict):
+    """Get the epoch budget of every successive halving rung
+
+    The budget starts at min_epochs and grows by reduction_factor until max_epochs.
+
+    Args:
+        spec (dict): sweep spec
+    """
+
+    min_epochs = int(spec.get("min_epochs", 2))
+    max_epochs = int(spec.get("max_epochs", 8))
+    reduction_factor = int(spec.get("reduction_factor", 2))
+    if min_epochs < 1 or max_epochs < min_epochs or reduction_factor < 2:
+        raise ValueError(f"invalid sweep budget: min_epochs {min_epochs}, max_epochs {max_epochs}, "
+                         f"reduction_factor {reduction_factor}")
+
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= reduction_factor
+    rungs.append(max_epochs)
+    return rungs
+
+
+def run_sweep(stage: str, sweep_id: str, spec: dict, next_stage: str = SWEEP_NEXT_STAGE):
+    """Run a hyperparameter sweep with successive halving and promote the best model
+
+    Every rung invokes the surviving trials in parallel with a larger epoch budget, reads their
+    trained_model.json from MinIO and keeps the best 1/reduction_factor of them. Each trial keeps its
+    run ID across rungs, so the stage resumes it from its checkpoint instead of starting over, and a
+    trial that stopped early keeps its score without being invoked again.
+
+    Args:
+        stage (str): stage name
+        sweep_id (str): sweep ID, also the run ID passed to the stage after the sweep
+        spec (dict): sweep spec
+        next_stage (str): stage invoked with the promoted model, None when a pipeline run schedules it
+    """
+
+    started = time.perf_counter()
+    try:
+        rungs = sweep_rungs(spec)
+        trials = [{"name": f"trial-{index:02d}",
+                   "run_id": f"{sweep_id}-trial-{index:02d}",
+                   "hyperparameters": hyperparameters,
+                   "rungs": []}
+                  for index, hyperparameters in enumerate(sweep_trials(spec))]
+    except (TypeError, ValueError) as err:
+        print(f"sweep {sweep_id} occurs error. Error: {err}")
+        return None
+
+    metric = spec.get("metric", "val_loss")
+    reduction_factor = int(spec.get("reduction_factor", 2))
+    max_parallel = max(1, min(int(spec.get("max_parallel", TRIGGER_MAX_WORKERS)), TRIGGER_MAX_WORKERS))
+    client = connect_minio()
+    print(f"sweep {sweep_id}: {len(trials)} trials, epochs per rung {rungs}, {max_parallel} in parallel")
+
+    survivors = trials
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix=f"sweep-{sweep_id}") as executor:
+        for rung, epochs in enumerate(rungs):
+            pending = [trial for trial in survivors if not trial.get("finished")]
+            list(executor.map(lambda trial: run_trial(client, stage, sweep_id, trial, epochs, metric), pending))
+
+            survivors = sorted((trial for trial in survivors if not trial.get("failed")), key=lambda trial: trial["score"])
+            if not survivors:
+                break
+            if rung < len(rungs) - 1:
+                survivors = survivors[:math.ceil(len(survivors) / reduction_factor)]
+            print(f"sweep {sweep_id} rung {rung} ({epochs} epochs): "
+                  f"{', '.join(trial['name'] for trial in survivors)} continue")
+
+    best = survivors[0] if survivors else None
+    summary = {
+        "sweep_id": sweep_id,
+        "stage": stage,
+        "metric": metric,
+        "rungs": rungs,
+        "best": best["name"] if best else None,
+        "seconds": time.perf_counter() - started,
+        "trials": [{key: trial.get(key) for key in ("name", "run_id", "hyperparameters", "score", "failed", "rungs")}
+                   for trial in trials],
+    }
+
+    try:
+        if best is not None:
+            promote_trial(client, sweep_id, best)
+        put_json_to_bucket(client, SWEEP_BUCKET, f"{SWEEP_PREFIX}/{sweep_id}/sweep.json", summary)
+    except minio_error.S3Error as err:
+        print(f"promote sweep {sweep_id} occurs error. Error: {err}")
+        best = None
+    finally:
+        # The stage keeps the checkpoints of sweep trials for the next rung, they are not needed anymore
+        for trial in trials:
+            delete_objects(client, SWEEP_BUCKET, f"{CHECKPOINT_PREFIX}/{trial['run_id']}/")
+
+    if best is None:
+        print(f"sweep {sweep_id} has no successful trial")
+        return summary
+
+    print(f"sweep {sweep_id} promoted {best['name']} ({metric} {best['score']}) in {summary['seconds']:.1f}s")
+    if next_stage:
+        invoke_stage(next_stage, {"run_id": sweep_id}, "function")
+    return summary
+
+
+def run_trial(client, stage: str, sweep_id: str, trial: dict, epochs: int, metric: str):
+    """Train a sweep trial up to an epoch budget and record its score
+
+    Args:
+        client: MinIO Client instance
+        stage (str): stage name
+        sweep_id (str): sweep ID
+        trial (dict): trial state, updated in place
+        epochs (int): epoch budget of the rung
+        metric (str): metric in trained_model.json to rank the trials by
+    """
+
+    payload = {
+        "run_id": trial["run_id"],
+        "sweep_trial": f"{sweep_id}/{trial['name']}",
+        "hyperparameters": dict(trial["hyperparameters"], epochs=epochs),
+    }
+    if not invoke_stage(stage, payload, "function"):
+        trial["failed"] = True
+        return trial
+
+    object_name = f"{SWEEP_PREFIX}/{sweep_id}/{trial['name']}/{TRAINED_MODEL_SETTINGS_FILENAME}"
+    try:
+        settings = get_json_from_bucket(client, SWEEP_BUCKET, object_name)
+        value = settings.get("best_metrics", settings["metrics"])[metric]
+    except (minio_error.S3Error, KeyError) as err:
+        print(f"read sweep trial {trial['name']} result occurs error. Error: {err}")
+        trial["failed"] = True
+        return trial
+
+    # Rank every metric as lower is better
+    trial["score"] = -value if "accuracy" in metric else value
+    trial["finished"] = settings["early_stopped"]
+    trial["rungs"].append({"epochs": epochs, "epochs_trained": settings["epochs_trained"], metric: value})
+    return trial
+
+
+def promote_trial(client, sweep_id: str, trial: dict):
+    """Copy the model of a sweep trial to the object the next stages load
+
+    Args:
+        client: MinIO Client instance
+        sweep_id (str): sweep ID
+        trial (dict): trial state
+    """
+
+    prefix = f"{SWEEP_PREFIX}/{sweep_id}/{trial['name']}/"
+    for object_name in (TRAINED_MODEL_KERAS_FILENAME, TRAINED_MODEL_SETTINGS_FILENAME):
+        client.copy_object(SWEEP_BUCKET, object_name,
+                           minio_commonconfig.CopySource(SWEEP_BUCKET, f"{prefix}{object_name}"))
+
+    # The TFLite export is skipped when quantization costs too much accuracy, never leave a stale one behind
+    try:
+        client.copy_object(SWEEP_BUCKET, TRAINED_MODEL_TFLITE_FILENAME,
+                           minio_commonconfig.CopySource(SWEEP_BUCKET, f"{prefix}{TRAINED_MODEL_TFLITE_FILENAME}"))
+    except minio_error.S3Error as err:
+        if err.code != "NoSuchKey":
+            raise
+        client.remove_object(SWEEP_BUCKET, TRAINED_MODEL_TFLITE_FILENAME)
+
+
+def delete_objects(client, bucket_name: str, prefix: str):
+    """Delete every object under a prefix
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO bucket name
+        prefix (str): object name prefix
+    """
+
+    try:
+        for obj in client.list_objects(bucket_name, prefix=prefix, recursive=True):
+            client.remove_object(bucket_name, obj.object_name)
+    except minio_error.S3Error as err:
+        print(f"delete {prefix} in MinIO bucket {bucket_name} occurs error. Error: {err}")
+
+
+def get_pipeline_spec(spec=None):
+    """Get a pipeline spec from the request, or else the pipeline setting, and validate it
+
+    A pipeline spec looks like
+    {"stages": [{"name": "mnist-preprocess"},
+                {"name": "mnist-training-model", "after": ["mnist-preprocess"]},
+                {"name": "mnist-model-evaluate", "after": ["mnist-training-model"]},
+                {"name": "mnist-batch-scoring", "after": ["mnist-training-model"], "payload": {"input_prefix": "crops/"}}]}
+    A stage runs once every stage in its "after" list has succeeded, so stages without a path between them
+    run at the same time. "function" invokes a function under another stage name, "payload" adds fields to
+    the request body and "sweep" runs the stage as a hyperparameter sweep.
+
+    Args:
+        spec (dict | bool): pipeline spec from the request body, True to use the pipeline setting
+    """
+
+    if not isinstance(spec, dict):
+        spec = json.loads(PIPELINE) if PIPELINE else DEFAULT_PIPELINE
+    pipeline_order(spec)
+    return spec
+
+
+def pipeline_order(spec: dict):
+    """Sort the stages of a pipeline spec so every stage comes after the stages it waits for
+
+    Args:
+        spec (dict): pipeline spec
+    """
+
+    stages = {}
+    for stage in spec["stages"]:
+        if stage["name"] in stages:
+            raise ValueError(f"pipeline stage {stage['name']} is defined twice")
+        stages[stage["name"]] = stage
+
+    order, visiting = [], set()
+
+    def visit(name: str):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"pipeline stages form a cycle through {name}")
+        visiting.add(name)
+        for dependency in stages[name].get("after", []):
+            if dependency not in stages:
+                raise ValueError(f"pipeline stage {name} waits for unknown stage {dependency}")
+            visit(dependency)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def start_pipeline(data: dict):
+    """Start, or resume, a pipeline run in the background
+
+    Triggering a run ID again is idempotent: a run still scheduled by this process is left alone, and a
+    run with state in MinIO only reruns the stages that have not succeeded yet.
+
+    Args:
+        data (dict): request body with "pipeline" and optionally "run_id"
+    """
+
+    try:
+        spec = get_pipeline_spec(data["pipeline"])
+    except (KeyError, TypeError, ValueError) as err:
+        return response(400, f"invalid pipeline spec. Error: {err}")
+
+    run_id = str(data.get("run_id") or uuid.uuid4().hex)
+    with ACTIVE_RUNS_LOCK:
+        if run_id in ACTIVE_RUNS:
+            return response(200, f"pipeline run {run_id} is already running...")
+        ACTIVE_RUNS.add(run_id)
+
+    threading.Thread(target=run_pipeline, args=(run_id, spec), name=f"pipeline-{run_id}", daemon=True).start()
+    return response(202, f"pipeline run {run_id} started...")
+
+
+def run_pipeline(run_id: str, spec: dict):
+    """Run the stages of a pipeline DAG as soon as the stages they wait for have succeeded
+
+    Stages are invoked synchronously so the scheduler sees them finish, and the state of every stage is
+    written to <run ID>/pipeline.json after each change and at least every quarter of PIPELINE_LEASE_SECONDS.
+    A running state refreshed within the lease is held by another scheduler (another replica, or a retried
+    async invocation) and is left alone. A run resumed from an expired or finished state keeps its spec
+    and skips stages that already succeeded; the others run again with the same run ID, so training
+    resumes from its checkpoint. Stages that wait for a failed stage are skipped.
+
+    Args:
+        run_id (str): pipeline run ID passed to every stage
+        spec (dict): pipeline spec
+    """
+
+    client, state, owner = None, None, None
+    try:
+        client = connect_minio()
+        create_buckets(client, [PIPELINE_BUCKET])
+        state = load_pipeline_state(client, run_id, spec)
+        if state["status"] == "succeeded":
+            print(f"pipeline run {run_id} already succeeded")
+            return state
+        if state["status"] == "running" and time.time() - state.get("updated_at", 0) < PIPELINE_LEASE_SECONDS:
+            print(f"pipeline run {run_id} is held by scheduler {state.get('owner')}")
+            return state
+        spec = state["spec"]
+        stages = {stage["name"]: stage for stage in spec["stages"]}
+        started = time.time()
+        for stage_state in state["stages"].values():
+            if stage_state["status"] != "succeeded":
+                stage_state["status"] = "pending"
+                stage_state.pop("error", None)
+        state.pop("error", None)
+        state.update(status="running", owner=uuid.uuid4().hex)
+        save_pipeline_state(client, state)
+        # Best effort against another scheduler taking the same expired state at the same time
+        if load_pipeline_state(client, run_id, spec).get("owner") != state["owner"]:
+            print(f"pipeline run {run_id} was taken by another scheduler")
+            return None
+        owner = state["owner"]
+        print(f"pipeline run {run_id}: {len(stages)} stages, "
+              f"{sum(stage['status'] == 'succeeded' for stage in state['stages'].values())} already succeeded")
+
+        with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix=f"pipeline-{run_id}") as executor:
+            running = {}
+            while True:
+                for name in ready_stages(spec, state):
+                    state["stages"][name].update(status="running", started_at=time.time(),
+                                                 attempts=state["stages"][name].get("attempts", 0) + 1)
+                    running[executor.submit(run_pipeline_stage, stages[name], run_id)] = name
+                if running:
+                    save_pipeline_state(client, state)
+                else:
+                    break
+
+                # Wake up at least every quarter of the lease so the saved state keeps the lease
+                done, _ = wait(running, timeout=PIPELINE_LEASE_SECONDS / 4, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    stage_state = state["stages"][name]
+                    try:
+                        succeeded = future.result()
+                    except Exception as err:
+                        print(f"pipeline run {run_id}: stage {name} occurs error. Error: {err}")
+                        stage_state["error"] = str(err)
+                        succeeded = False
+                    finished = time.time()
+                    stage_state.update(status="succeeded" if succeeded else "failed",
+                                       finished_at=finished, seconds=finished - stage_state["started_at"])
+                    print(f"pipeline run {run_id}: stage {name} {stage_state['status']} "
+                          f"in {stage_state['seconds']:.1f}s")
+
+        for stage_state in state["stages"].values():
+            if stage_state["status"] == "pending":
+                stage_state["status"] = "skipped"
+        succeeded = all(stage["status"] == "succeeded" for stage in state["stages"].values())
+        state.update(status="succeeded" if succeeded else "failed",
+                     seconds=time.time() - started,
+                     critical_path_seconds=critical_path_seconds(spec, state))
+        save_pipeline_state(client, state)
+        print(f"pipeline run {run_id} {state['status']} in {state['seconds']:.1f}s "
+              f"(critical path {state['critical_path_seconds']:.1f}s)")
+        return state
+    except Exception as err:
+        print(f"pipeline run {run_id} occurs error. Error: {err}")
+        # Release the lease right away instead of leaving the state running until the lease expires
+        if owner is not None:
+            state.update(status="failed", error=str(err))
+            try:
+                save_pipeline_state(client, state)
+            except Exception as save_err:
+                print(f"save pipeline run {run_id} state occurs error. Error: {save_err}")
+        return None
+    finally:
+        with ACTIVE_RUNS_LOCK:
+            ACTIVE_RUNS.discard(run_id)
+
+
+def ready_stages(spec: dict, state: dict):
+    """Get the pending stages whose dependencies have all succeeded
+
+    Args:
+        spec (dict): pipeline spec
+        state (dict): pipeline run state
+    """
+
+    return [
+        stage["name"] for stage in spec["stages"]
+        if state["stages"][stage["name"]]["status"] == "pending"
+        and all(state["stages"][dependency]["status"] == "succeeded" for dependency in stage.get("after", []))
+    ]
+
+
+def run_pipeline_stage(stage: dict, run_id: str):
+    """Invoke one stage of a pipeline run and wait for it, returns whether it succeeded
+
+    Args:
+        stage (dict): stage of the pipeline spec
+        run_id (str): pipeline run ID
+    """
+
+    function = stage.get("function", stage["name"])
+    sweep = get_sweep_spec(function, stage.get("sweep"))
+    if sweep is not None:
+        summary = run_sweep(function, run_id, sweep, next_stage=None)
+        return bool(summary and summary["best"])
+
+    # "scheduled" tells the stage not to trigger its own next_stage
+    payloads = [{**stage.get("payload", {}), **payload, "scheduled": True} for payload in stage_payloads(function, run_id)]
+    if len(payloads) == 1:
+        return invoke_stage(function, payloads[0], "function")
+
+    # Workers of a fan-out wait for each other every epoch, so all of them must run at the same time
+    with ThreadPoolExecutor(max_workers=len(payloads), thread_name_prefix=f"{stage['name']}-{run_id}") as executor:
+        return all(executor.map(lambda payload: invoke_stage(function, payload, "function"), payloads))
+
+
+def critical_path_seconds(spec: dict, state: dict):
+    """Get the duration of the longest chain of dependent stages in a pipeline run
+
+    Args:
+        spec (dict): pipeline spec
+        state (dict): pipeline run state
+    """
+
+    stages = {stage["name"]: stage for stage in spec["stages"]}
+    finished = {}
+    for name in pipeline_order(spec):
+        seconds = state["stages"][name].get("seconds") or 0.0
+        finished[name] = seconds + max((finished[dependency] for dependency in stages[name].get("after", [])),
+                                       default=0.0)
+    return max(finished.values(), default=0.0)
+
+
+def load_pipeline_state(client, run_id: str, spec: dict):
+    """Get the state of a pipeline run from MinIO, or a new state when the run has not started yet
+
+    Args:
+        client: MinIO Client instance
+        run_id (str): pipeline run ID
+        spec (dict): pipeline spec of a new run
+    """
+
+    try:
+        return get_json_from_bucket(client, PIPELINE_BUCKET, f"{run_id}/{PIPELINE_STATE_FILENAME}")
+    except minio_error.S3Error as err:
+        if err.code != "NoSuchKey":
+            raise
+
+    return {
+        "run_id": run_id,
+        "spec": spec,
+        "status": "pending",
+        "created_at": time.time(),
+        "stages": {stage["name"]: {"status": "pending"} for stage in spec["stages"]},
+    }
+
+
+def save_pipeline_state(client, state: dict):
+    """Write the state of a pipeline run to MinIO
+
+    Args:
+        client: MinIO Client instance
+        state (dict): pipeline run state
+    """
+
+    state["updated_at"] = time.time()
+    put_json_to_bucket(client, PIPELINE_BUCKET, f"{state['run_id']}/{PIPELINE_STATE_FILENAME}", state)
+
+
+def connect_minio():
+    """Get the MinIO client shared by the process, created on first use
+
+    Warm invocations reuse the keep-alive connections of one urllib3 connection pool.
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+
+            http_client = PoolManager(
+                maxsize=MINIO_MAX_CONNECTIONS,
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = minio.Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
+
+
+def create_buckets(client, bucket_names: list):
+    """Create MinIO buckets that do not exist yet
+
+    Args:
+        client: MinIO Client instance
+        bucket_names (list[str]): MinIO bucket names
+    """
+
+    with KNOWN_BUCKETS_LOCK:
+        for name in bucket_names:
+            # Buckets seen by a warm container are not checked again
+            if name in KNOWN_BUCKETS:
+                continue
+            if not client.bucket_exists(name):
+                client.make_bucket(name)
+                print(f"Bucket {name} created")
+            KNOWN_BUCKETS.add(name)
+
+
+def get_json_from_bucket(client, bucket_name: str, object_name: str):
+    """Get a JSON object from a MinIO bucket
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO bucket name
+        object_name (str): object name
+    """
+
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return json.loads(response.read())
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def put_json_to_bucket(client, bucket_name: str, object_name: str, data: dict):
+    """Upload a JSON object to a MinIO bucket
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO bucket name
+        object_name (str): object name
+        data (dict): data to upload
+    """
+
+    body = json.dumps(data).encode()
+    client.put_object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      data=io.BytesIO(body),
+                      length=len(body),
+                      content_type="application/json")
+
+
+def trigger_next_stage(stage: str, payload: dict):
+    """Trigger next stage in the background
 
     Args:
         stage (str): next stage name
+        payload (dict): request body passed to the next stage
+    """
+
+    return TRIGGER_EXECUTOR.submit(invoke_stage, stage, payload, "function")
+
+
+def trigger_fan_out(stage: str, payloads: list):
+    """Trigger every worker of a fan-out stage in the background at the same time
+
+    Workers of a fan-out wait for each other every epoch, so they get threads of their own instead of
+    queueing behind other triggers in TRIGGER_EXECUTOR.
+
+    Args:
+        stage (str): next stage name
+        payloads (list): request body of every worker
+    """
+
+    executor = ThreadPoolExecutor(max_workers=len(payloads), thread_name_prefix=f"fan-out-{stage}")
+    futures = [executor.submit(invoke_stage, stage, payload, "function") for payload in payloads]
+    # The threads exit once their invocation returns
+    executor.shutdown(wait=False)
+    return futures
+
+
+def invoke_stage(stage: str, payload: dict, route: str = "function"):
+    """Invoke a stage through the gateway, retrying with exponential backoff
+
+    Args:
+        stage (str): stage name
+        payload (dict): request body passed to the stage
+        route (str): gateway route, "function" or "async-function"
     """
 
-    def trigger():
-        _ = requests.get(
-            f"http://{OPENFAAS_GATEWAY_ENDPOINT}/function/{stage}"
+    run_id = payload.get("run_id")
+    started = time.perf_counter()
+    try:
+        resp = get_http_session().post(
+            f"http://{get_gateway_endpoint()}/{route}/{stage}",
+            json=payload,
+            timeout=(TRIGGER_CONNECT_TIMEOUT_SECONDS, TRIGGER_READ_TIMEOUT_SECONDS)
         )
-        print(f"next stage {stage} triggered...")
+        resp.raise_for_status()
+    except requests.RequestException as err:
+        TRIGGER_FAILURES.labels(stage).inc()
+        print(f"trigger stage {stage} (run {run_id}) occurs error. Error: {err}")
+        return False
+    finally:
+        TRIGGER_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+    print(f"next stage {stage} triggered (run {run_id})...")
+    return True
+
+
+def get_gateway_endpoint():
+    """Get the OpenFaaS gateway endpoint from the environment when a stage is invoked"""
+
+    return os.environ["openfaas_gateway_endpoint"]
+
+
+def get_http_session():
+    """Get the pooled HTTP session shared by every trigger in this process"""
+
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            # Only retry when the request never reached the stage: connection errors and gateway
+            # rejections (429, 503). After a read timeout or a 502 the stage may be running, so retrying
+            # would run it twice.
+            retry = Retry(total=TRIGGER_MAX_RETRIES, read=0,
+                          backoff_factor=TRIGGER_BACKOFF_SECONDS,
+                          status_forcelist=(429, 503),
+                          allowed_methods=None,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_maxsize=TRIGGER_MAX_WORKERS, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            HTTP_SESSION = session
+    return HTTP_SESSION
+
+
+def start_metrics_server():
+    """Start the Prometheus metrics HTTP server once per process"""
 
-    threading.Thread(target=trigger).start()
+    global METRICS_SERVER_STARTED
+    with METRICS_LOCK:
+        if METRICS_SERVER_STARTED:
+            return
+        try:
+            start_http_server(METRICS_PORT, registry=METRICS_REGISTRY)
+            METRICS_SERVER_STARTED = True
+        except OSError as err:
+            print(f"start metrics server on port {METRICS_PORT} occurs error. Error: {err}")
 
 
 def response(statusCode: int, message: str):
@@ -1,4 +1,13 @@
-from .handler import handle
+import json
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from . import handler
+from .handler import (critical_path_seconds, get_pipeline_spec, handle, pipeline_order, ready_stages, run_trial,
+                      sweep_rungs, sweep_trials)
 
 # Test your handler here
 
@@ -9,3 +18,275 @@ from .handler import handle
 def test_handle():
     # assert handle("input") == "input"
     pass
+
+
+@pytest.fixture
+def sweep_stubs(monkeypatch):
+    """Replace MinIO and gateway calls of run_sweep, trials are scored by a fake run_trial"""
+
+    calls = {"trials": [], "promoted": None, "invoked": []}
+    monkeypatch.setattr(handler, "connect_minio", lambda: None)
+    monkeypatch.setattr(handler, "put_json_to_bucket", lambda *args: None)
+    monkeypatch.setattr(handler, "delete_objects", lambda *args: None)
+    monkeypatch.setattr(handler, "promote_trial", lambda client, sweep_id, trial: calls.update(promoted=trial["name"]))
+    monkeypatch.setattr(handler, "invoke_stage", lambda stage, payload, route: calls["invoked"].append(stage))
+    return calls
+
+
+def fake_run_trial(calls: dict, losses: dict, finished: set = (), failed: set = ()):
+    """Score a trial by its loss divided by the epoch budget"""
+
+    def run(client, stage, sweep_id, trial, epochs, metric):
+        name = trial["name"]
+        calls["trials"].append((name, epochs))
+        if name in failed:
+            trial["failed"] = True
+            return trial
+        trial["score"] = losses[name] / epochs
+        trial["finished"] = name in finished
+        trial["rungs"].append({"epochs": epochs})
+        return trial
+
+    return run
+
+
+def test_sweep_rungs_grow_by_reduction_factor():
+    assert sweep_rungs({}) == [2, 4, 8]
+    assert sweep_rungs({"min_epochs": 1, "max_epochs": 9, "reduction_factor": 3}) == [1, 3, 9]
+    # The last rung is capped at max_epochs even when the factor overshoots it
+    assert sweep_rungs({"min_epochs": 2, "max_epochs": 5, "reduction_factor": 2}) == [2, 4, 5]
+    assert sweep_rungs({"min_epochs": 4, "max_epochs": 4}) == [4]
+
+
+@pytest.mark.parametrize("spec", [
+    {"min_epochs": 0},
+    {"min_epochs": 4, "max_epochs": 2},
+    {"reduction_factor": 1},
+])
+def test_sweep_rungs_reject_invalid_budget(spec):
+    with pytest.raises(ValueError, match="invalid sweep budget"):
+        sweep_rungs(spec)
+
+
+def test_sweep_trials_expand_grid_after_listed_trials():
+    spec = {"trials": [{"dropout": 0.1}], "grid": {"learning_rate": [0.1, 0.2], "batch_size": [32, 64]}}
+
+    assert sweep_trials(spec) == [
+        {"dropout": 0.1},
+        {"batch_size": 32, "learning_rate": 0.1},
+        {"batch_size": 32, "learning_rate": 0.2},
+        {"batch_size": 64, "learning_rate": 0.1},
+        {"batch_size": 64, "learning_rate": 0.2},
+    ]
+    assert sweep_trials({"trials": [{"dropout": 0.1}, {"dropout": 0.2}]}) == [{"dropout": 0.1}, {"dropout": 0.2}]
+    assert sweep_trials({}) == [{}]
+    with pytest.raises(ValueError, match="empty list"):
+        sweep_trials({"grid": {"learning_rate": []}})
+
+
+def test_run_sweep_keeps_best_fraction_every_rung(sweep_stubs, monkeypatch):
+    losses = {"trial-00": 5.0, "trial-01": 1.0, "trial-02": 4.0, "trial-03": 2.0, "trial-04": 3.0}
+    monkeypatch.setattr(handler, "run_trial", fake_run_trial(sweep_stubs, losses))
+    spec = {"trials": [{"index": index} for index in range(5)], "min_epochs": 1, "max_epochs": 4, "reduction_factor": 2}
+
+    summary = handler.run_sweep("mnist-training-model", "sweep-1", spec, next_stage="mnist-model-evaluate")
+
+    # 5 trials -> ceil(5 / 2) = 3 -> ceil(3 / 2) = 2, and the last rung only ranks them
+    assert summary["rungs"] == [1, 2, 4]
+    assert sorted(sweep_stubs["trials"]) == sorted(
+        [(name, 1) for name in losses]
+        + [("trial-01", 2), ("trial-03", 2), ("trial-04", 2)]
+        + [("trial-01", 4), ("trial-03", 4)])
+    assert summary["best"] == "trial-01"
+    assert sweep_stubs["promoted"] == "trial-01"
+    assert sweep_stubs["invoked"] == ["mnist-model-evaluate"]
+
+
+def test_run_sweep_skips_finished_and_drops_failed_trials(sweep_stubs, monkeypatch):
+    losses = {"trial-00": 1.0, "trial-01": 2.0, "trial-02": 3.0, "trial-03": 4.0}
+    monkeypatch.setattr(handler, "run_trial",
+                        fake_run_trial(sweep_stubs, losses, finished={"trial-01"}, failed={"trial-00"}))
+    spec = {"trials": [{} for _ in range(4)], "min_epochs": 2, "max_epochs": 4, "reduction_factor": 2}
+
+    summary = handler.run_sweep("mnist-training-model", "sweep-2", spec, next_stage=None)
+
+    # trial-00 fails and is dropped, trial-01 stopped early and keeps its first rung score without running again
+    assert [call for call in sweep_stubs["trials"] if call[1] == 4] == [("trial-02", 4)]
+    assert summary["best"] == "trial-02"
+    assert [trial["failed"] for trial in summary["trials"]] == [True, None, None, None]
+    assert sweep_stubs["invoked"] == []
+
+
+def test_run_sweep_without_successful_trial(sweep_stubs, monkeypatch):
+    monkeypatch.setattr(handler, "run_trial", fake_run_trial(sweep_stubs, {}, failed={"trial-00", "trial-01"}))
+    spec = {"trials": [{}, {}], "min_epochs": 1, "max_epochs": 2}
+
+    summary = handler.run_sweep("mnist-training-model", "sweep-3", spec)
+
+    assert summary["best"] is None
+    assert sweep_stubs["promoted"] is None
+    assert sweep_stubs["invoked"] == []
+
+
+def test_run_sweep_rejects_invalid_spec(sweep_stubs):
+    assert handler.run_sweep("mnist-training-model", "sweep-4", {"min_epochs": 0}) is None
+
+
+def test_run_trial_ranks_accuracy_as_lower_is_better(monkeypatch):
+    settings = {"metrics": {"val_accuracy": 0.9}, "best_metrics": {"val_accuracy": 0.95},
+                "early_stopped": True, "epochs_trained": 3}
+    payloads = []
+    monkeypatch.setattr(handler, "invoke_stage", lambda stage, payload, route: payloads.append(payload) or True)
+    monkeypatch.setattr(handler, "get_json_from_bucket", lambda client, bucket_name, object_name: settings)
+    trial = {"name": "trial-00", "run_id": "sweep-5-trial-00", "hyperparameters": {"batch_size": 32}, "rungs": []}
+
+    run_trial(None, "mnist-training-model", "sweep-5", trial, 4, "val_accuracy")
+
+    assert payloads == [{"run_id": "sweep-5-trial-00", "sweep_trial": "sweep-5/trial-00",
+                         "hyperparameters": {"batch_size": 32, "epochs": 4}}]
+    assert trial["score"] == -0.95
+    assert trial["finished"] is True
+    assert trial["rungs"] == [{"epochs": 4, "epochs_trained": 3, "val_accuracy": 0.95}]
+
+
+DIAMOND_PIPELINE = {"stages": [
+    {"name": "evaluate", "after": ["train"]},
+    {"name": "score", "after": ["train", "preprocess"]},
+    {"name": "train", "after": ["preprocess"]},
+    {"name": "preprocess"},
+    {"name": "report", "after": ["evaluate", "score"]},
+]}
+
+
+def pipeline_state(**statuses):
+    return {"stages": {name: {"status": status} for name, status in statuses.items()}}
+
+
+def test_pipeline_order_puts_dependencies_first():
+    order = pipeline_order(DIAMOND_PIPELINE)
+
+    assert sorted(order) == sorted(stage["name"] for stage in DIAMOND_PIPELINE["stages"])
+    for stage in DIAMOND_PIPELINE["stages"]:
+        assert all(order.index(dependency) < order.index(stage["name"]) for dependency in stage.get("after", []))
+
+
+@pytest.mark.parametrize("stages, message", [
+    ([{"name": "a", "after": ["b"]}, {"name": "b", "after": ["a"]}], "cycle"),
+    ([{"name": "a", "after": ["a"]}], "cycle"),
+    ([{"name": "a"}, {"name": "b", "after": ["c"]}, {"name": "c", "after": ["d"]}, {"name": "d", "after": ["b"]}],
+     "cycle"),
+    ([{"name": "a"}, {"name": "a"}], "defined twice"),
+    ([{"name": "a", "after": ["missing"]}], "unknown stage missing"),
+])
+def test_pipeline_order_rejects_invalid_graphs(stages, message):
+    with pytest.raises(ValueError, match=message):
+        pipeline_order({"stages": stages})
+    with pytest.raises(ValueError, match=message):
+        get_pipeline_spec({"stages": stages})
+
+
+def test_ready_stages_wait_for_every_dependency():
+    state = pipeline_state(preprocess="pending", train="pending", evaluate="pending", score="pending",
+                           report="pending")
+    assert ready_stages(DIAMOND_PIPELINE, state) == ["preprocess"]
+
+    state["stages"]["preprocess"]["status"] = "succeeded"
+    assert ready_stages(DIAMOND_PIPELINE, state) == ["train"]
+
+    state["stages"]["train"]["status"] = "running"
+    assert ready_stages(DIAMOND_PIPELINE, state) == []
+
+    state["stages"]["train"]["status"] = "succeeded"
+    assert ready_stages(DIAMOND_PIPELINE, state) == ["evaluate", "score"]
+
+    # A failed dependency never releases its dependents
+    state["stages"]["evaluate"]["status"] = "failed"
+    state["stages"]["score"]["status"] = "succeeded"
+    assert ready_stages(DIAMOND_PIPELINE, state) == []
+
+
+def test_critical_path_seconds_follows_longest_chain():
+    state = pipeline_state(preprocess="succeeded", train="succeeded", evaluate="succeeded", score="succeeded",
+                           report="succeeded")
+    for name, seconds in {"preprocess": 2.0, "train": 10.0, "evaluate": 1.0, "score": 4.0, "report": 0.5}.items():
+        state["stages"][name]["seconds"] = seconds
+
+    # preprocess -> train -> score -> report
+    assert critical_path_seconds(DIAMOND_PIPELINE, state) == pytest.approx(16.5)
+
+    # Stages that never ran count as zero seconds
+    del state["stages"]["score"]["seconds"]
+    state["stages"]["report"]["seconds"] = None
+    assert critical_path_seconds(DIAMOND_PIPELINE, state) == pytest.approx(13.0)
+    assert critical_path_seconds({"stages": []}, {"stages": {}}) == 0.0
+
+
+@pytest.fixture
+def pipeline_store(monkeypatch):
+    """Keep pipeline.json objects in a dict instead of MinIO"""
+
+    store = {}
+
+    def get_json_from_bucket(client, bucket_name, object_name):
+        if (bucket_name, object_name) not in store:
+            raise handler.minio_error.S3Error(response=None, code="NoSuchKey", message="", resource=object_name,
+                                              request_id=None, host_id=None)
+        return json.loads(store[(bucket_name, object_name)])
+
+    def put_json_to_bucket(client, bucket_name, object_name, data):
+        store[(bucket_name, object_name)] = json.dumps(data)
+
+    monkeypatch.setattr(handler, "connect_minio", lambda: None)
+    monkeypatch.setattr(handler, "create_buckets", lambda client, bucket_names: None)
+    monkeypatch.setattr(handler, "get_json_from_bucket", get_json_from_bucket)
+    monkeypatch.setattr(handler, "put_json_to_bucket", put_json_to_bucket)
+    return store
+
+
+def test_run_pipeline_releases_lease_on_unexpected_error(pipeline_store, monkeypatch):
+    def fail(spec, state):
+        raise ValueError("unexpected stage response")
+
+    monkeypatch.setattr(handler, "run_pipeline_stage", lambda stage, run_id: True)
+    monkeypatch.setattr(handler, "critical_path_seconds", fail)
+    spec = {"stages": [{"name": "preprocess"}]}
+
+    assert handler.run_pipeline("run-1", spec) is None
+
+    state = json.loads(pipeline_store[(handler.PIPELINE_BUCKET, f"run-1/{handler.PIPELINE_STATE_FILENAME}")])
+    assert state["status"] == "failed"
+    assert state["error"] == "unexpected stage response"
+    assert "run-1" not in handler.ACTIVE_RUNS
+
+    # The failed state is not held, so the next run resumes it right away and clears the error
+    monkeypatch.setattr(handler, "critical_path_seconds", lambda spec, state: 0.0)
+    state = handler.run_pipeline("run-1", spec)
+    assert state["status"] == "succeeded"
+    assert "error" not in state
+
+
+def test_fan_out_does_not_queue_behind_other_triggers(monkeypatch):
+    # Every thread of the shared trigger executor is busy with another trigger
+    release = threading.Event()
+    busy = ThreadPoolExecutor(max_workers=1)
+    busy.submit(release.wait)
+    monkeypatch.setattr(handler, "TRIGGER_EXECUTOR", busy)
+    monkeypatch.setattr(handler, "FAN_OUT", "mnist-training-model=3")
+
+    # Workers of a fan-out only return once all of them are running
+    barrier = threading.Barrier(3, timeout=5)
+    workers = []
+
+    def invoke_stage(stage, payload, route):
+        barrier.wait()
+        workers.append(payload["worker_index"])
+        return True
+
+    monkeypatch.setattr(handler, "invoke_stage", invoke_stage)
+    try:
+        futures = handler.trigger_fan_out("mnist-training-model", handler.stage_payloads("mnist-training-model", "run-2"))
+        assert all(future.result(timeout=5) for future in futures)
+        assert sorted(workers) == [0, 1, 2]
+    finally:
+        release.set()
+        busy.shutdown()
@@ -1,16 +1,124 @@
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import math
 import os
-import pickle
 import requests
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
 
-import keras
 import numpy as np
 
-from minio import Minio
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
 
 TRAINED_MODEL_KERAS_FILENAME = "trained_model.keras"
-X_TEST4D_NORMALIZE_PKL_FILENAME = "X_Test4D_normalize.pkl"
-Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME = "y_TestOneHot.pkl"
-OPENFAAS_GATEWAY_ENDPOINT = os.environ["openfaas_gateway_endpoint"]
+TRAINED_MODEL_TFLITE_FILENAME = "trained_model.tflite"
+X_TEST4D_NORMALIZE_NPY_FILENAME = "X_Test4D_normalize.npy"
+Y_TEST_ONE_HOT_ENCODING_NPY_FILENAME = "y_TestOneHot.npy"
+METRICS_FILENAME = "metrics.json"
+METRICS_PREFIX = "runs"
+EVALUATE_BATCH_SIZE = int(os.environ.get("evaluate_batch_size", "256"))
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+ARTIFACT_PART_SIZE = 16 * 1024 * 1024
+TRANSFER_MAX_WORKERS = int(os.environ.get("transfer_max_workers", "4"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+# "tflite" 以 TFLite interpreter 執行 training 輸出的量化模型，沒有 TFLite 模型時使用 .keras 模型
+MODEL_BACKEND = os.environ.get("model_backend", "keras")
+STAGE_NAME = "mnist-model-evaluate"
+TRIGGER_TIMEOUT_SECONDS = float(os.environ.get("trigger_timeout_seconds", "10"))
+TRIGGER_MAX_RETRIES = int(os.environ.get("trigger_max_retries", "5"))
+TRIGGER_BACKOFF_SECONDS = float(os.environ.get("trigger_backoff_seconds", "0.5"))
+RUN_REPORT_BUCKET_NAME = os.environ.get("run_report_bucket", "mnist-run-reports")
+METRICS_PORT = int(os.environ.get("metrics_port", "8081"))
+
+# 每個 handler 使用自己的 registry，同一個 process 載入多個 handler 時 metrics 名稱才不會衝突
+METRICS_REGISTRY = CollectorRegistry()
+PHASE_SECONDS = Histogram("mnist_pipeline_phase_seconds", "Duration of each pipeline phase",
+                          ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_BYTES = Counter("mnist_pipeline_phase_bytes", "Bytes moved by each pipeline phase",
+                      ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_PEAK_RSS_BYTES = Gauge("mnist_pipeline_phase_peak_rss_bytes", "Process peak RSS at the end of each pipeline phase",
+                             ["stage", "phase"], registry=METRICS_REGISTRY)
+METRICS_SERVER_STARTED = False
+METRICS_LOCK = threading.Lock()
+
+# 與 gateway 之間共用的 HTTP session
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+# warm container 之間共用的 MinIO client 與已經確認存在的 bucket
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+KNOWN_BUCKETS = set()
+KNOWN_BUCKETS_LOCK = threading.Lock()
+
+# process 啟動後延遲 import 的 module 與耗時 (秒)，寫入 run report
+STARTUP_PROFILE = {}
+COLD_START = True
+COLD_START_LOCK = threading.Lock()
+
+# warm container 之間共用的模型與測試資料，依照 object 的 ETag/version 判斷是否需要重新載入
+WARM_CACHE = {}
+WARM_CACHE_LOCK = threading.Lock()
+
+
+class LazyModule:
+    """第一次存取屬性時才 import 的 module
+
+    keras 的 import 需要 1 秒以上，延後到真的需要時才載入，使用 TFLite 模型時完全不會載入。
+    import 的耗時記錄在 STARTUP_PROFILE。
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): module 名稱
+        """
+
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """import module，之後直接回傳同一個 module"""
+
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                seconds = time.perf_counter() - started
+                STARTUP_PROFILE[f"import {self.name}"] = seconds
+                print(f"[Startup] import {self.name}: {seconds:.2f}s")
+        return self.module
+
+    def preload(self):
+        """在背景 thread 中 import module，與 process 啟動後的其他工作重疊"""
+
+        threading.Thread(target=self.load, name=f"preload-{self.name}", daemon=True).start()
+
+
+keras = LazyModule("keras")
+minio = LazyModule("minio")
+minio_error = LazyModule("minio.error")
+if MODEL_BACKEND == "keras":
+    # 第一個請求下載測試資料與模型時，keras 已經在背景載入
+    keras.preload()
 
 
 def handle(req):
@@ -20,88 +128,692 @@ def handle(req):
         req (str): request body
     """
 
+    start_metrics_server()
+    report = RunReport(get_run_id(req))
+
     minioClient = connect_minio()
 
-    get_file_from_bucket(client=minioClient,
-                         bucket_name="mnist-training-model",
-                         object_name=TRAINED_MODEL_KERAS_FILENAME,
-                         file_path=f"/home/app/{TRAINED_MODEL_KERAS_FILENAME}")
-    model = keras.models.load_model(TRAINED_MODEL_KERAS_FILENAME)
+    # warm container 只需要 HEAD 確認 object 是否改變
+    with report.phase("download_model") as record:
+        model = load_model(minioClient, record)
 
     # 從 Minio 取得測試資料
-    get_file_from_bucket(client=minioClient,
-                         bucket_name="mnist-normalize",
-                         object_name=X_TEST4D_NORMALIZE_PKL_FILENAME,
-                         file_path=f"/home/app/{X_TEST4D_NORMALIZE_PKL_FILENAME}")
-    X_Test4D_normalize = convert_pkl_to_data(
-        f"/home/app/{X_TEST4D_NORMALIZE_PKL_FILENAME}")
-    get_file_from_bucket(client=minioClient,
-                         bucket_name="mnist-onehot-encoding",
-                         object_name=Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME,
-                         file_path=f"/home/app/{Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME}")
-    y_TestOneHot = convert_pkl_to_data(
-        f"/home/app/{Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME}")
-
-    # 評估模型
-    evaluate_model(model, X_Test4D_normalize, y_TestOneHot)
-
-    # 預測模型
-    prediction_model(model, X_Test4D_normalize)
+    with report.phase("download") as record:
+        (X_Test4D_normalize, X_Test4D_header), (y_TestOneHot, y_TestOneHot_header) = cached_load(
+            "test_data",
+            (object_version(minioClient, "mnist-normalize", X_TEST4D_NORMALIZE_NPY_FILENAME),
+             object_version(minioClient, "mnist-onehot-encoding", Y_TEST_ONE_HOT_ENCODING_NPY_FILENAME)),
+            lambda: load_test_data(minioClient, record))
+
+    metrics = run_evaluation(report, model, X_Test4D_normalize, X_Test4D_header, y_TestOneHot, y_TestOneHot_header)
+    metrics["model"] = TRAINED_MODEL_TFLITE_FILENAME if isinstance(model, TFLiteModel) else TRAINED_MODEL_KERAS_FILENAME
+
+    with report.phase("upload_metrics"):
+        bucket_name = get_bucket_names()[0]
+        create_buckets(minioClient, [bucket_name])
+        write_metrics(minioClient, bucket_name, report.run_id, metrics)
 
+    # pipeline scheduler 呼叫時由 scheduler 決定之後的階段，不 requeue
     requeue = os.environ["requeue"]
-    if requeue == 'true':
+    if requeue == 'true' and not is_scheduled(req):
         next_stage = os.environ["next_stage"]
-        trigger(next_stage)
+        # requeue 會開始新的一次 pipeline 執行，所以不沿用 run ID
+        with report.phase("trigger"):
+            trigger(next_stage)
+        write_run_report(minioClient, report)
         return response(200, f"mnist-model-evaluate completed, trigger stage {next_stage}...")
 
+    write_run_report(minioClient, report)
     return response(200, "mnist-model-evaluate completed...")
 
 
-def evaluate_model(model, test_data, test_label):
-    """評估模型
+def run_evaluation(report, model, X_Test4D_normalize, X_Test4D_header: dict, y_TestOneHot, y_TestOneHot_header: dict):
+    """逐 batch 預測一次測試資料，同時計算 loss、準確率、confusion matrix 與各類別的 precision/recall
+
+    compact artifact 也在 ArtifactSequence 中逐 batch 解碼，記憶體中只會多出一個 batch 的解碼結果與預測結果。
 
     Args:
-        model (keras.models.Sequential): 訓練後的模型
-        test_data: 標準化後的測試資料
-        test_label: 標準化後的 onehot encoding 測試資料
+        report (RunReport): 本階段的 run report
+        model (keras.models.Sequential | TFLiteModel): 訓練後的模型
+        X_Test4D_normalize (numpy.ndarray): 測試資料
+        X_Test4D_header (dict): 測試資料 artifact 的 JSON header
+        y_TestOneHot (numpy.ndarray): 測試資料標籤
+        y_TestOneHot_header (dict): 測試資料標籤 artifact 的 JSON header
     """
 
-    scores = model.evaluate(test_data, test_label)
+    num_classes = y_TestOneHot_header.get("num_classes") or y_TestOneHot.shape[-1]
+    evaluator = StreamingEvaluator(num_classes)
+    sequence = ArtifactSequence(X_Test4D_normalize, X_Test4D_header, y_TestOneHot, y_TestOneHot_header,
+                                batch_size=EVALUATE_BATCH_SIZE)
+
+    with report.phase("evaluate") as record:
+        for images, labels in sequence:
+            evaluator.update(model.predict_on_batch(images), labels)
+        record["samples"] = evaluator.samples
+
+    metrics = evaluator.result()
     print()
     print("\t[Info] Accuracy of testing data = {:2.1f}%".format(
-        scores[1]*100.0))
+        metrics["accuracy"]*100.0))
+    print("\t[Info] Precision / recall of each class:")
+    for entry in metrics["per_class"]:
+        print("\t\t{}: {:.3f} / {:.3f} ({} samples)".format(
+            entry["class"], entry["precision"], entry["recall"], entry["support"]))
+    print()
+    return metrics
+
+
+class StreamingEvaluator:
+    """逐 batch 累計 categorical crossentropy 與 confusion matrix
+
+    每個 batch 的預測結果用完就丟，記憶體用量只和類別數量有關，與測試資料的筆數無關。
+    """
+
+    def __init__(self, num_classes: int):
+        """
+        Args:
+            num_classes (int): 類別數量
+        """
+
+        self.num_classes = num_classes
+        self.confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.loss = 0.0
+        self.samples = 0
+
+    def update(self, probabilities, labels):
+        """加入一個 batch 的預測結果
+
+        Args:
+            probabilities (numpy.ndarray): 模型輸出的各類別機率
+            labels (numpy.ndarray): onehot encoding 標籤
+        """
+
+        probabilities = np.asarray(probabilities, dtype='float32')
+        true_classes = np.argmax(labels, axis=1)
+        predicted_classes = np.argmax(probabilities, axis=1)
+
+        # 與 Keras 相同，機率先 clip 再取 log
+        self.loss -= float(np.sum(np.log(np.clip(probabilities[np.arange(len(true_classes)), true_classes],
+                                                 1e-7, 1.0))))
+        self.confusion_matrix += np.bincount(true_classes * self.num_classes + predicted_classes,
+                                             minlength=self.num_classes ** 2).reshape(self.num_classes,
+                                                                                       self.num_classes)
+        self.samples += len(true_classes)
+
+    def result(self):
+        """回傳可以寫成 JSON 的評估指標，confusion matrix 的列為實際類別、欄為預測類別"""
 
+        confusion = self.confusion_matrix
+        true_positives = np.diag(confusion).astype('float64')
+        support = confusion.sum(axis=1)
+        predicted = confusion.sum(axis=0)
+        precision = np.divide(true_positives, predicted, out=np.zeros(self.num_classes), where=predicted > 0)
+        recall = np.divide(true_positives, support, out=np.zeros(self.num_classes), where=support > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall,
+                       out=np.zeros(self.num_classes), where=precision + recall > 0)
 
-def prediction_model(model, test_data):
-    """預測模型
+        return {
+            "samples": self.samples,
+            "loss": self.loss / max(self.samples, 1),
+            "accuracy": float(true_positives.sum()) / max(self.samples, 1),
+            "macro_precision": float(precision.mean()),
+            "macro_recall": float(recall.mean()),
+            "macro_f1": float(f1.mean()),
+            "per_class": [
+                {
+                    "class": index,
+                    "precision": float(precision[index]),
+                    "recall": float(recall[index]),
+                    "f1": float(f1[index]),
+                    "support": int(support[index]),
+                }
+                for index in range(self.num_classes)
+            ],
+            "confusion_matrix": confusion.tolist(),
+        }
+
+
+def write_metrics(client, bucket_name: str, run_id: str, metrics: dict):
+    """將評估指標寫入 MinIO，同時更新最新一次的 metrics.json 與本次 run 的紀錄
 
     Args:
-        model (keras.models.Sequential): 訓練後的模型
-        test_data: 標準化後的測試資料
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        run_id (str): pipeline 執行的 run ID
+        metrics (dict): run_evaluation 回傳的評估指標
     """
 
-    print("\t[Info] Making prediction of X_Test4D_norm")
-    # Making prediction and save result to prediction
-    predict_x = model.predict(test_data)
-    classes_x = np.argmax(predict_x, axis=1)
-    print()
-    print("\t[Info] Show 10 prediction result (From 240):")
-    print("%s\n" % (classes_x[240:250]))
+    metrics = dict(metrics, run_id=run_id, evaluated_at=time.time())
+    put_json_to_bucket(client, bucket_name, f"{METRICS_PREFIX}/{run_id}/{METRICS_FILENAME}", metrics)
+    put_json_to_bucket(client, bucket_name, METRICS_FILENAME, metrics)
+    print(f"write metrics of run {run_id} to {bucket_name}/{METRICS_FILENAME}")
+
+
+def load_model(client, record: dict = None):
+    """依照 MODEL_BACKEND 從 warm cache 或 MinIO 取得模型
+
+    Args:
+        client: MinIO Client instance
+        record (dict): RunReport 的 phase 紀錄，用來記錄下載的位元組數
+    """
+
+    if MODEL_BACKEND == "tflite":
+        try:
+            version = object_version(client, "mnist-training-model", TRAINED_MODEL_TFLITE_FILENAME)
+        except minio_error.S3Error as err:
+            if err.code != "NoSuchKey":
+                raise
+            print(f"{TRAINED_MODEL_TFLITE_FILENAME} not found, use {TRAINED_MODEL_KERAS_FILENAME}")
+        else:
+            return cached_load(
+                "tflite_model",
+                version,
+                lambda: TFLiteModel(get_object_bytes(client, "mnist-training-model",
+                                                     TRAINED_MODEL_TFLITE_FILENAME, record)))
+
+    return cached_load(
+        "model",
+        object_version(client, "mnist-training-model", TRAINED_MODEL_KERAS_FILENAME),
+        lambda: load_model_from_bucket(client=client,
+                                       bucket_name="mnist-training-model",
+                                       object_name=TRAINED_MODEL_KERAS_FILENAME,
+                                       record=record))
+
+
+def load_test_data(client, record: dict = None):
+    """從 MinIO 同時下載測試資料與標籤
+
+    Args:
+        client: MinIO Client instance
+        record (dict): RunReport 的 phase 紀錄，用來記錄下載的位元組數
+    """
+
+    with TransferManager(client) as transfer_manager:
+        test_data = transfer_manager.download_artifacts([
+            ("mnist-normalize", X_TEST4D_NORMALIZE_NPY_FILENAME),
+            ("mnist-onehot-encoding", Y_TEST_ONE_HOT_ENCODING_NPY_FILENAME),
+        ])
+
+    if record is not None:
+        record["bytes"] = sum(data.nbytes for data, _ in test_data)
+    return test_data
+
+
+def object_version(client, bucket_name: str, object_name: str):
+    """以 HEAD 取得 object 的 ETag 與 version
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    stat = client.stat_object(bucket_name, object_name)
+    return stat.etag, stat.version_id
+
+
+def cached_load(cache_key: str, version, loader):
+    """從 warm cache 取得資料，version 改變時才重新載入
+
+    Args:
+        cache_key (str): cache 名稱
+        version: 資料來源 object 的 ETag/version
+        loader (callable): 重新載入資料的函式
+    """
+
+    with WARM_CACHE_LOCK:
+        entry = WARM_CACHE.get(cache_key)
+        if entry is not None and entry["version"] == version:
+            print(f"warm cache {cache_key} hit")
+            return entry["value"]
+
+    value = loader()
+    with WARM_CACHE_LOCK:
+        WARM_CACHE[cache_key] = {"version": version, "value": value}
+    return value
+
+
+class TFLiteModel:
+    """以 TFLite interpreter 執行模型，提供 run_evaluation 用到的 Keras predict_on_batch 介面
+
+    interpreter 不是 thread-safe，warm cache 會將同一個 instance 交給同時執行的請求，
+    所以每個 batch 的 resize、set_tensor、invoke 與 get_tensor 都在 lock 內完成。
+    """
+
+    def __init__(self, model_content: bytes):
+        """
+        Args:
+            model_content (bytes): TFLite 模型
+        """
+
+        self.interpreter = load_tflite_interpreter(model_content)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.allocated_batch_size = 0
+        self.lock = threading.Lock()
+
+    def predict_on_batch(self, images):
+        """預測一個 batch
+
+        Args:
+            images (numpy.ndarray): 標準化後的影像
+        """
+
+        images = np.asarray(images, dtype='float32')
+        with self.lock:
+            if len(images) != self.allocated_batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, list(images.shape))
+                self.interpreter.allocate_tensors()
+                self.allocated_batch_size = len(images)
+            self.interpreter.set_tensor(self.input_index, images)
+            self.interpreter.invoke()
+            # get_tensor 回傳複本，釋放 lock 之後不會被其他請求覆寫
+            return self.interpreter.get_tensor(self.output_index)
+
+
+def load_tflite_interpreter(model_content: bytes):
+    """建立 TFLite interpreter，優先使用 LiteRT，沒有安裝時使用 TensorFlow 內建的 interpreter
+
+    Args:
+        model_content (bytes): TFLite 模型
+    """
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_content=model_content)
+
+
+class ArtifactSequence:
+    """依照 artifact header 逐 batch 還原標準化資料與 onehot encoding 的資料集
+
+    compact artifact 只存 uint8 像素與類別索引，在這裡才轉成 float32 與 onehot，
+    所以記憶體中只會多出一個 batch 的解碼結果。
+    不繼承 keras.utils.PyDataset，使用 TFLite 模型時不需要載入 keras。
+    """
+
+    def __init__(self, images, image_header: dict, labels=None, label_header: dict = None, batch_size: int = 300):
+        """
+        Args:
+            images (numpy.ndarray): 影像 artifact
+            image_header (dict): 影像 artifact 的 JSON header
+            labels (numpy.ndarray): 標籤 artifact，預測時可以不給
+            label_header (dict): 標籤 artifact 的 JSON header
+            batch_size (int): batch 大小
+        """
+
+        self.images = images
+        self.image_header = image_header
+        self.labels = labels
+        self.label_header = label_header or {}
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return math.ceil(len(self.images) / self.batch_size)
+
+    def __getitem__(self, index):
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        x = decode_images(self.images[batch], self.image_header)
+        if self.labels is None:
+            return x
+        return x, decode_labels(self.labels[batch], self.label_header)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def decode_images(data, header: dict):
+    """將影像 artifact 還原成標準化後的 float32 資料
+
+    Args:
+        data (numpy.ndarray): 影像資料
+        header (dict): 影像 artifact 的 JSON header
+    """
+
+    scale = header.get("scale")
+    if scale is None:
+        return np.asarray(data)
+
+    images = data.astype('float32')
+    images /= scale
+    return images
+
+
+def decode_labels(data, header: dict):
+    """將標籤 artifact 還原成 onehot encoding
+
+    Args:
+        data (numpy.ndarray): 標籤資料
+        header (dict): 標籤 artifact 的 JSON header
+    """
+
+    num_classes = header.get("num_classes")
+    if num_classes is None:
+        return np.asarray(data)
+
+    return np.eye(num_classes, dtype='float32')[data]
+
+
+class TransferManager:
+    """所有階段共用的 MinIO 傳輸管理
+
+    以有上限的 thread pool 同時進行多個 object 的傳輸，大型 object 再切成多個 part 平行傳輸，
+    並記錄每個 object 的傳輸速度。
+    """
+
+    def __init__(self, client, max_workers: int = TRANSFER_MAX_WORKERS, part_size: int = ARTIFACT_PART_SIZE):
+        """
+        Args:
+            client: MinIO Client instance
+            max_workers (int): 同時進行的傳輸數量上限
+            part_size (int): 大型 object 切分的 part 大小
+        """
+
+        self.client = client
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.throughputs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+    def report(self, bucket_name: str, object_name: str, size: int, elapsed: float):
+        """記錄並印出單一 object 的傳輸速度
+
+        Args:
+            bucket_name (str): MinIO Bucket 名稱
+            object_name (str): object 名稱
+            size (int): 傳輸的位元組數
+            elapsed (float): 傳輸花費的秒數
+        """
+
+        throughput = size / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+        with self.lock:
+            self.throughputs[f"{bucket_name}/{object_name}"] = throughput
+        print(f"[Transfer] {bucket_name}/{object_name}: {size / (1024 * 1024):.1f} MiB "
+              f"in {elapsed:.2f}s ({throughput:.1f} MiB/s)")
+
+    def download_artifacts(self, artifacts: list):
+        """同時下載多個 artifact
+
+        先平行取得所有 JSON header 並預先配置 numpy.ndarray，再將每個 object 切成多個 ranged GET，
+        全部的 part 共用同一個 thread pool，所以總傳輸時間大約等於最大的單一 object。
+        header 有 shard index 時，下載後平行驗證每個 shard 的校驗碼。
+
+        Args:
+            artifacts (list): (bucket_name, filename) 的 list
+        """
+
+        headers = list(self.executor.map(
+            lambda artifact: get_json_from_bucket(self.client, artifact[0], artifact_header_filename(artifact[1])),
+            artifacts))
+
+        transfers = []
+        futures = []
+        for (bucket_name, filename), header in zip(artifacts, headers):
+            data_offset = header["data_offset"]
+
+            transfer = {
+                "bucket_name": bucket_name,
+                "filename": filename,
+                "header": header,
+                "shards": header.get("shards"),
+                "data_offset": data_offset,
+                "data": np.empty(header["shape"], dtype=np.dtype(header["dtype"])),
+                "preamble": bytearray(header["data_offset"]),
+                "started": time.perf_counter(),
+                "finished": None,
+            }
+            transfers.append(transfer)
+
+            parts = [(0, memoryview(transfer["preamble"]))]
+            view = memoryview(transfer["data"]).cast('B')
+            for start in range(0, view.nbytes, self.part_size):
+                parts.append((data_offset + start, view[start:start + self.part_size]))
+
+            for offset, buffer in parts:
+                future = self.executor.submit(self._get_range, bucket_name, filename, offset, buffer)
+                future.add_done_callback(lambda _, transfer=transfer: self._mark_finished(transfer))
+                futures.append(future)
+
+        for future in futures:
+            future.result()
+
+        results = []
+        for transfer in transfers:
+            header = transfer["header"]
+            filename = transfer["filename"]
+            check_npy_preamble(bytes(transfer["preamble"]), header, filename)
+
+            if transfer["shards"] is not None:
+                self.verify_shards(transfer)
+            else:
+                digest = hashlib.sha256(transfer["preamble"])
+                digest.update(memoryview(transfer["data"]).cast('B'))
+                checksum = digest.hexdigest()
+                if checksum != header["sha256"]:
+                    raise ValueError(
+                        f"artifact {filename} checksum mismatch, expected {header['sha256']} but got {checksum}"
+                    )
+
+            self.report(transfer["bucket_name"], filename, transfer["data"].nbytes,
+                        transfer["finished"] - transfer["started"])
+            results.append((transfer["data"], header))
+
+        return results
+
+    def verify_shards(self, transfer: dict):
+        """平行驗證下載的每個 shard 的校驗碼
+
+        Args:
+            transfer (dict): download_artifacts 中單一 artifact 的傳輸狀態
+        """
+
+        view = memoryview(transfer["data"]).cast('B')
+
+        def verify(shard: dict):
+            begin = shard["offset"] - transfer["data_offset"]
+            checksum = hashlib.sha256(view[begin:begin + shard["length"]]).hexdigest()
+            if checksum != shard["sha256"]:
+                raise ValueError(
+                    f"artifact {transfer['filename']} shard [{shard['start']}, {shard['stop']}) checksum mismatch, "
+                    f"expected {shard['sha256']} but got {checksum}"
+                )
+
+        list(self.executor.map(verify, transfer["shards"]))
+
+    def _get_range(self, bucket_name: str, object_name: str, offset: int, buffer):
+        if not buffer.nbytes:
+            return
+
+        response = self.client.get_object(bucket_name, object_name, offset=offset, length=buffer.nbytes)
+        try:
+            read_exactly(response, buffer)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _mark_finished(self, transfer: dict):
+        with self.lock:
+            transfer["finished"] = time.perf_counter()
+
+
+class RunReport:
+    """記錄單次 pipeline 執行中本階段各 phase 的耗時、peak RSS 與傳輸量
+
+    每個 phase 同時更新 Prometheus metrics，執行結束後整份報告以 JSON 寫入 MinIO。
+    """
+
+    def __init__(self, run_id: str):
+        """
+        Args:
+            run_id (str): pipeline 執行的 run ID
+        """
+
+        self.run_id = run_id
+        self.started_at = time.time()
+        self.phases = []
+        self.cold_start = is_cold_start()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """量測一個 phase，可以在 with 區塊內設定 record["bytes"] 記錄傳輸量
+
+        Args:
+            name (str): phase 名稱
+        """
+
+        record = {"phase": name, "bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            self.record(record)
+
+    def record(self, record: dict):
+        """加入一筆 phase 紀錄並更新 Prometheus metrics
+
+        Args:
+            record (dict): 包含 phase、seconds、bytes、peak_rss_bytes 的紀錄
+        """
+
+        self.phases.append(record)
+        PHASE_SECONDS.labels(STAGE_NAME, record["phase"]).observe(record["seconds"])
+        PHASE_BYTES.labels(STAGE_NAME, record["phase"]).inc(record["bytes"])
+        PHASE_PEAK_RSS_BYTES.labels(STAGE_NAME, record["phase"]).set(record["peak_rss_bytes"])
+        print(f"[Phase] {record['phase']}: {record['seconds']:.2f}s, {record['bytes']} bytes, "
+              f"peak RSS {record['peak_rss_bytes'] / (1024 * 1024):.1f} MiB")
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "stage": STAGE_NAME,
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "cold_start": self.cold_start,
+            "startup": dict(STARTUP_PROFILE),
+            "phases": self.phases,
+        }
+
+
+def is_cold_start():
+    """是否為 process 啟動後的第一個請求，只有第一次呼叫回傳 True"""
+
+    global COLD_START
+    with COLD_START_LOCK:
+        cold_start, COLD_START = COLD_START, False
+    return cold_start
+
+
+def peak_rss_bytes():
+    """取得目前 process 的 peak RSS (bytes)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_metrics_server():
+    """啟動 Prometheus metrics HTTP server，每個 process 只會啟動一次"""
+
+    global METRICS_SERVER_STARTED
+    with METRICS_LOCK:
+        if METRICS_SERVER_STARTED:
+            return
+        try:
+            start_http_server(METRICS_PORT, registry=METRICS_REGISTRY)
+            METRICS_SERVER_STARTED = True
+        except OSError as err:
+            print(f"start metrics server on port {METRICS_PORT} occurs error. Error: {err}")
+
+
+def get_run_id(req):
+    """從 request body 取得 run ID，沒有的話就產生新的 run ID
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and data.get("run_id"):
+        return str(data["run_id"])
+    return uuid.uuid4().hex
+
+
+def is_scheduled(req):
+    """是否由 mnist-faas-trigger 的 pipeline scheduler 呼叫，是的話由 scheduler 觸發之後的階段
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    return isinstance(data, dict) and data.get("scheduled") is True
+
+
+def write_run_report(client, report: RunReport):
+    """將本階段的 run report 以 JSON 寫入 MinIO
+
+    Args:
+        client: MinIO Client instance
+        report (RunReport): 本階段的 run report
+    """
+
+    try:
+        create_buckets(client, [RUN_REPORT_BUCKET_NAME])
+        put_json_to_bucket(client, RUN_REPORT_BUCKET_NAME, f"{report.run_id}/{STAGE_NAME}.json", report.to_dict())
+    except minio_error.S3Error as err:
+        print(f"write run report {report.run_id} occurs error. Error: {err}")
 
 
 def connect_minio():
-    """連接 Minio Server"""
+    """取得 process 共用的 MinIO client，第一次呼叫時才建立
+
+    warm container 的請求之間重複使用同一個 urllib3 connection pool 的 keep-alive 連線，
+    pool 的連線數量不少於平行傳輸的 thread 數量，連線才不會用完就被丟棄。
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+
+            http_client = PoolManager(
+                maxsize=max(MINIO_MAX_CONNECTIONS, TRANSFER_MAX_WORKERS),
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = minio.Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
 
-    MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
-    MINIO_ACCESS_KEY = os.environ["minio_access_key"]
-    MINIO_SECRET_KEY = os.environ["minio_secret_key"]
 
-    return Minio(
-        MINIO_API_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=False
-    )
+def get_gateway_endpoint():
+    """從環境變數中取得 OpenFaaS gateway endpoint，觸發下一個階段時才讀取"""
+
+    return os.environ["openfaas_gateway_endpoint"]
 
 
 def get_bucket_names():
@@ -119,53 +831,203 @@ def create_buckets(client, bucket_names: list):
         bucket_names (list[str]): 要建立的 Minio Bucket 名稱
     """
 
-    for name in bucket_names:
-        if client.bucket_exists(name):
-            print(f"Bucket {name} already exists")
-        else:
-            client.make_bucket(name)
-            print(f"Bucket {name} created")
+    with KNOWN_BUCKETS_LOCK:
+        for name in bucket_names:
+            # warm container 已經確認過的 bucket 不需要再詢問 MinIO
+            if name in KNOWN_BUCKETS:
+                continue
+            if client.bucket_exists(name):
+                print(f"Bucket {name} already exists")
+            else:
+                client.make_bucket(name)
+                print(f"Bucket {name} created")
+            KNOWN_BUCKETS.add(name)
+
 
+def artifact_header_filename(filename: str):
+    """取得 artifact 對應的 JSON header 檔名
+
+    Args:
+        filename (str): artifact 檔名 (.npy)
+    """
+
+    return f"{os.path.splitext(filename)[0]}.json"
 
-def get_file_from_bucket(client, bucket_name: str, object_name: str, file_path: str):
-    """取得 MinIO Bucket 內的資料
+
+def get_json_from_bucket(client, bucket_name: str, object_name: str):
+    """取得 MinIO Bucket 內的 JSON object
 
     Args:
         client: MinIO Client instance
         bucket_name (str): MinIO Bucket 名稱
         object_name (str): 要取得的 object 名稱
-        file_path (str): 下載後的檔案路徑
     """
 
-    client.fget_object(bucket_name, object_name, file_path)
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return json.loads(response.read())
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def put_json_to_bucket(client, bucket_name: str, object_name: str, data: dict):
+    """上傳 JSON object 到 MinIO Bucket 內
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要上傳的 object 名稱
+        data (dict): 要上傳的資料
+    """
+
+    body = json.dumps(data).encode()
+    client.put_object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      data=io.BytesIO(body),
+                      length=len(body),
+                      content_type="application/json")
+
+
+def read_exactly(stream, buffer):
+    """從 stream 分段讀滿整個 buffer
+
+    Args:
+        stream: 支援 readinto 的 stream，例如 get_object 的 response
+        buffer: 預先配置好的 buffer (bytearray、memoryview 或 C-contiguous 的 numpy.ndarray)
+    """
+
+    view = memoryview(buffer).cast('B')
+    position = 0
+    while position < view.nbytes:
+        size = stream.readinto(view[position:position + ARTIFACT_CHUNK_SIZE])
+        if not size:
+            raise ValueError(f"stream ended after {position} of {view.nbytes} bytes")
+        position += size
+
+
+def check_npy_preamble(preamble: bytes, header: dict, filename: str):
+    """確認 .npy preamble 與 JSON header 描述的 dtype、shape 一致
+
+    Args:
+        preamble (bytes): .npy 檔案開頭的 magic 與 header
+        header (dict): artifact 的 JSON header
+        filename (str): artifact 檔名 (.npy)
+    """
+
+    stream = io.BytesIO(preamble)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+
+    if fortran_order or dtype.str != header["dtype"] or list(shape) != header["shape"]:
+        raise ValueError(
+            f"artifact {filename} does not match its header, "
+            f"expected {header['dtype']}{header['shape']} but got {dtype.str}{list(shape)}"
+        )
+
+
+def get_object_bytes(client, bucket_name: str, object_name: str, record: dict = None):
+    """下載整個 object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+        record (dict): RunReport 的 phase 紀錄，用來記錄下載的位元組數
+    """
+
+    response = client.get_object(bucket_name, object_name)
+    try:
+        body = response.read()
+    finally:
+        response.close()
+        response.release_conn()
 
+    if record is not None:
+        record["bytes"] = len(body)
+    return body
 
-def convert_pkl_to_data(filename: str):
-    """將 pkl 檔案轉換回原始資料
+
+def load_model_from_bucket(client, bucket_name: str, object_name: str, record: dict = None):
+    """從 MinIO Bucket 串流下載並載入模型
+
+    Keras 只能從檔案載入模型，所以模型先寫到暫存目錄，不佔用 /home/app。
 
     Args:
-        filename (str): pkl 檔案名稱
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 模型的 object 名稱
+        record (dict): RunReport 的 phase 紀錄，用來記錄下載的位元組數
     """
 
-    with open(filename, 'rb') as f:
-        data = pickle.load(f)
-    return data
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, object_name)
+        response = client.get_object(bucket_name, object_name)
+        try:
+            with open(file_path, 'wb') as f:
+                for chunk in response.stream(ARTIFACT_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
 
+        if record is not None:
+            record["bytes"] = os.path.getsize(file_path)
+        return keras.models.load_model(file_path)
 
-def trigger(next_stage: str):
+
+def trigger(next_stage: str, run_id: str = None):
     """觸發下一個階段
 
     Args:
-        next_stage (str): 下一個階段名稱
+        next_stage (str): 下一個階段的名稱
+        run_id (str): pipeline 執行的 run ID
     """
 
     req_body = {
         "next_stage": next_stage
     }
-    _ = requests.post(
-        f"http://{OPENFAAS_GATEWAY_ENDPOINT}/function/mnist-faas-trigger",
-        json=req_body
-    )
+    if run_id is not None:
+        req_body["run_id"] = run_id
+
+    try:
+        resp = get_http_session().post(
+            f"http://{get_gateway_endpoint()}/function/mnist-faas-trigger",
+            json=req_body,
+            timeout=TRIGGER_TIMEOUT_SECONDS
+        )
+        resp.raise_for_status()
+    except requests.RequestException as err:
+        print(f"trigger {next_stage} occurs error. Error: {err}")
+        return False
+    return True
+
+
+def get_http_session():
+    """取得共用的 HTTP session，重複使用與 gateway 之間的連線
+
+    連線失敗或 gateway 回應 429、503 時，以 exponential backoff 重試
+    """
+
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            # 只在請求沒有送到下一個階段時重試：連線錯誤、429 與 503
+            # read timeout 與 502 時下一個階段可能已經在執行，重試會讓它執行兩次
+            retry = Retry(total=TRIGGER_MAX_RETRIES, read=0,
+                          backoff_factor=TRIGGER_BACKOFF_SECONDS,
+                          status_forcelist=(429, 503),
+                          allowed_methods=None,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            HTTP_SESSION = session
+    return HTTP_SESSION
 
 
 def response(statusCode: int, message: str):
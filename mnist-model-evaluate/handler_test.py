@@ -1,4 +1,10 @@
-from .handler import handle
+import json
+import math
+
+import numpy as np
+import pytest
+
+from .handler import METRICS_FILENAME, METRICS_PREFIX, StreamingEvaluator, handle, write_metrics
 
 # Test your handler here
 
@@ -9,3 +15,98 @@ from .handler import handle
 def test_handle():
     # assert handle("input") == "input"
     pass
+
+
+def onehot(classes, num_classes: int):
+    return np.eye(num_classes, dtype='float32')[classes]
+
+
+def probabilities_for(classes, num_classes: int):
+    """預測類別的機率為 0.7，其餘類別平分剩下的 0.3"""
+
+    probabilities = np.full((len(classes), num_classes), 0.3 / (num_classes - 1), dtype='float32')
+    probabilities[np.arange(len(classes)), classes] = 0.7
+    return probabilities
+
+
+class RecordingClient:
+    """只記錄 put_object 內容的 MinIO client"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        body = data.read()
+        assert len(body) == length
+        self.objects[(bucket_name, object_name)] = json.loads(body)
+
+
+def test_streaming_evaluator_matches_hand_computed_metrics():
+    # 實際類別 0 0 1 2 2 2，預測類別 0 1 1 2 2 0，分成兩個 batch 加入
+    true_classes = np.array([0, 0, 1, 2, 2, 2])
+    predicted_classes = np.array([0, 1, 1, 2, 2, 0])
+    evaluator = StreamingEvaluator(3)
+    for batch in (slice(0, 4), slice(4, 6)):
+        evaluator.update(probabilities_for(predicted_classes[batch], 3), onehot(true_classes[batch], 3))
+
+    metrics = evaluator.result()
+
+    assert metrics["samples"] == 6
+    assert metrics["confusion_matrix"] == [[1, 1, 0],
+                                           [0, 1, 0],
+                                           [1, 0, 2]]
+    assert metrics["accuracy"] == pytest.approx(4 / 6)
+    # 4 筆預測正確 (實際類別的機率 0.7)，2 筆預測錯誤 (實際類別的機率 0.15)
+    assert metrics["loss"] == pytest.approx(-(4 * math.log(0.7) + 2 * math.log(0.15)) / 6, rel=1e-5)
+
+    per_class = metrics["per_class"]
+    assert [entry["precision"] for entry in per_class] == pytest.approx([1 / 2, 1 / 2, 2 / 2])
+    assert [entry["recall"] for entry in per_class] == pytest.approx([1 / 2, 1 / 1, 2 / 3])
+    assert [entry["f1"] for entry in per_class] == pytest.approx([1 / 2, 2 / 3, 4 / 5])
+    assert [entry["support"] for entry in per_class] == [2, 1, 3]
+    assert metrics["macro_precision"] == pytest.approx(2 / 3)
+    assert metrics["macro_recall"] == pytest.approx((1 / 2 + 1 + 2 / 3) / 3)
+    assert metrics["macro_f1"] == pytest.approx((1 / 2 + 2 / 3 + 4 / 5) / 3)
+
+
+def test_streaming_evaluator_scores_unseen_class_as_zero():
+    # 類別 3 從未出現也從未被預測，precision/recall/f1 為 0 而不是 NaN
+    evaluator = StreamingEvaluator(4)
+    evaluator.update(probabilities_for(np.array([0, 1, 2]), 4), onehot(np.array([0, 1, 1]), 4))
+
+    per_class = evaluator.result()["per_class"]
+
+    assert per_class[3] == {"class": 3, "precision": 0.0, "recall": 0.0, "f1": 0.0, "support": 0}
+    assert per_class[2]["precision"] == 0.0
+    assert per_class[1]["recall"] == pytest.approx(1 / 2)
+
+
+def test_streaming_evaluator_clips_zero_probability():
+    evaluator = StreamingEvaluator(2)
+    evaluator.update(np.array([[1.0, 0.0]]), onehot(np.array([1]), 2))
+
+    assert evaluator.result()["loss"] == pytest.approx(-math.log(1e-7), rel=1e-5)
+
+
+def test_streaming_evaluator_without_samples():
+    metrics = StreamingEvaluator(10).result()
+
+    assert metrics["samples"] == 0
+    assert metrics["loss"] == 0.0
+    assert metrics["accuracy"] == 0.0
+    assert len(metrics["per_class"]) == 10
+
+
+def test_write_metrics_updates_run_and_latest_objects():
+    client = RecordingClient()
+    metrics = {"loss": 0.25, "accuracy": 0.9}
+
+    write_metrics(client, "mnist", "run-1", metrics)
+
+    run_metrics = client.objects[("mnist", f"{METRICS_PREFIX}/run-1/{METRICS_FILENAME}")]
+    latest_metrics = client.objects[("mnist", METRICS_FILENAME)]
+    assert run_metrics == latest_metrics
+    assert run_metrics["run_id"] == "run-1"
+    assert run_metrics["loss"] == 0.25
+    assert "evaluated_at" in run_metrics
+    assert "run_id" not in metrics
@@ -0,0 +1,445 @@
+import importlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
+
+TRAINED_MODEL_KERAS_FILENAME = "trained_model.keras"
+TRAINED_MODEL_TFLITE_FILENAME = "trained_model.tflite"
+TRAINED_MODEL_BUCKET_NAME = "mnist-training-model"
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+PIXEL_SCALE = 255
+MAX_BATCH_SIZE = int(os.environ.get("max_batch_size", "64"))
+MAX_BATCH_WAIT_MS = float(os.environ.get("max_batch_wait_ms", "5"))
+MODEL_REFRESH_SECONDS = float(os.environ.get("model_refresh_seconds", "30"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+# "tflite" 以 TFLite interpreter 執行 training 輸出的量化模型，沒有 TFLite 模型時使用 .keras 模型
+MODEL_BACKEND = os.environ.get("model_backend", "keras")
+
+# warm container 之間共用的 MinIO client
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+
+# process 啟動後延遲 import 的 module 與耗時 (秒)
+STARTUP_PROFILE = {}
+
+# warm container 之間共用的模型與 micro-batcher
+MODEL_CACHE = {}
+MODEL_CACHE_LOCK = threading.Lock()
+BATCHER = None
+BATCHER_LOCK = threading.Lock()
+
+
+class LazyModule:
+    """第一次存取屬性時才 import 的 module
+
+    keras 的 import 需要 1 秒以上，延後到真的需要時才載入，使用 TFLite 模型時完全不會載入。
+    import 的耗時記錄在 STARTUP_PROFILE。
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): module 名稱
+        """
+
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """import module，之後直接回傳同一個 module"""
+
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                seconds = time.perf_counter() - started
+                STARTUP_PROFILE[f"import {self.name}"] = seconds
+                print(f"[Startup] import {self.name}: {seconds:.2f}s")
+        return self.module
+
+    def preload(self):
+        """在背景 thread 中 import module，與 process 啟動後的其他工作重疊"""
+
+        threading.Thread(target=self.load, name=f"preload-{self.name}", daemon=True).start()
+
+
+keras = LazyModule("keras")
+minio = LazyModule("minio")
+minio_error = LazyModule("minio.error")
+if MODEL_BACKEND == "keras":
+    # 第一個請求到達之前，keras 已經在背景載入
+    keras.preload()
+
+
+def handle(req):
+    """handle a request to the function
+
+    request body 可以是單張 {"image": [[...]]} 或多張 {"images": [[[...]]]} 的 28x28 影像，
+    像素值為 0~255，若已經標準化到 0~1 可以加上 "normalized": true。
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req)
+        images = parse_images(data)
+    except (ValueError, KeyError, TypeError) as err:
+        return response(400, f"invalid request body. Error: {err}")
+
+    # 同時進來的請求會被合併成同一個 micro-batch 推論
+    try:
+        probabilities = get_batcher().submit(images).result()
+    except Exception as err:
+        return response(503, f"mnist-model-inference model is unavailable. Error: {err}")
+    classes = np.argmax(probabilities, axis=1)
+
+    predictions = [
+        {"class": int(label), "probabilities": [round(float(p), 6) for p in probability]}
+        for label, probability in zip(classes, probabilities)
+    ]
+    return response(200, f"{len(predictions)} image(s) predicted", predictions)
+
+
+def parse_images(data: dict):
+    """將 request body 轉換成標準化後的 (N, 28, 28, 1) float32 影像
+
+    Args:
+        data (dict): request body
+    """
+
+    if "images" in data:
+        images = np.asarray(data["images"], dtype='float32')
+    else:
+        images = np.asarray(data["image"], dtype='float32')[np.newaxis]
+
+    if images.ndim == 2 and images.shape[1] == 28 * 28:
+        images = images.reshape(-1, 28, 28)
+    if images.ndim == 3:
+        images = images[..., np.newaxis]
+    if images.ndim != 4 or images.shape[1:] != (28, 28, 1) or not len(images):
+        raise ValueError(f"expected 28x28 images, got shape {images.shape}")
+
+    if not data.get("normalized", False):
+        images /= PIXEL_SCALE
+    return images
+
+
+class MicroBatcher:
+    """將同時進來的推論請求合併成 micro-batch
+
+    背景 thread 取得第一個請求後，最多再等待 max_wait_ms 或湊滿 max_batch_size 張影像，
+    再一次執行模型推論並將結果分配回各個請求，讓吞吐量維持在高檔的同時 latency 也有上限。
+    超過 max_batch_size 張影像的請求先切成多段，所以每個 micro-batch 都不會超過 max_batch_size。
+    """
+
+    def __init__(self, model_loader, max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_BATCH_WAIT_MS):
+        """
+        Args:
+            model_loader (callable): 取得目前模型的函式
+            max_batch_size (int): 每個 micro-batch 的最大影像數量
+            max_wait_ms (float): 湊 batch 時最多等待的毫秒數
+        """
+
+        self.model_loader = model_loader
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, images):
+        """送出推論請求，回傳所有影像預測結果的 Future
+
+        Args:
+            images (numpy.ndarray): 標準化後的 (N, 28, 28, 1) 影像
+        """
+
+        futures = []
+        for start in range(0, len(images), self.max_batch_size):
+            future = Future()
+            self.requests.put((images[start:start + self.max_batch_size], future))
+            futures.append(future)
+        if len(futures) == 1:
+            return futures[0]
+
+        # 依序接回每一段的結果，任何一段失敗時整個請求都失敗
+        result = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                result.set_exception(errors[0])
+            else:
+                result.set_result(np.concatenate([future.result() for future in futures]))
+
+        for future in futures:
+            future.add_done_callback(done)
+        return result
+
+    def run(self):
+        pending = None
+        while True:
+            batch = [pending or self.requests.get()]
+            pending = None
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                # 放不下的請求留到下一個 micro-batch
+                if size + len(request[0]) > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            self.predict(batch)
+
+    def predict(self, batch: list):
+        futures = [future for _, future in batch]
+        try:
+            model = self.model_loader()
+            images = np.concatenate([images for images, _ in batch])
+            probabilities = np.asarray(model.predict_on_batch(images))
+        except Exception as err:
+            for future in futures:
+                future.set_exception(err)
+            return
+
+        start = 0
+        for images, future in batch:
+            future.set_result(probabilities[start:start + len(images)])
+            start += len(images)
+
+
+def get_batcher():
+    """取得 process 共用的 micro-batcher"""
+
+    global BATCHER
+    with BATCHER_LOCK:
+        if BATCHER is None:
+            BATCHER = MicroBatcher(get_model)
+        return BATCHER
+
+
+def get_model():
+    """取得目前的模型
+
+    模型只在第一次使用時載入，之後每 MODEL_REFRESH_SECONDS 秒才以 HEAD 確認 ETag 是否改變。
+    """
+
+    with MODEL_CACHE_LOCK:
+        now = time.monotonic()
+        if MODEL_CACHE and now - MODEL_CACHE["checked"] < MODEL_REFRESH_SECONDS:
+            return MODEL_CACHE["model"]
+
+        client = connect_minio()
+        object_name, version = model_version(client)
+        if not MODEL_CACHE or MODEL_CACHE["version"] != (object_name, version):
+            print(f"load model {TRAINED_MODEL_BUCKET_NAME}/{object_name} {version}")
+            if object_name == TRAINED_MODEL_TFLITE_FILENAME:
+                MODEL_CACHE["model"] = TFLiteModel(get_object_bytes(client, TRAINED_MODEL_BUCKET_NAME, object_name))
+            else:
+                MODEL_CACHE["model"] = load_model_from_bucket(client=client,
+                                                              bucket_name=TRAINED_MODEL_BUCKET_NAME,
+                                                              object_name=object_name)
+            MODEL_CACHE["version"] = (object_name, version)
+        MODEL_CACHE["checked"] = now
+        return MODEL_CACHE["model"]
+
+
+def model_version(client):
+    """依照 MODEL_BACKEND 取得要載入的模型 object 名稱與它的 ETag/version
+
+    Args:
+        client: MinIO Client instance
+    """
+
+    if MODEL_BACKEND == "tflite":
+        try:
+            return TRAINED_MODEL_TFLITE_FILENAME, object_version(client, TRAINED_MODEL_BUCKET_NAME,
+                                                                 TRAINED_MODEL_TFLITE_FILENAME)
+        except minio_error.S3Error as err:
+            if err.code != "NoSuchKey":
+                raise
+            print(f"{TRAINED_MODEL_TFLITE_FILENAME} not found, use {TRAINED_MODEL_KERAS_FILENAME}")
+    return TRAINED_MODEL_KERAS_FILENAME, object_version(client, TRAINED_MODEL_BUCKET_NAME, TRAINED_MODEL_KERAS_FILENAME)
+
+
+class TFLiteModel:
+    """以 TFLite interpreter 執行模型，提供 MicroBatcher 用到的 predict_on_batch
+
+    interpreter 不是 thread-safe，只在 MicroBatcher 的 thread 中使用。
+    """
+
+    def __init__(self, model_content: bytes):
+        """
+        Args:
+            model_content (bytes): TFLite 模型
+        """
+
+        self.interpreter = load_tflite_interpreter(model_content)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.allocated_batch_size = 0
+
+    def predict_on_batch(self, images):
+        """預測一個 batch
+
+        Args:
+            images (numpy.ndarray): 標準化後的影像
+        """
+
+        images = np.asarray(images, dtype='float32')
+        if len(images) != self.allocated_batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, list(images.shape))
+            self.interpreter.allocate_tensors()
+            self.allocated_batch_size = len(images)
+        self.interpreter.set_tensor(self.input_index, images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+
+def load_tflite_interpreter(model_content: bytes):
+    """建立 TFLite interpreter，優先使用 LiteRT，沒有安裝時使用 TensorFlow 內建的 interpreter
+
+    Args:
+        model_content (bytes): TFLite 模型
+    """
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_content=model_content)
+
+
+def connect_minio():
+    """取得 process 共用的 MinIO client，第一次呼叫時才建立
+
+    warm container 的請求之間重複使用同一個 urllib3 connection pool 的 keep-alive 連線，
+    pool 的連線數量不少於平行傳輸的 thread 數量，連線才不會用完就被丟棄。
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+
+            http_client = PoolManager(
+                maxsize=MINIO_MAX_CONNECTIONS,
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = minio.Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
+
+
+def object_version(client, bucket_name: str, object_name: str):
+    """以 HEAD 取得 object 的 ETag 與 version
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    stat = client.stat_object(bucket_name, object_name)
+    return stat.etag, stat.version_id
+
+
+def get_object_bytes(client, bucket_name: str, object_name: str):
+    """下載整個 object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): object 名稱
+    """
+
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def load_model_from_bucket(client, bucket_name: str, object_name: str):
+    """從 MinIO Bucket 串流下載並載入模型
+
+    Keras 只能從檔案載入模型，所以模型先寫到暫存目錄，不佔用 /home/app。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 模型的 object 名稱
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, object_name)
+        response = client.get_object(bucket_name, object_name)
+        try:
+            with open(file_path, 'wb') as f:
+                for chunk in response.stream(ARTIFACT_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.close()
+            response.release_conn()
+
+        return keras.models.load_model(file_path)
+
+
+def response(statusCode: int, message: str, predictions: list = None):
+    """Create an HTTP response.
+
+    Args:
+        statusCode (int): HTTP status code
+        message (str): response message
+        predictions (list): prediction results
+    """
+
+    body = {
+        "statusCode": statusCode,
+        "message": message,
+    }
+    if predictions is not None:
+        body["predictions"] = predictions
+    return body
@@ -0,0 +1,108 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from . import handler
+from .handler import MicroBatcher, handle, parse_images
+
+# Test your handler here
+
+# To disable testing, you can set the build_arg `TEST_ENABLED=false` on the CLI or in your stack.yml
+# https://docs.openfaas.com/reference/yaml/#function-build-args-build-args
+
+
+def test_handle():
+    # assert handle("input") == "input"
+    pass
+
+
+class RecordingModel:
+    """回傳每張影像第一個像素的模型，並記錄每次 predict_on_batch 的 batch 大小"""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+
+    def predict_on_batch(self, images):
+        with self.lock:
+            self.batch_sizes.append(len(images))
+        return images.reshape(len(images), -1)[:, :1]
+
+
+def numbered_images(start: int, count: int):
+    images = np.zeros((count, 28, 28, 1), dtype='float32')
+    images[:, 0, 0, 0] = np.arange(start, start + count)
+    return images
+
+
+def test_parse_images_shapes():
+    image = np.full((28, 28), 255).tolist()
+
+    single = parse_images({"image": image})
+    assert single.shape == (1, 28, 28, 1)
+    assert single.dtype == np.float32
+    assert single.max() == 1.0
+
+    assert parse_images({"images": [image, image, image]}).shape == (3, 28, 28, 1)
+    assert parse_images({"images": [[0.5] * (28 * 28)] * 2, "normalized": True}).max() == 0.5
+    assert parse_images({"images": np.zeros((2, 28, 28, 1)).tolist()}).shape == (2, 28, 28, 1)
+
+
+@pytest.mark.parametrize("data", [
+    {"image": [[0] * 27] * 28},
+    {"images": []},
+    {"images": np.zeros((2, 28, 28, 3)).tolist()},
+])
+def test_parse_images_rejects_other_shapes(data):
+    with pytest.raises(ValueError, match="expected 28x28 images"):
+        parse_images(data)
+
+
+def test_micro_batcher_merges_concurrent_requests():
+    model = RecordingModel()
+    batcher = MicroBatcher(lambda: model, max_batch_size=64, max_wait_ms=200)
+
+    futures = [batcher.submit(numbered_images(start, count)) for start, count in [(0, 2), (2, 3), (5, 1)]]
+
+    assert [future.result(timeout=5)[:, 0].tolist() for future in futures] == [[0, 1], [2, 3, 4], [5]]
+    assert model.batch_sizes == [6]
+
+
+def test_micro_batcher_never_exceeds_max_batch_size():
+    model = RecordingModel()
+    batcher = MicroBatcher(lambda: model, max_batch_size=4, max_wait_ms=200)
+
+    # 10 張影像的請求切成 4 + 4 + 2，之後的 3 張放不進剩下 2 張的 batch
+    futures = [batcher.submit(numbered_images(0, 10)), batcher.submit(numbered_images(10, 3))]
+
+    assert futures[0].result(timeout=5)[:, 0].tolist() == list(range(10))
+    assert futures[1].result(timeout=5)[:, 0].tolist() == [10, 11, 12]
+    assert max(model.batch_sizes) <= 4
+    assert sum(model.batch_sizes) == 13
+
+
+def test_micro_batcher_reports_model_errors_to_every_request():
+    def fail():
+        raise RuntimeError("model not found")
+
+    batcher = MicroBatcher(fail, max_batch_size=4, max_wait_ms=50)
+
+    futures = [batcher.submit(numbered_images(0, 2)), batcher.submit(numbered_images(0, 6))]
+
+    for future in futures:
+        with pytest.raises(RuntimeError, match="model not found"):
+            future.result(timeout=5)
+
+
+def test_handle_answers_503_when_model_is_unavailable(monkeypatch):
+    def fail():
+        raise RuntimeError("model not found")
+
+    monkeypatch.setattr(handler, "get_batcher", lambda: MicroBatcher(fail, max_wait_ms=1))
+
+    result = handle(json.dumps({"image": np.zeros((28, 28)).tolist()}))
+
+    assert result["statusCode"] == 503
+    assert "model not found" in result["message"]
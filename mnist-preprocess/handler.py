@@ -1,21 +1,122 @@
+import collections
+import contextlib
+import hashlib
+import importlib
+import io
+import json
 import os
-import pickle
 import requests
+import resource
+import threading
+import time
+import uuid
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
-from keras import utils
-from keras.datasets import mnist
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
+
+
+X_TRAIN4D_NORMALIZE_NPY_FILENAME = "X_Train4D_normalize.npy"
+X_TEST4D_NORMALIZE_NPY_FILENAME = "X_Test4D_normalize.npy"
+Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME = "y_Train_One_Hot_Encoding.npy"
+Y_TEST_ONE_HOT_ENCODING_NPY_FILENAME = "y_TestOneHot.npy"
+PIXEL_SCALE = 255
+NUM_CLASSES = 10
+ARTIFACT_PART_SIZE = 16 * 1024 * 1024
+TRANSFER_MAX_WORKERS = int(os.environ.get("transfer_max_workers", "4"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+# 每個 artifact 依照固定筆數切成 shard，header 中記錄每個 shard 的範圍、位移與校驗碼
+ARTIFACT_SHARD_SAMPLES = int(os.environ.get("artifact_shard_samples", "8192"))
+# 同時預處理的 block 數量，每個 artifact 最多保留 (PREPROCESS_MAX_WORKERS + 2) 個 block 的輸出 buffer
+PREPROCESS_MAX_WORKERS = int(os.environ.get("preprocess_max_workers", str(min(4, os.cpu_count() or 1))))
+# keras.datasets.mnist.load_data() 下載的 mnist.npz SHA-256
+MNIST_DATASET_SHA256 = "731c5ac602752760c8e48fbffcf8c3b850d9dc2a2aedcf2cc48468fc17b673d1"
+ARTIFACT_CACHE_PREFIX = "cache"
+# incremental 模式只預處理 INCREMENTAL_INPUT_BUCKET 中新加入的已標記資料 (.npz，包含 images 與 labels)，
+# 附加成 segments/<segment ID>/ 下的訓練資料 artifact，每個 segment 各自記錄在 segments/entries/<segment ID>.json
+SEGMENT_PREFIX = "segments"
+SEGMENT_ENTRY_PREFIX = f"{SEGMENT_PREFIX}/entries/"
+INCREMENTAL_INPUT_BUCKET = os.environ.get("incremental_input_bucket", "mnist-new-samples")
+INCREMENTAL_INPUT_PREFIX = os.environ.get("incremental_input_prefix", "")
+STAGE_NAME = "mnist-preprocess"
+TRIGGER_TIMEOUT_SECONDS = float(os.environ.get("trigger_timeout_seconds", "10"))
+TRIGGER_MAX_RETRIES = int(os.environ.get("trigger_max_retries", "5"))
+TRIGGER_BACKOFF_SECONDS = float(os.environ.get("trigger_backoff_seconds", "0.5"))
+RUN_REPORT_BUCKET_NAME = os.environ.get("run_report_bucket", "mnist-run-reports")
+METRICS_PORT = int(os.environ.get("metrics_port", "8081"))
+
+# 每個 handler 使用自己的 registry，同一個 process 載入多個 handler 時 metrics 名稱才不會衝突
+METRICS_REGISTRY = CollectorRegistry()
+PHASE_SECONDS = Histogram("mnist_pipeline_phase_seconds", "Duration of each pipeline phase",
+                          ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_BYTES = Counter("mnist_pipeline_phase_bytes", "Bytes moved by each pipeline phase",
+                      ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_PEAK_RSS_BYTES = Gauge("mnist_pipeline_phase_peak_rss_bytes", "Process peak RSS at the end of each pipeline phase",
+                             ["stage", "phase"], registry=METRICS_REGISTRY)
+METRICS_SERVER_STARTED = False
+METRICS_LOCK = threading.Lock()
+
+# 與 gateway 之間共用的 HTTP session
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+# warm container 之間共用的 MinIO client 與已經確認存在的 bucket
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+KNOWN_BUCKETS = set()
+KNOWN_BUCKETS_LOCK = threading.Lock()
+
+# process 啟動後延遲 import 的 module 與耗時 (秒)，寫入 run report
+STARTUP_PROFILE = {}
+COLD_START = True
+COLD_START_LOCK = threading.Lock()
+
+
+class LazyModule:
+    """第一次存取屬性時才 import 的 module
 
-from minio import Minio
-from minio.error import S3Error
+    keras 的 import 需要 1 秒以上，只有真的要讀取 mnist 資料集時才載入，artifact cache hit 時完全不會載入。
+    import 的耗時記錄在 STARTUP_PROFILE。
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): module 名稱
+        """
+
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def load(self):
+        """import module，之後直接回傳同一個 module"""
 
+        with self.lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.name)
+                seconds = time.perf_counter() - started
+                STARTUP_PROFILE[f"import {self.name}"] = seconds
+                print(f"[Startup] import {self.name}: {seconds:.2f}s")
+        return self.module
 
-X_TRAIN4D_NORMALIZE_PKL_FILENAME = "X_Train4D_normalize.pkl"
-X_TEST4D_NORMALIZE_PKL_FILENAME = "X_Test4D_normalize.pkl"
-Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME = "y_Train_One_Hot_Encoding.pkl"
-Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME = "y_TestOneHot.pkl"
-OPENFAAS_GATEWAY_ENDPOINT = os.environ["openfaas_gateway_endpoint"]
+
+mnist = LazyModule("keras.datasets.mnist")
+minio = LazyModule("minio")
+minio_error = LazyModule("minio.error")
 
 
 def handle(req):
@@ -25,106 +126,797 @@ def handle(req):
         req (str): request body
     """
 
+    start_metrics_server()
+    report = RunReport(get_run_id(req))
+
     minioClient = connect_minio()
     bucket_names = get_bucket_names()
     create_buckets(minioClient, bucket_names)
 
-    X_Train4D_normalize, X_Test4D_normalize, y_TrainOneHot, y_TestOneHot = data_preprocess()
-    write_file(f"{X_TRAIN4D_NORMALIZE_PKL_FILENAME}", X_Train4D_normalize)
-    write_file(f"{X_TEST4D_NORMALIZE_PKL_FILENAME}", X_Test4D_normalize)
-    write_file(f"{Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME}", y_TrainOneHot)
-    write_file(f"{Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME}", y_TestOneHot)
-
-    # 上傳檔案至 Minio Bucket
-    # normalize
-    upload_file_to_bucket(client=minioClient,
-                          bucket_name=bucket_names[0],
-                          object_name=X_TRAIN4D_NORMALIZE_PKL_FILENAME,
-                          file_path=f"/home/app/{X_TRAIN4D_NORMALIZE_PKL_FILENAME}")
-    upload_file_to_bucket(client=minioClient,
-                          bucket_name=bucket_names[0],
-                          object_name=X_TEST4D_NORMALIZE_PKL_FILENAME,
-                          file_path=f"/home/app/{X_TEST4D_NORMALIZE_PKL_FILENAME}")
-    # onehot encoding
-    upload_file_to_bucket(client=minioClient,
-                          bucket_name=bucket_names[1],
-                          object_name=Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME,
-                          file_path=f"/home/app/{Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME}")
-    upload_file_to_bucket(client=minioClient,
-                          bucket_name=bucket_names[1],
-                          object_name=Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME,
-                          file_path=f"/home/app/{Y_TEST_ONE_HOT_ENCODING_PKL_FILENAME}")
+    # pipeline scheduler 呼叫時不觸發下一個階段
+    next_stage = None if is_scheduled(req) else os.environ["next_stage"]
+    compact = is_compact_artifacts()
+
+    # 只預處理新加入的資料，不重新處理整個資料集
+    if is_incremental(req):
+        try:
+            return preprocess_increment(report, minioClient, bucket_names, next_stage, compact)
+        except ValueError as err:
+            write_run_report(minioClient, report)
+            return response(500, f"mnist-preprocess incremental preprocess failed. Error: {err}")
+
+    # 輸入與參數都沒有改變時，直接沿用 MinIO 內既有的 artifact
+    cache_key = artifact_cache_key(compact)
+    with report.phase("cache_check"):
+        cache_hit = is_artifact_cache_enabled() and artifact_cache_hit(minioClient, bucket_names, cache_key)
+    if cache_hit:
+        print(f"artifact cache {cache_key} hit, skip preprocess")
+        if next_stage:
+            with report.phase("trigger"):
+                trigger(next_stage, report.run_id)
+        write_run_report(minioClient, report)
+        return response(200, f"mnist-preprocess cache hit, trigger stage {next_stage}..." if next_stage
+                        else "mnist-preprocess cache hit...")
+
+    # 預處理與上傳重疊進行，每個 block 轉換完成後直接串流上傳
+    with report.phase("preprocess"):
+        X_Train4D_normalize, X_Test4D_normalize, y_TrainOneHot, y_TestOneHot = data_preprocess(compact, streaming=True)
+
+    artifacts = build_artifacts(bucket_names, cache_key, compact,
+                                X_Train4D_normalize, X_Test4D_normalize, y_TrainOneHot, y_TestOneHot)
+    with report.phase("upload") as record:
+        upload_artifacts(minioClient, bucket_names, cache_key, artifacts)
+        record["bytes"] = sum(data.nbytes for _, _, data, _ in artifacts)
 
     # 觸發下一個階段
-    next_stage = os.environ["next_stage"]
-    trigger(next_stage)
+    if next_stage:
+        with report.phase("trigger"):
+            trigger(next_stage, report.run_id)
+    write_run_report(minioClient, report)
+
+    return response(200, f"mnist-model-build completed, trigger stage {next_stage}..." if next_stage
+                    else "mnist-preprocess completed...")
+
 
-    return response(200, f"mnist-model-build completed, trigger stage {next_stage}...")
+def data_preprocess(compact: bool = False, streaming: bool = False):
+    """資料預處理
 
+    以固定筆數的 block 逐段預處理，每個 block 直接寫入預先配置的輸出 buffer，
+    不會產生 reshape、astype、標準化與 onehot encoding 的整份中間副本。
 
-def data_preprocess():
-    """資料預處理"""
+    Args:
+        compact (bool): 是否只輸出 uint8 像素與 uint8 類別索引
+        streaming (bool): 是否回傳 BlockSource，在上傳時才逐 block 預處理，記憶體用量不隨資料集大小增加
+    """
 
     np.random.seed(10)
 
     # 讀取 mnist 資料集
     (X_train, y_train), (X_test, y_test) = mnist.load_data()
 
-    # 資料轉換
-    X_Train4D = X_train.reshape(X_train.shape[0], 28, 28, 1).astype('float32')
-    X_Test4D = X_test.reshape(X_test.shape[0], 28, 28, 1).astype('float32')
+    sources = [
+        image_source(X_train, compact),
+        image_source(X_test, compact),
+        label_source(y_train, compact),
+        label_source(y_test, compact),
+    ]
+    if streaming:
+        return sources
+    return [source.materialize() for source in sources]
+
+
+def image_source(images, compact: bool = False):
+    """建立影像資料的 BlockSource，轉成 (筆數, 28, 28, 1) 並標準化
+
+    Args:
+        images (numpy.ndarray): uint8 影像資料，可以是 numpy.memmap
+        compact (bool): 是否保留 uint8 像素
+    """
+
+    if compact:
+        return BlockSource(images, copy_block, 'uint8', (28, 28, 1))
+    return BlockSource(images, data_normalize, 'float32', (28, 28, 1))
+
+
+def label_source(labels, compact: bool = False):
+    """建立標籤資料的 BlockSource，轉成 onehot encoding
+
+    Args:
+        labels (numpy.ndarray): 類別索引，可以是 numpy.memmap
+        compact (bool): 是否保留 uint8 類別索引
+    """
+
+    if compact:
+        return BlockSource(labels, copy_block, 'uint8', ())
+    return BlockSource(labels, data_one_hot_encoding, 'float32', (NUM_CLASSES,))
+
+
+def copy_block(block, out):
+    """將 block 原樣複製到輸出 buffer
+
+    Args:
+        block (numpy.ndarray): 輸入 block
+        out (numpy.ndarray): 預先配置的輸出 buffer
+    """
+
+    np.copyto(out, block.reshape(out.shape), casting='unsafe')
+
+
+def data_normalize(block, out):
+    """資料轉換與標準化，直接在輸出 buffer 中計算
+
+    Args:
+        block (numpy.ndarray): uint8 影像 block
+        out (numpy.ndarray): 預先配置的 float32 輸出 buffer
+    """
+
+    np.copyto(out, block.reshape(out.shape), casting='unsafe')
+    np.divide(out, PIXEL_SCALE, out=out)
+
+
+def data_one_hot_encoding(block, out):
+    """Label Onehot encoding，直接寫入輸出 buffer
+
+    Args:
+        block (numpy.ndarray): 類別索引 block
+        out (numpy.ndarray): 預先配置的 float32 輸出 buffer
+    """
+
+    out.fill(0)
+    out[np.arange(len(block)), block] = 1
+
+
+class BlockSource:
+    """以固定筆數的 block 逐段產生 artifact 資料
+
+    block 由 thread pool 平行轉換 (numpy ufunc 執行時會釋放 GIL)，並寫入預先配置、輪流使用的輸出 buffer，
+    所以記憶體用量只與 block 大小和 worker 數量有關，與資料集大小無關。
+    """
+
+    def __init__(self, source, transform, dtype, row_shape: tuple,
+                 block_samples: int = ARTIFACT_SHARD_SAMPLES, max_workers: int = PREPROCESS_MAX_WORKERS):
+        """
+        Args:
+            source (numpy.ndarray): 輸入資料，只會以 source[start:stop] 逐段讀取，可以是 numpy.memmap
+            transform (callable): transform(block, out) 將輸入 block 轉換到輸出 buffer，None 表示直接使用輸入資料
+            dtype: 輸出資料的 dtype
+            row_shape (tuple): 每筆輸出資料的 shape
+            block_samples (int): 每個 block 的資料筆數，與 artifact 的 shard 一致
+            max_workers (int): 同時轉換的 block 數量
+        """
+
+        self.source = source
+        self.transform = transform
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(source),) + tuple(row_shape)
+        self.nbytes = int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+        self.block_samples = block_samples
+        self.max_workers = max_workers
+
+    @classmethod
+    def from_array(cls, data, block_samples: int = ARTIFACT_SHARD_SAMPLES):
+        """以記憶體中已經預處理好的 numpy.ndarray 建立 BlockSource
+
+        Args:
+            data (numpy.ndarray): C-contiguous 的 numpy.ndarray
+            block_samples (int): 每個 block 的資料筆數
+        """
+
+        return cls(data, None, data.dtype, data.shape[1:], block_samples=block_samples)
+
+    def ranges(self):
+        rows = self.shape[0]
+        return [(start, min(start + self.block_samples, rows)) for start in range(0, rows, self.block_samples)]
+
+    def materialize(self):
+        """將所有 block 直接轉換到一份預先配置的完整 numpy.ndarray"""
+
+        data = np.empty(self.shape, dtype=self.dtype)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda r: self.transform(self.source[r[0]:r[1]], data[r[0]:r[1]]), self.ranges()))
+        return data
+
+    def blocks(self, labels: bool = False):
+        """依序產生 (start, stop, block, block 描述)
+
+        同時最多有 max_workers 個 block 在背景轉換，輸出 buffer 輪流使用，
+        一個 block 在呼叫端要求下一個 block 之後才可能被覆寫。
+
+        Args:
+            labels (bool): 是否為標籤資料，是的話在 block 描述中記錄各類別筆數
+        """
+
+        if self.transform is None:
+            for start, stop in self.ranges():
+                block = self.source[start:stop]
+                yield start, stop, block, describe_block(block, labels)
+            return
+
+        buffer_samples = min(self.block_samples, self.shape[0])
+        buffers = [np.empty((buffer_samples,) + self.shape[1:], dtype=self.dtype) for _ in range(self.max_workers + 2)]
+
+        def convert(index: int, start: int, stop: int):
+            out = buffers[index % len(buffers)][:stop - start]
+            self.transform(self.source[start:stop], out)
+            return start, stop, out, describe_block(out, labels)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = collections.deque()
+            for index, (start, stop) in enumerate(self.ranges()):
+                pending.append(executor.submit(convert, index, start, stop))
+                if len(pending) > self.max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def describe_block(block, labels: bool = False):
+    """計算 block 的校驗碼，標籤資料另外記錄各類別筆數
+
+    Args:
+        block (numpy.ndarray): C-contiguous 的 block
+        labels (bool): 是否為標籤資料
+    """
+
+    description = {"sha256": hashlib.sha256(memoryview(block).cast('B')).hexdigest()}
+    if labels:
+        description["label_histogram"] = label_histogram(block).tolist()
+    return description
+
+
+def build_artifacts(bucket_names: list, cache_key: str, compact: bool,
+                    X_Train4D_normalize, X_Test4D_normalize, y_TrainOneHot, y_TestOneHot):
+    """組出要上傳的 artifact 與其 JSON header 屬性
+
+    Args:
+        bucket_names (list): MinIO Bucket 名稱，依序為 normalize 與 onehot encoding
+        cache_key (str): artifact cache key
+        compact (bool): 是否為 compact (uint8) artifact
+        X_Train4D_normalize (numpy.ndarray): 訓練資料
+        X_Test4D_normalize (numpy.ndarray): 測試資料
+        y_TrainOneHot (numpy.ndarray): 訓練資料標籤
+        y_TestOneHot (numpy.ndarray): 測試資料標籤
+    """
+
+    # compact 模式下保留 uint8 像素與類別索引，由下游在 input pipeline 中才標準化與 onehot encoding
+    image_attributes = {"cache_key": cache_key}
+    label_attributes = {"cache_key": cache_key, "labels": True}
+    if compact:
+        image_attributes["scale"] = PIXEL_SCALE
+        label_attributes["num_classes"] = NUM_CLASSES
+
+    return [
+        # normalize
+        (bucket_names[0], X_TRAIN4D_NORMALIZE_NPY_FILENAME, X_Train4D_normalize, image_attributes),
+        (bucket_names[0], X_TEST4D_NORMALIZE_NPY_FILENAME, X_Test4D_normalize, image_attributes),
+        # onehot encoding
+        (bucket_names[1], Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME, y_TrainOneHot, label_attributes),
+        (bucket_names[1], Y_TEST_ONE_HOT_ENCODING_NPY_FILENAME, y_TestOneHot, label_attributes),
+    ]
+
+
+def upload_artifacts(client, bucket_names: list, cache_key: str, artifacts: list):
+    """直接從記憶體串流上傳 artifact 至 Minio Bucket，不經過 /home/app 的暫存檔，所有 artifact 同時上傳
+
+    Args:
+        client: MinIO Client instance
+        bucket_names (list): MinIO Bucket 名稱
+        cache_key (str): artifact cache key
+        artifacts (list): (bucket_name, filename, data, attributes) 的 list
+    """
+
+    with TransferManager(client) as transfer_manager:
+        headers = transfer_manager.upload_artifacts(artifacts)
+
+    # 全部 artifact 都上傳成功才記錄 cache marker
+    if all(headers):
+        write_artifact_cache_marker(client, bucket_names, cache_key, artifacts, headers)
+    return headers
+
+
+def is_compact_artifacts():
+    """從環境變數判斷是否輸出 compact (uint8) artifact"""
+
+    return os.environ.get("compact_artifacts", "false") == "true"
+
+
+def is_artifact_cache_enabled():
+    """從環境變數判斷是否啟用 artifact cache"""
+
+    return os.environ.get("artifact_cache", "true") == "true"
+
+
+def artifact_cache_key(compact: bool):
+    """依照資料集、程式版本與預處理參數計算 artifact cache key
+
+    Args:
+        compact (bool): 是否輸出 compact (uint8) artifact
+    """
+
+    code_version = os.environ.get("code_version")
+    if not code_version:
+        with open(__file__, 'rb') as f:
+            code_version = hashlib.sha256(f.read()).hexdigest()
+
+    parameters = {
+        "dataset": MNIST_DATASET_SHA256,
+        "code_version": code_version,
+        "compact": compact,
+        "scale": PIXEL_SCALE,
+        "num_classes": NUM_CLASSES,
+        "shard_samples": ARTIFACT_SHARD_SAMPLES,
+        "split": "mnist.load_data",
+    }
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+def artifact_cache_marker_name(cache_key: str):
+    """取得 artifact cache marker 的 object 名稱
+
+    Args:
+        cache_key (str): artifact cache key
+    """
+
+    return f"{ARTIFACT_CACHE_PREFIX}/{cache_key}.json"
+
+
+def artifact_cache_hit(client, bucket_names: list, cache_key: str):
+    """確認 MinIO 內是否已經有相同 cache key 的 artifact
+
+    除了 cache marker 存在之外，目前的 artifact header 也必須與 marker 記錄的校驗碼相同，
+    避免 artifact 已經被其他參數的執行結果覆蓋。
+
+    Args:
+        client: MinIO Client instance
+        bucket_names (list): artifact 所在的 MinIO Bucket 名稱
+        cache_key (str): artifact cache key
+    """
+
+    try:
+        marker = get_json_from_bucket(client, bucket_names[0], artifact_cache_marker_name(cache_key))
+        for artifact in marker["artifacts"]:
+            header = get_json_from_bucket(client,
+                                          artifact["bucket_name"],
+                                          artifact_header_filename(artifact["filename"]))
+            if header.get("cache_key") != cache_key or header["sha256"] != artifact["sha256"]:
+                return False
+    except minio_error.S3Error as err:
+        if err.code != "NoSuchKey":
+            print(f"check artifact cache {cache_key} occurs error. Error: {err}")
+        return False
+
+    return True
+
+
+def write_artifact_cache_marker(client, bucket_names: list, cache_key: str, artifacts: list, headers: list):
+    """記錄 cache key 對應的 artifact 與校驗碼
+
+    Args:
+        client: MinIO Client instance
+        bucket_names (list): artifact 所在的 MinIO Bucket 名稱
+        cache_key (str): artifact cache key
+        artifacts (list): (bucket_name, filename, data, attributes) 的 list
+        headers (list): 每個 artifact 上傳後的 JSON header
+    """
+
+    marker = {
+        "cache_key": cache_key,
+        "artifacts": [
+            {"bucket_name": bucket_name, "filename": filename, "sha256": header["sha256"]}
+            for (bucket_name, filename, _, _), header in zip(artifacts, headers)
+        ],
+    }
+    try:
+        put_json_to_bucket(client, bucket_names[0], artifact_cache_marker_name(cache_key), marker)
+    except minio_error.S3Error as err:
+        print(f"write artifact cache {cache_key} occurs error. Error: {err}")
+
+
+def preprocess_increment(report, client, bucket_names: list, next_stage: str, compact: bool):
+    """只預處理還沒有加入任何 segment 的新資料，上傳成一個新的 artifact segment 後觸發下一個階段
+
+    新資料只作為訓練資料，測試資料維持不變，不同次訓練的 evaluate 結果才能互相比較。
+    segment 與原本的 artifact 使用相同的格式與 shard 大小，所以花費的時間只與新資料的筆數有關。
+
+    Args:
+        report (RunReport): 本階段的 run report
+        client: MinIO Client instance
+        bucket_names (list): MinIO Bucket 名稱，依序為 normalize 與 onehot encoding
+        next_stage (str): 下一個階段的名稱，None 表示不觸發
+        compact (bool): 是否輸出 compact (uint8) artifact
+    """
+
+    with report.phase("list_new_samples"):
+        manifest = load_segment_manifest(client, bucket_names[0])
+        object_names = list_new_samples(client, manifest)
+    if not object_names:
+        print(f"no new samples in {INCREMENTAL_INPUT_BUCKET}/{INCREMENTAL_INPUT_PREFIX}, skip preprocess")
+        write_run_report(client, report)
+        return response(200, "mnist-preprocess has no new samples...")
+
+    with report.phase("download_new_samples") as record:
+        try:
+            images, labels, record["bytes"] = load_new_samples(client, object_names)
+        except ValueError as err:
+            write_run_report(client, report)
+            return response(400, f"invalid new samples. Error: {err}")
+
+    # segment ID 由資料內容決定，同時執行的 run 不會搶同一個編號，處理相同新資料時則寫入相同的 segment
+    segment = segment_id(object_names)
+    artifacts = build_segment_artifacts(bucket_names, segment, compact, images, labels)
+    with report.phase("upload") as record:
+        with TransferManager(client) as transfer_manager:
+            headers = transfer_manager.upload_artifacts(artifacts)
+        record["bytes"] = sum(data.nbytes for _, _, data, _ in artifacts)
+    if not all(headers):
+        raise ValueError(f"upload segment {segment} failed")
+
+    # segment 的 artifact 全部上傳成功才寫入 segment 紀錄，下游只會看到完整的 segment；
+    # 每個 segment 各自一個 object，同時執行的 run 不會覆寫彼此的紀錄
+    with report.phase("manifest"):
+        entry = {
+            "segment": segment,
+            "prefix": segment_prefix(segment),
+            "rows": len(labels),
+            "objects": object_names,
+            "label_histogram": headers[1]["label_histogram"],
+            "run_id": report.run_id,
+            "created_at": time.time(),
+        }
+        try:
+            put_json_to_bucket(client, bucket_names[0], f"{SEGMENT_ENTRY_PREFIX}{segment}.json", entry)
+            # 再讀一次所有紀錄，確認這個 segment 沒有因為和同時執行的 run 重疊而被忽略
+            manifest = load_segment_manifest(client, bucket_names[0])
+            accepted = segment in {appended["segment"] for appended in manifest["segments"]}
+            if not accepted:
+                discard_segment(client, bucket_names, segment)
+        except minio_error.S3Error as err:
+            raise ValueError(f"write segment {segment} occurs error. Error: {err}")
+    if not accepted:
+        # 另一個同時執行的 run 先加入了部分相同的資料，剩下的新資料留給下一次執行
+        print(f"segment {segment} overlaps a segment appended by a concurrent run, discard it")
+        write_run_report(client, report)
+        return response(200, f"mnist-preprocess discarded segment {segment}, its samples were appended by a concurrent run...")
+    print(f"appended segment {segment} with {len(labels)} samples from {len(object_names)} objects")
+
+    if next_stage:
+        with report.phase("trigger"):
+            trigger(next_stage, report.run_id)
+    write_run_report(client, report)
+
+    return response(200, f"mnist-preprocess appended segment {segment}, trigger stage {next_stage}..." if next_stage
+                    else f"mnist-preprocess appended segment {segment}...")
+
+
+def segment_id(object_names: list):
+    """以新資料的 object 名稱計算 segment ID
+
+    Args:
+        object_names (list): segment 包含的 .npz object 名稱
+    """
+
+    return hashlib.sha256("\n".join(sorted(object_names)).encode()).hexdigest()[:16]
+
 
-    # 資料標準化
-    X_Train4D_normalize, X_Test4D_normalize = data_normalize(
-        X_Train4D, X_Test4D)
+def segment_prefix(segment: str):
+    """取得 segment artifact 的 object prefix
 
-    # Label Onehot encoding
-    y_TrainOneHot, y_TestOneHot = data_one_hot_encoding(y_train, y_test)
+    Args:
+        segment (str): segment ID
+    """
+
+    return f"{SEGMENT_PREFIX}/{segment}/"
+
+
+def load_segment_manifest(client, bucket_name: str):
+    """讀取所有 segment 紀錄，依照建立時間排序組成 manifest，還沒有任何 segment 時回傳空的 manifest
+
+    同時執行的 run 可能把同一個 object 加入不同的 segment，這時只保留最早建立的 segment，
+    後來的 segment 整個忽略，其中其他的新資料會在下一次執行時重新加入。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): segment 紀錄所在的 MinIO Bucket 名稱
+    """
 
-    return X_Train4D_normalize, X_Test4D_normalize, y_TrainOneHot, y_TestOneHot
+    if not client.bucket_exists(bucket_name):
+        return {"segments": []}
 
+    entries = [
+        get_json_from_bucket(client, bucket_name, obj.object_name)
+        for obj in client.list_objects(bucket_name, prefix=SEGMENT_ENTRY_PREFIX, recursive=True)
+        if obj.object_name.endswith(".json")
+    ]
+    segments, ingested = [], set()
+    for entry in sorted(entries, key=lambda entry: (entry["created_at"], entry["segment"])):
+        if ingested.isdisjoint(entry["objects"]):
+            segments.append(entry)
+            ingested.update(entry["objects"])
+    return {"segments": segments}
 
-def data_normalize(X_Train4D, X_Test4D):
-    """資料標準化
+
+def discard_segment(client, bucket_names: list, segment: str):
+    """刪除沒有被採用的 segment 紀錄與 artifact
 
     Args:
-        X_Train4D (numpy.ndarray): 訓練資料
-        X_Test4D (numpy.ndarray): 測試資料
+        client: MinIO Client instance
+        bucket_names (list): MinIO Bucket 名稱，依序為 normalize 與 onehot encoding
+        segment (str): segment ID
     """
 
-    X_Train4D_normalize = X_Train4D / 255
-    X_Test4D_normalize = X_Test4D / 255
+    client.remove_object(bucket_names[0], f"{SEGMENT_ENTRY_PREFIX}{segment}.json")
+    for bucket_name in bucket_names:
+        for obj in client.list_objects(bucket_name, prefix=segment_prefix(segment), recursive=True):
+            client.remove_object(bucket_name, obj.object_name)
 
-    return X_Train4D_normalize, X_Test4D_normalize
 
+def list_new_samples(client, manifest: dict):
+    """依照名稱排序列出還沒有加入任何 segment 的 .npz object
 
-def data_one_hot_encoding(y_train, y_test):
-    """Label Onehot encoding
+    object 以名稱判斷是否已經處理過，所以新資料要以新的 object 名稱上傳。
 
     Args:
-        y_train (numpy.ndarray): 訓練資料標籤
-        y_test (numpy.ndarray): 測試資料標籤
+        client: MinIO Client instance
+        manifest (dict): segment manifest
     """
 
-    y_TrainOneHot = utils.to_categorical(y_train)
-    y_TestOneHot = utils.to_categorical(y_test)
+    if not client.bucket_exists(INCREMENTAL_INPUT_BUCKET):
+        return []
+
+    ingested = {object_name for segment in manifest["segments"] for object_name in segment["objects"]}
+    return [
+        obj.object_name
+        for obj in client.list_objects(INCREMENTAL_INPUT_BUCKET, prefix=INCREMENTAL_INPUT_PREFIX or None, recursive=True)
+        if not obj.is_dir and obj.object_name.endswith(".npz") and obj.object_name not in ingested
+    ]
+
+
+def load_new_samples(client, object_names: list):
+    """平行下載新資料，回傳 (uint8 影像, uint8 類別索引, 下載的位元組數)，資料格式不符時 raise ValueError
+
+    Args:
+        client: MinIO Client instance
+        object_names (list): INCREMENTAL_INPUT_BUCKET 中的 .npz object 名稱
+    """
+
+    def load(object_name: str):
+        response = client.get_object(INCREMENTAL_INPUT_BUCKET, object_name)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+        try:
+            with np.load(io.BytesIO(body), allow_pickle=False) as archive:
+                images, labels = archive["images"], archive["labels"]
+        except (KeyError, ValueError, zipfile.BadZipFile) as err:
+            raise ValueError(f"new samples {object_name} is not a .npz with images and labels: {err}")
+        if images.dtype != np.uint8 or images.shape[1:] not in ((28, 28), (28, 28, 1)) or \
+                not np.issubdtype(labels.dtype, np.integer) or labels.shape != images.shape[:1]:
+            raise ValueError(f"new samples {object_name} must hold uint8 images (N, 28, 28) and integer labels (N,), "
+                             f"got {images.dtype} {images.shape} and {labels.dtype} {labels.shape}")
+        if labels.size and not (0 <= labels.min() and labels.max() < NUM_CLASSES):
+            raise ValueError(f"new samples {object_name} has labels outside [0, {NUM_CLASSES})")
+        return images.reshape(-1, 28, 28), labels.astype('uint8'), len(body)
+
+    with ThreadPoolExecutor(max_workers=TRANSFER_MAX_WORKERS) as executor:
+        samples = list(executor.map(load, object_names))
+    return (np.concatenate([images for images, _, _ in samples]),
+            np.concatenate([labels for _, labels, _ in samples]),
+            sum(size for _, _, size in samples))
+
+
+def build_segment_artifacts(bucket_names: list, segment: str, compact: bool, images, labels):
+    """組出 segment 的訓練資料 artifact，格式與 build_artifacts 相同
+
+    Args:
+        bucket_names (list): MinIO Bucket 名稱，依序為 normalize 與 onehot encoding
+        segment (str): segment ID
+        compact (bool): 是否為 compact (uint8) artifact
+        images (numpy.ndarray): uint8 影像
+        labels (numpy.ndarray): 類別索引
+    """
+
+    image_attributes = {"segment": segment}
+    label_attributes = {"segment": segment, "labels": True}
+    if compact:
+        image_attributes["scale"] = PIXEL_SCALE
+        label_attributes["num_classes"] = NUM_CLASSES
+
+    prefix = segment_prefix(segment)
+    return [
+        (bucket_names[0], f"{prefix}{X_TRAIN4D_NORMALIZE_NPY_FILENAME}", image_source(images, compact),
+         image_attributes),
+        (bucket_names[1], f"{prefix}{Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME}", label_source(labels, compact),
+         label_attributes),
+    ]
+
+
+class RunReport:
+    """記錄單次 pipeline 執行中本階段各 phase 的耗時、peak RSS 與傳輸量
+
+    每個 phase 同時更新 Prometheus metrics，執行結束後整份報告以 JSON 寫入 MinIO。
+    """
+
+    def __init__(self, run_id: str):
+        """
+        Args:
+            run_id (str): pipeline 執行的 run ID
+        """
+
+        self.run_id = run_id
+        self.started_at = time.time()
+        self.phases = []
+        self.cold_start = is_cold_start()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """量測一個 phase，可以在 with 區塊內設定 record["bytes"] 記錄傳輸量
+
+        Args:
+            name (str): phase 名稱
+        """
+
+        record = {"phase": name, "bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            self.record(record)
+
+    def record(self, record: dict):
+        """加入一筆 phase 紀錄並更新 Prometheus metrics
+
+        Args:
+            record (dict): 包含 phase、seconds、bytes、peak_rss_bytes 的紀錄
+        """
+
+        self.phases.append(record)
+        PHASE_SECONDS.labels(STAGE_NAME, record["phase"]).observe(record["seconds"])
+        PHASE_BYTES.labels(STAGE_NAME, record["phase"]).inc(record["bytes"])
+        PHASE_PEAK_RSS_BYTES.labels(STAGE_NAME, record["phase"]).set(record["peak_rss_bytes"])
+        print(f"[Phase] {record['phase']}: {record['seconds']:.2f}s, {record['bytes']} bytes, "
+              f"peak RSS {record['peak_rss_bytes'] / (1024 * 1024):.1f} MiB")
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "stage": STAGE_NAME,
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "cold_start": self.cold_start,
+            "startup": dict(STARTUP_PROFILE),
+            "phases": self.phases,
+        }
+
+
+def is_cold_start():
+    """是否為 process 啟動後的第一個請求，只有第一次呼叫回傳 True"""
+
+    global COLD_START
+    with COLD_START_LOCK:
+        cold_start, COLD_START = COLD_START, False
+    return cold_start
+
+
+def peak_rss_bytes():
+    """取得目前 process 的 peak RSS (bytes)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_metrics_server():
+    """啟動 Prometheus metrics HTTP server，每個 process 只會啟動一次"""
+
+    global METRICS_SERVER_STARTED
+    with METRICS_LOCK:
+        if METRICS_SERVER_STARTED:
+            return
+        try:
+            start_http_server(METRICS_PORT, registry=METRICS_REGISTRY)
+            METRICS_SERVER_STARTED = True
+        except OSError as err:
+            print(f"start metrics server on port {METRICS_PORT} occurs error. Error: {err}")
+
+
+def get_run_id(req):
+    """從 request body 取得 run ID，沒有的話就產生新的 run ID
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and data.get("run_id"):
+        return str(data["run_id"])
+    return uuid.uuid4().hex
+
+
+def is_scheduled(req):
+    """是否由 mnist-faas-trigger 的 pipeline scheduler 呼叫，是的話由 scheduler 觸發之後的階段
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    return isinstance(data, dict) and data.get("scheduled") is True
+
+
+def is_incremental(req):
+    """是否只預處理新加入的資料，request body 的 "incremental" 優先於 incremental 環境變數
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and isinstance(data.get("incremental"), bool):
+        return data["incremental"]
+    return os.environ.get("incremental", "false") == "true"
+
 
-    return y_TrainOneHot, y_TestOneHot
+def write_run_report(client, report: RunReport):
+    """將本階段的 run report 以 JSON 寫入 MinIO
+
+    Args:
+        client: MinIO Client instance
+        report (RunReport): 本階段的 run report
+    """
+
+    try:
+        create_buckets(client, [RUN_REPORT_BUCKET_NAME])
+        put_json_to_bucket(client, RUN_REPORT_BUCKET_NAME, f"{report.run_id}/{STAGE_NAME}.json", report.to_dict())
+    except minio_error.S3Error as err:
+        print(f"write run report {report.run_id} occurs error. Error: {err}")
 
 
 def connect_minio():
-    """連接 Minio Server"""
+    """取得 process 共用的 MinIO client，第一次呼叫時才建立
+
+    warm container 的請求之間重複使用同一個 urllib3 connection pool 的 keep-alive 連線，
+    pool 的連線數量不少於平行傳輸的 thread 數量，連線才不會用完就被丟棄。
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+
+            http_client = PoolManager(
+                maxsize=max(MINIO_MAX_CONNECTIONS, TRANSFER_MAX_WORKERS),
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = minio.Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
 
-    MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
-    MINIO_ACCESS_KEY = os.environ["minio_access_key"]
-    MINIO_SECRET_KEY = os.environ["minio_secret_key"]
 
-    return Minio(
-        MINIO_API_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=False
-    )
+def get_gateway_endpoint():
+    """從環境變數中取得 OpenFaaS gateway endpoint，觸發下一個階段時才讀取"""
+
+    return os.environ["openfaas_gateway_endpoint"]
 
 
 def get_bucket_names():
@@ -143,54 +935,304 @@ def create_buckets(client, bucket_names: list):
     """
 
     print(f"bucket_names: {bucket_names}")
-    for name in bucket_names:
-        if client.bucket_exists(name):
-            print(f"Bucket {name} already exists")
-        else:
-            client.make_bucket(name)
-            print(f"Bucket {name} created")
+    with KNOWN_BUCKETS_LOCK:
+        for name in bucket_names:
+            # warm container 已經確認過的 bucket 不需要再詢問 MinIO
+            if name in KNOWN_BUCKETS:
+                continue
+            if client.bucket_exists(name):
+                print(f"Bucket {name} already exists")
+            else:
+                client.make_bucket(name)
+                print(f"Bucket {name} created")
+            KNOWN_BUCKETS.add(name)
+
+
+class TransferManager:
+    """所有階段共用的 MinIO 傳輸管理
+
+    以有上限的 thread pool 同時進行多個 object 的傳輸，大型 object 再切成多個 part 平行傳輸，
+    並記錄每個 object 的傳輸速度。
+    """
+
+    def __init__(self, client, max_workers: int = TRANSFER_MAX_WORKERS, part_size: int = ARTIFACT_PART_SIZE):
+        """
+        Args:
+            client: MinIO Client instance
+            max_workers (int): 同時進行的傳輸數量上限
+            part_size (int): 大型 object 切分的 part 大小
+        """
+
+        self.client = client
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.throughputs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+    def report(self, bucket_name: str, object_name: str, size: int, elapsed: float):
+        """記錄並印出單一 object 的傳輸速度
 
+        Args:
+            bucket_name (str): MinIO Bucket 名稱
+            object_name (str): object 名稱
+            size (int): 傳輸的位元組數
+            elapsed (float): 傳輸花費的秒數
+        """
 
-def upload_file_to_bucket(client, bucket_name: str, object_name: str, file_path: str):
-    """上傳資料到 MinIO Bucket 內
+        throughput = size / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+        with self.lock:
+            self.throughputs[f"{bucket_name}/{object_name}"] = throughput
+        print(f"[Transfer] {bucket_name}/{object_name}: {size / (1024 * 1024):.1f} MiB "
+              f"in {elapsed:.2f}s ({throughput:.1f} MiB/s)")
+
+    def upload_artifacts(self, artifacts: list):
+        """同時上傳多個 artifact
+
+        Args:
+            artifacts (list): (bucket_name, filename, data, attributes) 的 list
+        """
+
+        futures = [self.executor.submit(self._upload_artifact, *artifact) for artifact in artifacts]
+        return [future.result() for future in futures]
+
+    def _upload_artifact(self, bucket_name: str, filename: str, data, attributes: dict):
+        started = time.perf_counter()
+        header = upload_artifact_to_bucket(client=self.client,
+                                           bucket_name=bucket_name,
+                                           filename=filename,
+                                           data=data,
+                                           attributes=attributes,
+                                           num_parallel_uploads=self.max_workers)
+        self.report(bucket_name, filename, data.nbytes, time.perf_counter() - started)
+        return header
+
+
+class ArtifactReader(io.RawIOBase):
+    """將 .npy preamble 與 BlockSource 產生的 block 依序串流給 put_object
+
+    讀取的同時計算整個 object 的 SHA-256 並建立 shard index，資料本體不會另外複製一份成 bytes。
+    """
+
+    def __init__(self, source: BlockSource, labels: bool = False):
+        """
+        Args:
+            source (BlockSource): artifact 資料來源
+            labels (bool): 是否為標籤資料
+        """
+
+        preamble = io.BytesIO()
+        np.lib.format.write_array_header_1_0(preamble, {
+            "descr": np.lib.format.dtype_to_descr(source.dtype),
+            "fortran_order": False,
+            "shape": source.shape,
+        })
+        self.data_offset = preamble.tell()
+        self.row_bytes = source.nbytes // source.shape[0] if source.shape[0] else 0
+        self.length = self.data_offset + source.nbytes
+        self.blocks = source.blocks(labels)
+        self.current = memoryview(preamble.getvalue())
+        self.shards = []
+        self.sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.current.nbytes:
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            start, stop, data, description = block
+            self.shards.append({
+                "start": start,
+                "stop": stop,
+                "offset": self.data_offset + start * self.row_bytes,
+                "length": data.nbytes,
+                **description,
+            })
+            self.current = memoryview(data).cast('B')
+
+        size = min(len(buffer), self.current.nbytes)
+        chunk = self.current[:size]
+        buffer[:size] = chunk
+        self.sha256.update(chunk)
+        self.current = self.current[size:]
+        return size
+
+
+def artifact_header_filename(filename: str):
+    """取得 artifact 對應的 JSON header 檔名
+
+    Args:
+        filename (str): artifact 檔名 (.npy)
+    """
+
+    return f"{os.path.splitext(filename)[0]}.json"
+
+
+def get_json_from_bucket(client, bucket_name: str, object_name: str):
+    """取得 MinIO Bucket 內的 JSON object
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要取得的 object 名稱
+    """
+
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return json.loads(response.read())
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def put_json_to_bucket(client, bucket_name: str, object_name: str, data: dict):
+    """上傳 JSON object 到 MinIO Bucket 內
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要上傳的 object 名稱
+        data (dict): 要上傳的資料
+    """
+
+    body = json.dumps(data).encode()
+    client.put_object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      data=io.BytesIO(body),
+                      length=len(body),
+                      content_type="application/json")
+
+
+def label_histogram(labels):
+    """計算標籤中各類別的筆數
+
+    Args:
+        labels (numpy.ndarray): 類別索引或 onehot encoding 的標籤
+    """
+
+    if labels.ndim == 1:
+        return np.bincount(labels, minlength=NUM_CLASSES)
+    return labels.sum(axis=0).round().astype('int64')
+
+
+def upload_artifact_to_bucket(client, bucket_name: str, filename: str, data, attributes: dict = None,
+                              num_parallel_uploads: int = 3):
+    """將 numpy.ndarray 以 .npy artifact 與 JSON header 串流上傳到 MinIO Bucket 內
+
+    資料以 multipart 的方式分段上傳，下游階段可以依照 header 預先配置 buffer 後直接串流讀入。
+    每個 block 就是一個 shard，header 中記錄每個 shard 的範圍、位移與校驗碼。
 
     Args:
         client: MinIO Client instance
         bucket_name (str): MinIO Bucket 名稱
-        object_name (str): 要上傳到 MinIO Bucket 的 object 名稱
-        filename (object): 要上傳到 MinIO Bucket 的檔案名稱
+        filename (str): artifact 檔名 (.npy)
+        data (numpy.ndarray | BlockSource): 要上傳的資料，BlockSource 會在上傳時才逐 block 產生
+        attributes (dict): 額外寫入 header 的解碼資訊，例如 scale、num_classes；labels 為 True 時記錄各類別筆數
+        num_parallel_uploads (int): 同時上傳的 multipart part 數量
     """
 
+    source = data if isinstance(data, BlockSource) else BlockSource.from_array(np.ascontiguousarray(data))
+    attributes = attributes or {}
+    reader = ArtifactReader(source, labels=attributes.get("labels", False))
     try:
-        client.fput_object(bucket_name=bucket_name,
-                           object_name=object_name,
-                           file_path=file_path)
-    except S3Error as err:
+        client.put_object(bucket_name=bucket_name,
+                          object_name=filename,
+                          data=reader,
+                          length=reader.length,
+                          part_size=ARTIFACT_PART_SIZE,
+                          num_parallel_uploads=num_parallel_uploads)
+    except minio_error.S3Error as err:
         print(
-            f"upload file {file_path} to minio bucket {bucket_name} occurs error. Error: {err}"
+            f"upload artifact {filename} to minio bucket {bucket_name} occurs error. Error: {err}"
         )
+        return None
 
+    header = {
+        "format": "npy",
+        "dtype": source.dtype.str,
+        "shape": list(source.shape),
+        "data_offset": reader.data_offset,
+        "sha256": reader.sha256.hexdigest(),
+        "shard_samples": source.block_samples,
+        "shards": reader.shards,
+        **attributes,
+    }
+    if attributes.get("labels"):
+        histogram = np.zeros(NUM_CLASSES, dtype='int64')
+        for shard in reader.shards:
+            histogram += shard["label_histogram"]
+        header["label_histogram"] = histogram.tolist()
 
-def write_file(filename: str, data):
-    with open(filename, 'wb') as f:
-        pickle.dump(data, f)
+    # 最後才上傳 header，讓下游看到 header 時資料已完整
+    try:
+        put_json_to_bucket(client, bucket_name, artifact_header_filename(filename), header)
+    except minio_error.S3Error as err:
+        print(
+            f"upload artifact header {filename} to minio bucket {bucket_name} occurs error. Error: {err}"
+        )
+        return None
+
+    return header
 
 
-def trigger(next_stage: str):
+def trigger(next_stage: str, run_id: str = None):
     """觸發下一個階段
 
     Args:
         next_stage (str): 下一個階段的名稱
+        run_id (str): pipeline 執行的 run ID
     """
 
     req_body = {
         "next_stage": next_stage
     }
+    if run_id is not None:
+        req_body["run_id"] = run_id
+
+    try:
+        resp = get_http_session().post(
+            f"http://{get_gateway_endpoint()}/function/mnist-faas-trigger",
+            json=req_body,
+            timeout=TRIGGER_TIMEOUT_SECONDS
+        )
+        resp.raise_for_status()
+    except requests.RequestException as err:
+        print(f"trigger {next_stage} occurs error. Error: {err}")
+        return False
+    return True
+
+
+def get_http_session():
+    """取得共用的 HTTP session，重複使用與 gateway 之間的連線
+
+    連線失敗或 gateway 回應 429、503 時，以 exponential backoff 重試
+    """
 
-    _ = requests.post(
-        f"http://{OPENFAAS_GATEWAY_ENDPOINT}/function/mnist-faas-trigger",
-        json=req_body
-    )
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            # 只在請求沒有送到下一個階段時重試：連線錯誤、429 與 503
+            # read timeout 與 502 時下一個階段可能已經在執行，重試會讓它執行兩次
+            retry = Retry(total=TRIGGER_MAX_RETRIES, read=0,
+                          backoff_factor=TRIGGER_BACKOFF_SECONDS,
+                          status_forcelist=(429, 503),
+                          allowed_methods=None,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            HTTP_SESSION = session
+    return HTTP_SESSION
 
 
 def response(statusCode: int, message: str):
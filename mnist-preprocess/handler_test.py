@@ -1,4 +1,10 @@
-from .handler import handle
+import hashlib
+import io
+
+import numpy as np
+
+from .handler import (NUM_CLASSES, PIXEL_SCALE, ArtifactReader, BlockSource, data_normalize, data_one_hot_encoding,
+                      handle)
 
 # Test your handler here
 
@@ -9,3 +15,98 @@ from .handler import handle
 def test_handle():
     # assert handle("input") == "input"
     pass
+
+
+def sample_images(rows: int):
+    return (np.arange(rows * 28 * 28) % 256).astype('uint8').reshape(rows, 28, 28)
+
+
+def sample_labels(rows: int):
+    return (np.arange(rows) * 7 % NUM_CLASSES).astype('uint8')
+
+
+def read_all(reader, chunk_size: int):
+    """以固定大小的 buffer 讀完整個 ArtifactReader，chunk_size 刻意不和 block 大小對齊"""
+
+    body = bytearray()
+    buffer = bytearray(chunk_size)
+    while True:
+        size = reader.readinto(buffer)
+        if not size:
+            return bytes(body)
+        body += buffer[:size]
+
+
+def test_block_source_ranges():
+    assert BlockSource(np.zeros(10), None, 'float32', (), block_samples=4).ranges() == [(0, 4), (4, 8), (8, 10)]
+    assert BlockSource(np.zeros(8), None, 'float32', (), block_samples=4).ranges() == [(0, 4), (4, 8)]
+    assert BlockSource(np.zeros(3), None, 'float32', (), block_samples=4).ranges() == [(0, 3)]
+    assert BlockSource(np.zeros(0), None, 'float32', (), block_samples=4).ranges() == []
+
+
+def test_block_source_blocks_follow_ranges_with_reused_buffers():
+    # 10 個 block 只有 max_workers + 2 = 3 個輸出 buffer，每個 block 在取下一個 block 前都必須是正確的內容
+    images = sample_images(37)
+    source = BlockSource(images, data_normalize, 'float32', (28, 28, 1), block_samples=4, max_workers=1)
+    expected = images.reshape(37, 28, 28, 1).astype('float32') / PIXEL_SCALE
+
+    blocks = []
+    for start, stop, block, description in source.blocks():
+        np.testing.assert_array_equal(block, expected[start:stop])
+        assert description["sha256"] == hashlib.sha256(expected[start:stop].tobytes()).hexdigest()
+        blocks.append((start, stop))
+
+    assert blocks == source.ranges()
+
+
+def test_block_source_materialize_matches_blocks():
+    labels = sample_labels(11)
+    source = BlockSource(labels, data_one_hot_encoding, 'float32', (NUM_CLASSES,), block_samples=4, max_workers=2)
+
+    data = source.materialize()
+
+    assert data.shape == source.shape == (11, NUM_CLASSES)
+    assert data.nbytes == source.nbytes
+    np.testing.assert_array_equal(data, np.eye(NUM_CLASSES, dtype='float32')[labels])
+    np.testing.assert_array_equal(np.concatenate([block.copy() for _, _, block, _ in source.blocks()]), data)
+
+
+def test_block_source_from_array_yields_views():
+    data = np.arange(12, dtype='int64').reshape(6, 2)
+    source = BlockSource.from_array(data, block_samples=4)
+
+    blocks = list(source.blocks())
+
+    assert [(start, stop) for start, stop, _, _ in blocks] == [(0, 4), (4, 6)]
+    assert all(np.shares_memory(block, data) for _, _, block, _ in blocks)
+
+
+def test_artifact_reader_streams_npy_bytes():
+    images = sample_images(10)
+    source = BlockSource(images, data_normalize, 'float32', (28, 28, 1), block_samples=3, max_workers=2)
+    expected = io.BytesIO()
+    np.save(expected, source.materialize())
+    expected = expected.getvalue()
+
+    reader = ArtifactReader(source)
+    body = read_all(reader, 1000)
+
+    assert body == expected
+    assert reader.length == len(expected)
+    assert reader.data_offset == len(expected) - source.nbytes
+    assert reader.sha256.hexdigest() == hashlib.sha256(expected).hexdigest()
+
+
+def test_artifact_reader_shard_index_points_at_each_block():
+    labels = sample_labels(10)
+    reader = ArtifactReader(BlockSource(labels, None, 'uint8', (), block_samples=4), labels=True)
+    body = read_all(reader, 3)
+
+    assert [(shard["start"], shard["stop"]) for shard in reader.shards] == [(0, 4), (4, 8), (8, 10)]
+    for shard in reader.shards:
+        shard_body = body[shard["offset"]:shard["offset"] + shard["length"]]
+        assert shard_body == labels[shard["start"]:shard["stop"]].tobytes()
+        assert shard["sha256"] == hashlib.sha256(shard_body).hexdigest()
+        assert shard["label_histogram"] == np.bincount(labels[shard["start"]:shard["stop"]],
+                                                       minlength=NUM_CLASSES).tolist()
+    assert reader.shards[-1]["offset"] + reader.shards[-1]["length"] == reader.length
@@ -1,18 +1,122 @@
+import contextlib
+import hashlib
+import io
+import json
+import math
 import os
-import pickle
 import requests
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
 
 from keras.layers import Conv2D, Dense, Dropout, Flatten, MaxPool2D
-from keras.models import Sequential
+from keras.models import Sequential, load_model
+from keras.callbacks import Callback, EarlyStopping, ReduceLROnPlateau
+from keras.optimizers import Adam
+from keras.utils import PyDataset
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
 
 from minio import Minio
 from minio.error import S3Error
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
 
 
-X_TRAIN4D_NORMALIZE_PKL_FILENAME = "X_Train4D_normalize.pkl"
-Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME = "y_Train_One_Hot_Encoding.pkl"
+X_TRAIN4D_NORMALIZE_NPY_FILENAME = "X_Train4D_normalize.npy"
+Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME = "y_Train_One_Hot_Encoding.npy"
 TRAINED_MODEL_KERAS_FILENAME = "trained_model.keras"
-OPENFAAS_GATEWAY_ENDPOINT = os.environ["openfaas_gateway_endpoint"]
+TRAINED_MODEL_SETTINGS_FILENAME = "trained_model.json"
+TRAINED_MODEL_TFLITE_FILENAME = "trained_model.tflite"
+ARTIFACT_CHUNK_SIZE = 1024 * 1024
+ARTIFACT_PART_SIZE = 16 * 1024 * 1024
+TRANSFER_MAX_WORKERS = int(os.environ.get("transfer_max_workers", "4"))
+MINIO_MAX_CONNECTIONS = int(os.environ.get("minio_max_connections", "16"))
+MINIO_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("minio_connect_timeout_seconds", "5"))
+MINIO_READ_TIMEOUT_SECONDS = float(os.environ.get("minio_read_timeout_seconds", "60"))
+INPUT_PIPELINE = os.environ.get("input_pipeline", "keras")
+TF_DATA_SHARD_SIZE = int(os.environ.get("tf_data_shard_size", "4096"))
+TF_DATA_SHUFFLE_BUFFER = int(os.environ.get("tf_data_shuffle_buffer", "10000"))
+TF_DATA_CACHE = os.environ.get("tf_data_cache", "")
+STAGE_NAME = "mnist-training-model"
+TRIGGER_TIMEOUT_SECONDS = float(os.environ.get("trigger_timeout_seconds", "10"))
+TRIGGER_MAX_RETRIES = int(os.environ.get("trigger_max_retries", "5"))
+TRIGGER_BACKOFF_SECONDS = float(os.environ.get("trigger_backoff_seconds", "0.5"))
+RUN_REPORT_BUCKET_NAME = os.environ.get("run_report_bucket", "mnist-run-reports")
+# 多 worker 訓練時，每個 epoch 結束後透過 MinIO 交換並平均模型參數
+DISTRIBUTED_PREFIX = "distributed"
+DISTRIBUTED_SYNC_TIMEOUT_SECONDS = float(os.environ.get("distributed_sync_timeout_seconds", "600"))
+DISTRIBUTED_POLL_SECONDS = float(os.environ.get("distributed_poll_seconds", "0.5"))
+# 訓練中定期將模型與 optimizer 狀態寫入 MinIO，0 表示不依照該間隔寫入
+CHECKPOINT_PREFIX = "checkpoints"
+CHECKPOINT_EVERY_EPOCHS = int(os.environ.get("checkpoint_every_epochs", "1"))
+CHECKPOINT_EVERY_BATCHES = int(os.environ.get("checkpoint_every_batches", "0"))
+# 另外輸出給 evaluate/inference 以 TFLite interpreter 執行的模型，"float16"、"int8" 或 "" (不輸出)
+# 與原本模型在驗證資料上的準確率差距超過 INFERENCE_EXPORT_MAX_ACCURACY_DROP 時不上傳
+INFERENCE_EXPORT = os.environ.get("inference_export", "float16")
+INFERENCE_EXPORT_CHECK_SAMPLES = int(os.environ.get("inference_export_check_samples", "2000"))
+INFERENCE_EXPORT_MAX_ACCURACY_DROP = float(os.environ.get("inference_export_max_accuracy_drop", "0.01"))
+INFERENCE_EXPORT_BATCH_SIZE = 256
+# hyperparameter sweep 的 trial 將模型寫到 sweeps/<sweep ID>/<trial>/，由 mnist-faas-trigger 挑選最好的模型
+SWEEP_PREFIX = "sweeps"
+# incremental 模式載入上一次的模型，只以還沒訓練過的 segment 加上回放的舊資料微調
+# 回放的筆數為新資料筆數的 REPLAY_RATIO 倍，依照筆數比例從已經訓練過的資料中取出
+SEGMENT_PREFIX = "segments"
+SEGMENT_ENTRY_PREFIX = f"{SEGMENT_PREFIX}/entries/"
+FINETUNE_EPOCHS = int(os.environ.get("finetune_epochs", "3"))
+FINETUNE_LEARNING_RATE = float(os.environ.get("finetune_learning_rate", "0.0001"))
+REPLAY_RATIO = float(os.environ.get("replay_ratio", "1.0"))
+# 訓練超參數的預設值，可以用同名的環境變數或 request body 的 "hyperparameters" 覆寫
+# patience 為 0 表示停用 EarlyStopping/ReduceLROnPlateau
+DEFAULT_HYPERPARAMETERS = {
+    "epochs": 10,
+    "batch_size": 300,
+    "validation_split": 0.2,
+    "learning_rate": 0.001,
+    "conv1_filters": 16,
+    "conv2_filters": 36,
+    "dense_units": 128,
+    "conv_dropout": 0.25,
+    "dense_dropout": 0.5,
+    "early_stopping_patience": 3,
+    "early_stopping_min_delta": 0.0,
+    "reduce_lr_patience": 2,
+    "reduce_lr_factor": 0.5,
+    "min_learning_rate": 0.00001,
+}
+METRICS_PORT = int(os.environ.get("metrics_port", "8081"))
+
+# 每個 handler 使用自己的 registry，同一個 process 載入多個 handler 時 metrics 名稱才不會衝突
+METRICS_REGISTRY = CollectorRegistry()
+PHASE_SECONDS = Histogram("mnist_pipeline_phase_seconds", "Duration of each pipeline phase",
+                          ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_BYTES = Counter("mnist_pipeline_phase_bytes", "Bytes moved by each pipeline phase",
+                      ["stage", "phase"], registry=METRICS_REGISTRY)
+PHASE_PEAK_RSS_BYTES = Gauge("mnist_pipeline_phase_peak_rss_bytes", "Process peak RSS at the end of each pipeline phase",
+                             ["stage", "phase"], registry=METRICS_REGISTRY)
+METRICS_SERVER_STARTED = False
+METRICS_LOCK = threading.Lock()
+
+# warm container 之間共用的 MinIO client 與已經確認存在的 bucket
+MINIO_CLIENT = None
+MINIO_CLIENT_LOCK = threading.Lock()
+KNOWN_BUCKETS = set()
+KNOWN_BUCKETS_LOCK = threading.Lock()
+
+# 與 gateway 之間共用的 HTTP session
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+COLD_START = True
+COLD_START_LOCK = threading.Lock()
 
 
 def handle(req):
@@ -22,66 +126,220 @@ def handle(req):
         req (str): request body
     """
 
+    start_metrics_server()
+    try:
+        worker_index, num_workers = get_worker(req)
+    except (TypeError, ValueError) as err:
+        return response(400, f"invalid worker. Error: {err}")
+    report = RunReport(get_run_id(req), worker_index, num_workers)
+    try:
+        hyperparameters = get_hyperparameters(req)
+    except (TypeError, ValueError) as err:
+        return response(400, f"invalid hyperparameters. Error: {err}")
+    sweep_trial = get_sweep_trial(req)
+    if num_workers > 1:
+        # 各 worker 的驗證資料不同，各自提早停止會讓其他 worker 等不到參數，所以多 worker 時停用
+        hyperparameters.update(early_stopping_patience=0, reduce_lr_patience=0)
+    print(f"hyperparameters: {json.dumps(hyperparameters)}")
+
     minioClient = connect_minio()
     bucket_names = get_bucket_names()
     create_buckets(minioClient, bucket_names)
 
-    # 從 MinIO 取得上一個階段的資料
-    get_file_from_bucket(client=minioClient,
-                         bucket_name="mnist-normalize",
-                         object_name=X_TRAIN4D_NORMALIZE_PKL_FILENAME,
-                         file_path=f"/home/app/{X_TRAIN4D_NORMALIZE_PKL_FILENAME}")
-    X_Train4D_normalize = convert_pkl_to_data(
-        f"/home/app/{X_TRAIN4D_NORMALIZE_PKL_FILENAME}")
-    get_file_from_bucket(client=minioClient,
-                         bucket_name="mnist-onehot-encoding",
-                         object_name=Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME,
-                         file_path=f"/home/app/{Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME}")
-    y_TrainOneHot = convert_pkl_to_data(
-        f"/home/app/{Y_TRAIN_ONE_HOT_ENCODING_PKL_FILENAME}")
-
-    # 建立模型
-    model = model_build()
+    # incremental 模式載入上一次的模型微調，多 worker 訓練與 sweep 的 trial 都從頭訓練
+    segments = load_segment_manifest(minioClient, "mnist-normalize")["segments"]
+    previous = None
+    if is_incremental(req) and num_workers == 1 and not sweep_trial:
+        with report.phase("download_model") as record:
+            previous = load_previous_model(minioClient, bucket_names[0], record)
+        if previous is None:
+            print("no previous model to fine-tune, train from scratch")
+
+    if previous is not None:
+        model, previous_settings = previous
+        trained = set(previous_settings.get("segments", []))
+        new_segments = [segment for segment in segments if segment["segment"] not in trained]
+        if not new_segments:
+            print(f"model of run {previous_settings['run_id']} is already trained on every segment, skip training")
+            write_run_report(minioClient, report)
+            return response(200, "mnist-training-model is up to date...")
+
+        # 只下載新的 segment 與回放的舊資料，花費的時間與新資料的筆數有關，而不是整個資料集
+        hyperparameters.update(epochs=FINETUNE_EPOCHS, learning_rate=FINETUNE_LEARNING_RATE)
+        print(f"fine-tune model of run {previous_settings['run_id']} on segments "
+              f"{[segment['segment'] for segment in new_segments]} for {FINETUNE_EPOCHS} epochs")
+        with report.phase("download") as record:
+            with TransferManager(minioClient) as transfer_manager:
+                (X_Train4D_normalize, X_Train4D_header), (y_TrainOneHot, y_TrainOneHot_header), replay_rows = \
+                    download_finetune_data(transfer_manager,
+                                           new_segments=new_segments,
+                                           old_segments=[segment for segment in segments if segment["segment"] in trained])
+            record["bytes"] = X_Train4D_normalize.nbytes + y_TrainOneHot.nbytes
+        trained_segments = sorted(trained | {segment["segment"] for segment in new_segments})
+    else:
+        # 從 MinIO 取得上一個階段的資料與所有 segment，下載時同時還原成 numpy.ndarray 並驗證校驗碼
+        # 多 worker 訓練時每個 worker 只以 ranged GET 讀取每個 artifact 中自己的 shard
+        shard = (worker_index, num_workers) if num_workers > 1 else None
+        with report.phase("download") as record:
+            with TransferManager(minioClient) as transfer_manager:
+                artifacts = transfer_manager.download_artifacts(training_artifacts(segments), shard=shard)
+            (X_Train4D_normalize, X_Train4D_header) = concat_artifacts(artifacts[0::2])
+            (y_TrainOneHot, y_TrainOneHot_header) = concat_artifacts(artifacts[1::2])
+            record["bytes"] = X_Train4D_normalize.nbytes + y_TrainOneHot.nbytes
+
+        # 建立模型
+        with report.phase("model_build"):
+            model = model_build(hyperparameters)
+        trained_segments = [segment["segment"] for segment in segments]
+
+    callbacks = [EpochReportCallback(report)]
+
+    # 同一個 run ID 重新執行時 (例如逾時或被驅逐後重新觸發)，從最新的 checkpoint 接續訓練
+    # 多 worker 訓練的參數每個 epoch 都會重新平均，所以只在單一 worker 時使用 checkpoint
+    checkpoint = None
+    if num_workers == 1 and (CHECKPOINT_EVERY_EPOCHS or CHECKPOINT_EVERY_BATCHES):
+        with report.phase("checkpoint_load") as record:
+            checkpoint = load_checkpoint(minioClient, bucket_names[0], report.run_id)
+            if checkpoint is not None:
+                record["bytes"] = checkpoint["bytes"]
+                print(f"resume run {report.run_id} from checkpoint at epoch {checkpoint['epoch']} "
+                      f"batch {checkpoint['batch']}")
+        callbacks.append(CheckpointCallback(client=minioClient,
+                                            bucket_name=bucket_names[0],
+                                            run_id=report.run_id,
+                                            every_epochs=CHECKPOINT_EVERY_EPOCHS,
+                                            every_batches=CHECKPOINT_EVERY_BATCHES,
+                                            checkpoint=checkpoint))
+    if num_workers > 1:
+        callbacks.append(ParameterAveragingCallback(client=minioClient,
+                                                    bucket_name=bucket_names[0],
+                                                    run_id=report.run_id,
+                                                    worker_index=worker_index,
+                                                    num_workers=num_workers,
+                                                    samples=len(X_Train4D_normalize)))
 
     # 訓練模型
-    trained_model, _ = training_model(model=model,
-                                      normalize_data=X_Train4D_normalize,
-                                      onehot_data=y_TrainOneHot)
+    with report.phase("fit"):
+        trained_model, train_result = training_model(model=model,
+                                                     normalize_data=X_Train4D_normalize,
+                                                     onehot_data=y_TrainOneHot,
+                                                     normalize_header=X_Train4D_header,
+                                                     onehot_header=y_TrainOneHot_header,
+                                                     callbacks=callbacks,
+                                                     initial_epoch=checkpoint["epoch"] if checkpoint else 0,
+                                                     hyperparameters=hyperparameters)
+
+    # 每個 worker 的參數已經平均過，只由 worker 0 上傳模型並觸發下一個階段
+    if worker_index != 0:
+        write_run_report(minioClient, report)
+        return response(200, f"mnist-training-model worker {worker_index}/{num_workers} completed...")
+
+    # 將訓練後的模型資料儲存到 MinIO Bucket，sweep 的 trial 寫到自己的 prefix 下
+    object_prefix = f"{SWEEP_PREFIX}/{sweep_trial}/" if sweep_trial else ""
+    with report.phase("upload") as record:
+        uploaded_bytes = upload_model_to_bucket(client=minioClient,
+                                                bucket_name=bucket_names[0],
+                                                object_name=f"{object_prefix}{TRAINED_MODEL_KERAS_FILENAME}",
+                                                model=trained_model)
+        record["bytes"] = uploaded_bytes
+
+    # 輸出量化後的 TFLite 模型，並以驗證資料確認準確率沒有下降太多
+    settings = training_settings(report.run_id, hyperparameters, train_result)
+    settings["segments"] = trained_segments
+    if previous is not None:
+        settings["fine_tuned_from"] = previous_settings["run_id"]
+        settings["replay_rows"] = replay_rows
+    if INFERENCE_EXPORT:
+        tflite_object_name = f"{object_prefix}{TRAINED_MODEL_TFLITE_FILENAME}"
+        with report.phase("export") as record:
+            # .keras 模型已經上傳，TFLite 轉換失敗時仍然繼續寫入訓練設定並觸發下一個階段
+            try:
+                export = export_inference_model(client=minioClient,
+                                                bucket_name=bucket_names[0],
+                                                object_name=tflite_object_name,
+                                                model=trained_model,
+                                                images=X_Train4D_normalize,
+                                                image_header=X_Train4D_header,
+                                                labels=y_TrainOneHot,
+                                                label_header=y_TrainOneHot_header,
+                                                validation_split=hyperparameters["validation_split"])
+            except Exception as err:
+                print(f"export TFLite model {tflite_object_name} occurs error. Error: {err}")
+                export = {"format": "tflite", "quantization": INFERENCE_EXPORT, "object_name": tflite_object_name,
+                          "bytes": 0, "error": str(err)}
+                # 刪除之前的 TFLite 模型，evaluate/inference 才不會讀到與 .keras 模型不一致的版本
+                try:
+                    minioClient.remove_object(bucket_names[0], tflite_object_name)
+                except S3Error as remove_err:
+                    print(f"remove TFLite model {tflite_object_name} occurs error. Error: {remove_err}")
+            settings["inference_export"] = export
+            record["bytes"] = export["bytes"]
+
+    # 將這次訓練使用的超參數與停止的 epoch 存在模型旁邊
+    print(f"training stopped after epoch {settings['epochs_trained']}/{hyperparameters['epochs']}")
+    try:
+        put_json_to_bucket(minioClient, bucket_names[0], f"{object_prefix}{TRAINED_MODEL_SETTINGS_FILENAME}", settings)
+    except S3Error as err:
+        print(f"upload training settings to MinIO bucket {bucket_names[0]} occurs error. Error: {err}")
+
+    # sweep 的下一輪會以更多 epoch 從 checkpoint 接續訓練，由 mnist-faas-trigger 在 sweep 結束後刪除
+    # 也不觸發下一個階段，由 mnist-faas-trigger 在挑選出最好的模型之後觸發
+    if sweep_trial:
+        write_run_report(minioClient, report)
+        return response(200, f"mnist-training-model sweep trial {sweep_trial} completed...")
+
+    # 模型已經上傳，這次執行不再需要 checkpoint
+    if uploaded_bytes:
+        delete_checkpoints(minioClient, bucket_names[0], report.run_id)
 
-    # 將訓練後的模型資料儲存到 MinIO Bucket
-    save_trained_model(trained_model, TRAINED_MODEL_KERAS_FILENAME)
-    upload_file_to_bucket(client=minioClient,
-                          bucket_name=bucket_names[0],
-                          object_name=TRAINED_MODEL_KERAS_FILENAME,
-                          file_path=f"/home/app/{TRAINED_MODEL_KERAS_FILENAME}")
+    # pipeline scheduler 呼叫時由 scheduler 觸發之後的階段
+    if is_scheduled(req):
+        write_run_report(minioClient, report)
+        return response(200, "mnist-training-model completed...")
 
     # 觸發下一個階段
     next_stage = os.environ["next_stage"]
-    trigger(next_stage)
+    with report.phase("trigger"):
+        trigger(next_stage, report.run_id)
+    write_run_report(minioClient, report)
 
     return response(200, f"mnist-model-build completed, trigger stage {next_stage}...")
 
 
-def model_build():
-    """建立模型"""
+def model_build(hyperparameters: dict = None):
+    """建立模型
+
+    Args:
+        hyperparameters (dict): 訓練超參數，沒有給的話使用 DEFAULT_HYPERPARAMETERS
+    """
+
+    hyperparameters = hyperparameters or DEFAULT_HYPERPARAMETERS
 
     model = Sequential()
-    create_cn_layer_and_pool_layer(model)
-    create_flatten_layer_and_hidden_layer(model)
+    create_cn_layer_and_pool_layer(model,
+                                   conv1_filters=hyperparameters["conv1_filters"],
+                                   conv2_filters=hyperparameters["conv2_filters"],
+                                   dropout=hyperparameters["conv_dropout"])
+    create_flatten_layer_and_hidden_layer(model,
+                                          dense_units=hyperparameters["dense_units"],
+                                          dropout=hyperparameters["dense_dropout"])
     model_summary(model)
 
     return model
 
 
-def create_cn_layer_and_pool_layer(model):
+def create_cn_layer_and_pool_layer(model, conv1_filters: int = 16, conv2_filters: int = 36, dropout: float = 0.25):
     """建立卷積層與池化層
 
     Args:
         model (keras.models.Sequential): keras.models.Sequential
+        conv1_filters (int): 第一層卷積層的 filter 數量
+        conv2_filters (int): 第二層卷積層的 filter 數量
+        dropout (float): 池化層之後的 dropout 比例
     """
 
     # Create CN layer 1
-    model.add(Conv2D(filters=16,
+    model.add(Conv2D(filters=conv1_filters,
                      kernel_size=(5, 5),
                      padding='same',
                      input_shape=(28, 28, 1),
@@ -91,7 +349,7 @@ def create_cn_layer_and_pool_layer(model):
     model.add(MaxPool2D(pool_size=(2, 2), name='max_pooling2d_1'))
 
     # Create CN layer 2
-    model.add(Conv2D(filters=36,
+    model.add(Conv2D(filters=conv2_filters,
                      kernel_size=(5, 5),
                      padding='same',
                      input_shape=(28, 28, 1),
@@ -102,22 +360,24 @@ def create_cn_layer_and_pool_layer(model):
     model.add(MaxPool2D(pool_size=(2, 2), name='max_pooling2d_2'))
 
     # Add Dropout layer
-    model.add(Dropout(0.25, name='dropout_1'))
+    model.add(Dropout(dropout, name='dropout_1'))
 
 
-def create_flatten_layer_and_hidden_layer(model):
+def create_flatten_layer_and_hidden_layer(model, dense_units: int = 128, dropout: float = 0.5):
     """建立平坦層與隱藏層
 
     Args:
         model (keras.models.Sequential): keras.models.Sequential
+        dense_units (int): 隱藏層的神經元數量
+        dropout (float): 隱藏層之後的 dropout 比例
     """
 
     # Create Flatten layer
     model.add(Flatten(name='flatten_1'))
 
     # Create Hidden layer
-    model.add(Dense(128, activation='relu', name='dense_1'))
-    model.add(Dropout(0.5, name='dropout_2'))
+    model.add(Dense(dense_units, activation='relu', name='dense_1'))
+    model.add(Dropout(dropout, name='dropout_2'))
 
     # Create Output layer
     model.add(Dense(10, activation='softmax', name='dense_2'))
@@ -134,31 +394,369 @@ def model_summary(model):
     print("Model is built successfully!")
 
 
-def training_model(model, normalize_data, onehot_data):
+def training_model(model, normalize_data, onehot_data, normalize_header: dict = None, onehot_header: dict = None,
+                   callbacks: list = None, initial_epoch: int = 0, hyperparameters: dict = None):
     """訓練模型
 
     Args:
         model (keras.models.Sequential): keras.models.Sequential
         normalize_data (numpy.ndarray): 標準化後的訓練資料
         onehot_data (numpy.ndarray): onehot encoding 後的訓練資料
+        normalize_header (dict): 訓練資料 artifact 的 JSON header
+        onehot_header (dict): 訓練資料標籤 artifact 的 JSON header
+        callbacks (list): 傳給 model.fit 的 keras.callbacks.Callback
+        initial_epoch (int): 從 checkpoint 接續訓練時已經完成的 epoch 數
+        hyperparameters (dict): 訓練超參數，沒有給的話使用 DEFAULT_HYPERPARAMETERS
     """
 
+    normalize_header = normalize_header or {}
+    onehot_header = onehot_header or {}
+    hyperparameters = hyperparameters or DEFAULT_HYPERPARAMETERS
+    validation_split = hyperparameters["validation_split"]
+    epochs = hyperparameters["epochs"]
+    batch_size = hyperparameters["batch_size"]
+
     # 定義訓練方式
     model.compile(loss='categorical_crossentropy',
-                  optimizer='adam',
+                  optimizer=Adam(learning_rate=hyperparameters["learning_rate"]),
                   metrics=['accuracy'])
 
+    # 驗證損失不再下降時降低 learning rate，仍然沒有改善就提早停止
+    callbacks = list(callbacks or []) + adaptive_callbacks(hyperparameters,
+                                                           monitor='val_loss' if validation_split else 'loss')
+
+    # 與 validation_split 相同，取最後 validation_split 比例的資料作為驗證資料
+    split_at = int(len(normalize_data) * (1 - validation_split))
+
+    # tf.data input pipeline，記憶體用量取決於 shuffle/prefetch buffer 而不是資料集大小
+    if INPUT_PIPELINE == "tf.data":
+        train_data = build_tf_dataset(normalize_data, normalize_header, onehot_data, onehot_header,
+                                      start=0,
+                                      stop=split_at,
+                                      batch_size=batch_size,
+                                      shuffle=True)
+        validation_data = build_tf_dataset(normalize_data, normalize_header, onehot_data, onehot_header,
+                                           start=split_at,
+                                           stop=len(normalize_data),
+                                           batch_size=batch_size) if validation_split else None
+        train_result = model.fit(train_data,
+                                 validation_data=validation_data,
+                                 epochs=epochs,
+                                 initial_epoch=initial_epoch,
+                                 callbacks=callbacks,
+                                 verbose=1)
+        return model, train_result
+
+    # compact artifact 在 input pipeline 中逐 batch 解碼
+    if is_compact_artifact(normalize_header) or is_compact_artifact(onehot_header):
+        train_data = ArtifactSequence(normalize_data, normalize_header, onehot_data, onehot_header,
+                                      batch_size=batch_size,
+                                      indices=np.arange(split_at),
+                                      shuffle=True)
+        validation_data = ArtifactSequence(normalize_data, normalize_header, onehot_data, onehot_header,
+                                           batch_size=batch_size,
+                                           indices=np.arange(split_at, len(normalize_data))) if validation_split else None
+        train_result = model.fit(train_data,
+                                 validation_data=validation_data,
+                                 epochs=epochs,
+                                 initial_epoch=initial_epoch,
+                                 callbacks=callbacks,
+                                 verbose=1)
+        return model, train_result
+
     # 開始訓練
     train_result = model.fit(x=normalize_data,
                              y=onehot_data,
-                             validation_split=0.2,
-                             epochs=10,
-                             batch_size=300,
+                             validation_split=validation_split,
+                             epochs=epochs,
+                             initial_epoch=initial_epoch,
+                             batch_size=batch_size,
+                             callbacks=callbacks,
                              verbose=1)
 
     return model, train_result
 
 
+def adaptive_callbacks(hyperparameters: dict, monitor: str = 'val_loss'):
+    """依照超參數建立 ReduceLROnPlateau 與 EarlyStopping
+
+    Args:
+        hyperparameters (dict): 訓練超參數
+        monitor (str): 監看的指標
+    """
+
+    callbacks = []
+    if hyperparameters["reduce_lr_patience"]:
+        callbacks.append(ReduceLROnPlateau(monitor=monitor,
+                                           factor=hyperparameters["reduce_lr_factor"],
+                                           patience=hyperparameters["reduce_lr_patience"],
+                                           min_lr=hyperparameters["min_learning_rate"],
+                                           verbose=1))
+    if hyperparameters["early_stopping_patience"]:
+        callbacks.append(EarlyStopping(monitor=monitor,
+                                       min_delta=hyperparameters["early_stopping_min_delta"],
+                                       patience=hyperparameters["early_stopping_patience"],
+                                       restore_best_weights=True,
+                                       verbose=1))
+    return callbacks
+
+
+def training_settings(run_id: str, hyperparameters: dict, train_result):
+    """整理這次訓練使用的超參數、實際訓練的 epoch 數、最後的指標與最好 epoch 的指標
+
+    EarlyStopping 會還原監看指標最好的 epoch 的參數，所以上傳的模型對應 best_metrics。
+
+    Args:
+        run_id (str): pipeline 執行的 run ID
+        hyperparameters (dict): 訓練超參數
+        train_result (keras.callbacks.History): model.fit 的回傳值
+    """
+
+    history = train_result.history if train_result is not None else {}
+    epochs_trained = train_result.epoch[-1] + 1 if train_result is not None and train_result.epoch else 0
+    monitor = 'val_loss' if history.get('val_loss') else 'loss'
+    values = history.get(monitor, [])
+    # 沒有 EarlyStopping 時模型就是最後一個 epoch 的參數
+    best = int(np.argmin(values)) if hyperparameters["early_stopping_patience"] and values else len(values) - 1
+    return {
+        "run_id": run_id,
+        "hyperparameters": hyperparameters,
+        "epochs_trained": epochs_trained,
+        "early_stopped": epochs_trained < hyperparameters["epochs"],
+        "metrics": {name: float(values[-1]) for name, values in history.items() if values},
+        "best_metrics": {name: float(values[best]) for name, values in history.items() if len(values) > best >= 0},
+    }
+
+
+def get_hyperparameters(req):
+    """取得訓練超參數，優先順序為 request body 的 "hyperparameters"、同名的環境變數、預設值，數值不合法時 raise ValueError
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    overrides = data.get("hyperparameters") if isinstance(data, dict) else None
+    overrides = overrides if isinstance(overrides, dict) else {}
+
+    hyperparameters = {}
+    for name, default in DEFAULT_HYPERPARAMETERS.items():
+        value = overrides.get(name, os.environ.get(name, default))
+        # 整數超參數不接受小數，避免 epochs=2.5 被默默截斷成 2
+        if isinstance(default, int) and (isinstance(value, bool) or isinstance(value, float) and not value.is_integer()):
+            raise ValueError(f"{name} must be an integer, got {value}")
+        hyperparameters[name] = type(default)(value)
+
+    unknown = set(overrides) - set(DEFAULT_HYPERPARAMETERS)
+    if unknown:
+        raise ValueError(f"unknown hyperparameters: {', '.join(sorted(unknown))}")
+    for name in ("epochs", "batch_size", "conv1_filters", "conv2_filters", "dense_units", "learning_rate"):
+        if not hyperparameters[name] > 0:
+            raise ValueError(f"{name} must be positive, got {hyperparameters[name]}")
+    for name in ("early_stopping_patience", "reduce_lr_patience", "early_stopping_min_delta", "min_learning_rate"):
+        if hyperparameters[name] < 0:
+            raise ValueError(f"{name} must not be negative, got {hyperparameters[name]}")
+    if not 0 < hyperparameters["reduce_lr_factor"] < 1:
+        raise ValueError(f"reduce_lr_factor must be in (0, 1), got {hyperparameters['reduce_lr_factor']}")
+    if not 0 <= hyperparameters["validation_split"] < 1:
+        raise ValueError(f"validation_split must be in [0, 1), got {hyperparameters['validation_split']}")
+    for name in ("conv_dropout", "dense_dropout"):
+        if not 0 <= hyperparameters[name] < 1:
+            raise ValueError(f"{name} must be in [0, 1), got {hyperparameters[name]}")
+    return hyperparameters
+
+
+def build_tf_dataset(images, image_header: dict, labels, label_header: dict, start: int, stop: int,
+                     batch_size: int, shuffle: bool = False):
+    """由 artifact 建立 tf.data input pipeline
+
+    資料依照 TF_DATA_SHARD_SIZE 切成多個 shard 平行讀取，標準化與 onehot encoding 在 batch 之後
+    以平行 map 進行，最後 prefetch(AUTOTUNE) 讓資料準備與訓練重疊。
+
+    Args:
+        images (numpy.ndarray): 影像 artifact
+        image_header (dict): 影像 artifact 的 JSON header
+        labels (numpy.ndarray): 標籤 artifact
+        label_header (dict): 標籤 artifact 的 JSON header
+        start (int): 第一個樣本的索引
+        stop (int): 最後一個樣本的下一個索引
+        batch_size (int): batch 大小
+        shuffle (bool): 是否打亂資料順序
+    """
+
+    image_header = image_header or {}
+    label_header = label_header or {}
+    shard_starts = np.arange(start, stop, TF_DATA_SHARD_SIZE, dtype='int64')
+    image_spec = tf.TensorSpec((None, *images.shape[1:]), tf.as_dtype(images.dtype))
+    label_spec = tf.TensorSpec((None, *labels.shape[1:]), tf.as_dtype(labels.dtype))
+
+    def read_shard(shard_start):
+        shard_stop = min(shard_start + TF_DATA_SHARD_SIZE, stop)
+        return images[shard_start:shard_stop], labels[shard_start:shard_stop]
+
+    def shard_dataset(shard_start):
+        shard_images, shard_labels = tf.numpy_function(read_shard, [shard_start],
+                                                       [image_spec.dtype, label_spec.dtype])
+        shard_images = tf.ensure_shape(shard_images, image_spec.shape)
+        shard_labels = tf.ensure_shape(shard_labels, label_spec.shape)
+        return tf.data.Dataset.from_tensor_slices((shard_images, shard_labels))
+
+    def decode(batch_images, batch_labels):
+        batch_images = tf.cast(batch_images, tf.float32)
+        if image_header.get("scale") is not None:
+            batch_images = batch_images / image_header["scale"]
+        if label_header.get("num_classes") is not None:
+            batch_labels = tf.one_hot(tf.cast(batch_labels, tf.int32), label_header["num_classes"])
+        return batch_images, tf.cast(batch_labels, tf.float32)
+
+    dataset = tf.data.Dataset.from_tensor_slices(shard_starts)
+    # cache 之後順序就固定了，所以只在不 cache 時打亂 shard 的順序
+    if shuffle and not TF_DATA_CACHE:
+        dataset = dataset.shuffle(len(shard_starts))
+    dataset = dataset.interleave(shard_dataset,
+                                 cycle_length=tf.data.AUTOTUNE,
+                                 num_parallel_calls=tf.data.AUTOTUNE,
+                                 deterministic=not shuffle)
+
+    # tf_data_cache 為 "memory" 時快取在記憶體，其他值視為快取檔案路徑
+    if TF_DATA_CACHE:
+        dataset = dataset.cache("" if TF_DATA_CACHE == "memory" else TF_DATA_CACHE)
+    if shuffle:
+        dataset = dataset.shuffle(TF_DATA_SHUFFLE_BUFFER, reshuffle_each_iteration=True)
+
+    return (dataset
+            .batch(batch_size)
+            .map(decode, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE))
+
+
+def export_inference_model(client, bucket_name: str, object_name: str, model, images, image_header: dict,
+                           labels, label_header: dict, validation_split: float = 0.2):
+    """將模型轉換成量化後的 TFLite 模型，比較兩者在驗證資料上的準確率後上傳，回傳比較結果
+
+    準確率下降超過 INFERENCE_EXPORT_MAX_ACCURACY_DROP 時不上傳，並刪除之前的 TFLite 模型，
+    evaluate/inference 才不會讀到與 .keras 模型不一致的版本。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): TFLite 模型的 object 名稱
+        model (keras.models.Sequential): 訓練好的模型
+        images (numpy.ndarray): 訓練資料
+        image_header (dict): 訓練資料 artifact 的 JSON header
+        labels (numpy.ndarray): 訓練資料標籤
+        label_header (dict): 訓練資料標籤 artifact 的 JSON header
+        validation_split (float): 訓練時保留給驗證的比例，model.fit 取最後面的資料驗證
+    """
+
+    # 只用沒有參與訓練的驗證資料比較，沒有驗證資料時取最後面的資料
+    samples = min(INFERENCE_EXPORT_CHECK_SAMPLES, max(int(len(images) * validation_split), 1), len(images))
+    check_images = decode_images(images[-samples:], image_header).astype('float32', copy=False)
+    check_labels = np.argmax(decode_labels(labels[-samples:], label_header), axis=1)
+
+    model_content = convert_to_tflite(model, INFERENCE_EXPORT, check_images)
+    keras_accuracy = float(np.mean(np.argmax(model.predict(check_images, batch_size=INFERENCE_EXPORT_BATCH_SIZE,
+                                                           verbose=0), axis=1) == check_labels))
+    tflite_accuracy = float(np.mean(np.argmax(tflite_predict(model_content, check_images), axis=1) == check_labels))
+    result = {
+        "format": "tflite",
+        "quantization": INFERENCE_EXPORT,
+        "object_name": object_name,
+        "bytes": 0,
+        "samples": samples,
+        "keras_accuracy": keras_accuracy,
+        "tflite_accuracy": tflite_accuracy,
+        "accuracy_drop": keras_accuracy - tflite_accuracy,
+    }
+    print(f"TFLite {INFERENCE_EXPORT} model: {len(model_content)} bytes, accuracy {tflite_accuracy:.4f} "
+          f"(keras {keras_accuracy:.4f}) on {samples} validation samples")
+
+    try:
+        if result["accuracy_drop"] > INFERENCE_EXPORT_MAX_ACCURACY_DROP:
+            print(f"TFLite model accuracy drop {result['accuracy_drop']:.4f} exceeds "
+                  f"{INFERENCE_EXPORT_MAX_ACCURACY_DROP}, {object_name} not uploaded")
+            client.remove_object(bucket_name, object_name)
+            return result
+
+        client.put_object(bucket_name=bucket_name,
+                          object_name=object_name,
+                          data=io.BytesIO(model_content),
+                          length=len(model_content))
+    except S3Error as err:
+        print(f"upload TFLite model {object_name} to MinIO bucket {bucket_name} occurs error. Error: {err}")
+        return result
+
+    result["bytes"] = len(model_content)
+    return result
+
+
+def convert_to_tflite(model, quantization: str, representative_images=None):
+    """將模型轉換成 TFLite 模型
+
+    float16 只將參數存成 float16；int8 以 representative_images 校正 activation 的範圍，
+    參數與運算都量化成 int8，輸入與輸出仍然是 float32。
+
+    Args:
+        model (keras.models.Sequential): 訓練好的模型
+        quantization (str): "float16" 或 "int8"
+        representative_images (numpy.ndarray): int8 量化時用來校正的影像
+    """
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        calibration = representative_images[:INFERENCE_EXPORT_BATCH_SIZE]
+        converter.representative_dataset = lambda: ([image[np.newaxis]] for image in calibration)
+    else:
+        raise ValueError(f"unsupported inference_export {quantization}, expected float16 or int8")
+    return converter.convert()
+
+
+def tflite_predict(model_content: bytes, images):
+    """以 TFLite interpreter 預測
+
+    Args:
+        model_content (bytes): TFLite 模型
+        images (numpy.ndarray): 標準化後的影像
+    """
+
+    interpreter = load_tflite_interpreter(model_content)
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    outputs = []
+    batch_size = 0
+    for start in range(0, len(images), INFERENCE_EXPORT_BATCH_SIZE):
+        batch = images[start:start + INFERENCE_EXPORT_BATCH_SIZE]
+        if len(batch) != batch_size:
+            batch_size = len(batch)
+            interpreter.resize_tensor_input(input_index, [batch_size, *batch.shape[1:]])
+            interpreter.allocate_tensors()
+        interpreter.set_tensor(input_index, batch)
+        interpreter.invoke()
+        outputs.append(interpreter.get_tensor(output_index))
+    return np.concatenate(outputs)
+
+
+def load_tflite_interpreter(model_content: bytes):
+    """建立 TFLite interpreter，優先使用 LiteRT，沒有安裝時使用 TensorFlow 內建的 interpreter
+
+    Args:
+        model_content (bytes): TFLite 模型
+    """
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_content=model_content)
+
+
 def save_trained_model(model, filename: str):
     """儲存訓練好的模型
 
@@ -170,19 +768,960 @@ def save_trained_model(model, filename: str):
     model.save(filename)
 
 
+class ArtifactSequence(PyDataset):
+    """依照 artifact header 逐 batch 還原標準化資料與 onehot encoding 的資料集
+
+    compact artifact 只存 uint8 像素與類別索引，在這裡才轉成 float32 與 onehot，
+    所以記憶體中只會多出一個 batch 的解碼結果。
+    """
+
+    def __init__(self, images, image_header: dict, labels=None, label_header: dict = None,
+                 batch_size: int = 300, indices=None, shuffle: bool = False, **kwargs):
+        """
+        Args:
+            images (numpy.ndarray): 影像 artifact
+            image_header (dict): 影像 artifact 的 JSON header
+            labels (numpy.ndarray): 標籤 artifact，預測時可以不給
+            label_header (dict): 標籤 artifact 的 JSON header
+            batch_size (int): batch 大小
+            indices (numpy.ndarray): 要使用的樣本索引，預設為全部
+            shuffle (bool): 是否在每個 epoch 結束時打亂順序
+        """
+
+        super().__init__(**kwargs)
+        self.images = images
+        self.image_header = image_header
+        self.labels = labels
+        self.label_header = label_header or {}
+        self.batch_size = batch_size
+        self.indices = np.arange(len(images)) if indices is None else np.asarray(indices)
+        self.shuffle = shuffle
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __getitem__(self, index):
+        # 排序後再取值，讓讀取的記憶體位置盡量連續
+        batch = np.sort(self.indices[index * self.batch_size:(index + 1) * self.batch_size])
+        x = decode_images(self.images[batch], self.image_header)
+        if self.labels is None:
+            return x
+        return x, decode_labels(self.labels[batch], self.label_header)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
+def is_compact_artifact(header: dict):
+    """判斷 artifact 是否為 compact (需要在 input pipeline 中解碼) 格式
+
+    Args:
+        header (dict): artifact 的 JSON header
+    """
+
+    return "scale" in header or "num_classes" in header
+
+
+def decode_images(data, header: dict):
+    """將影像 artifact 還原成標準化後的 float32 資料
+
+    Args:
+        data (numpy.ndarray): 影像資料
+        header (dict): 影像 artifact 的 JSON header
+    """
+
+    scale = header.get("scale")
+    if scale is None:
+        return np.asarray(data)
+
+    images = data.astype('float32')
+    images /= scale
+    return images
+
+
+def decode_labels(data, header: dict):
+    """將標籤 artifact 還原成 onehot encoding
+
+    Args:
+        data (numpy.ndarray): 標籤資料
+        header (dict): 標籤 artifact 的 JSON header
+    """
+
+    num_classes = header.get("num_classes")
+    if num_classes is None:
+        return np.asarray(data)
+
+    return np.eye(num_classes, dtype='float32')[data]
+
+
+class TransferManager:
+    """所有階段共用的 MinIO 傳輸管理
+
+    以有上限的 thread pool 同時進行多個 object 的傳輸，大型 object 再切成多個 part 平行傳輸，
+    並記錄每個 object 的傳輸速度。
+    """
+
+    def __init__(self, client, max_workers: int = TRANSFER_MAX_WORKERS, part_size: int = ARTIFACT_PART_SIZE):
+        """
+        Args:
+            client: MinIO Client instance
+            max_workers (int): 同時進行的傳輸數量上限
+            part_size (int): 大型 object 切分的 part 大小
+        """
+
+        self.client = client
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.throughputs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown(wait=True)
+
+    def report(self, bucket_name: str, object_name: str, size: int, elapsed: float):
+        """記錄並印出單一 object 的傳輸速度
+
+        Args:
+            bucket_name (str): MinIO Bucket 名稱
+            object_name (str): object 名稱
+            size (int): 傳輸的位元組數
+            elapsed (float): 傳輸花費的秒數
+        """
+
+        throughput = size / elapsed / (1024 * 1024) if elapsed > 0 else float("inf")
+        with self.lock:
+            self.throughputs[f"{bucket_name}/{object_name}"] = throughput
+        print(f"[Transfer] {bucket_name}/{object_name}: {size / (1024 * 1024):.1f} MiB "
+              f"in {elapsed:.2f}s ({throughput:.1f} MiB/s)")
+
+    def download_artifacts(self, artifacts: list, shard: tuple = None):
+        """同時下載多個 artifact
+
+        先平行取得所有 JSON header 並預先配置 numpy.ndarray，再將每個 object 切成多個 ranged GET，
+        全部的 part 共用同一個 thread pool，所以總傳輸時間大約等於最大的單一 object。
+        header 有 shard index 時，下載後平行驗證每個 shard 的校驗碼。
+
+        Args:
+            artifacts (list): (bucket_name, filename) 的 list
+            shard (tuple): (shard index, shard 數量)，只下載第一個維度中屬於這個 shard 的連續資料
+        """
+
+        headers = list(self.executor.map(
+            lambda artifact: get_json_from_bucket(self.client, artifact[0], artifact_header_filename(artifact[1])),
+            artifacts))
+
+        transfers = []
+        futures = []
+        for (bucket_name, filename), header in zip(artifacts, headers):
+            shape = list(header["shape"])
+            dtype = np.dtype(header["dtype"])
+            start, stop, shards = select_shards(header, shard)
+            if (start, stop) != (0, shape[0]):
+                header = dict(header, shard_rows=[start, stop])
+            # 以 C order 儲存的資料中，第一個維度的連續範圍就是 object 中的連續位元組
+            data_offset = header["data_offset"] + start * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+            shape[0] = stop - start
+
+            transfer = {
+                "bucket_name": bucket_name,
+                "filename": filename,
+                "header": header,
+                "shards": shards,
+                "data_offset": data_offset,
+                "data": np.empty(shape, dtype=dtype),
+                "preamble": bytearray(header["data_offset"]),
+                "started": time.perf_counter(),
+                "finished": None,
+            }
+            transfers.append(transfer)
+
+            parts = [(0, memoryview(transfer["preamble"]))]
+            view = memoryview(transfer["data"]).cast('B')
+            for start in range(0, view.nbytes, self.part_size):
+                parts.append((data_offset + start, view[start:start + self.part_size]))
+
+            for offset, buffer in parts:
+                future = self.executor.submit(self._get_range, bucket_name, filename, offset, buffer)
+                future.add_done_callback(lambda _, transfer=transfer: self._mark_finished(transfer))
+                futures.append(future)
+
+        for future in futures:
+            future.result()
+
+        results = []
+        for transfer in transfers:
+            header = transfer["header"]
+            filename = transfer["filename"]
+            check_npy_preamble(bytes(transfer["preamble"]), header, filename)
+
+            if transfer["shards"] is not None:
+                self.verify_shards(transfer)
+            elif "shard_rows" not in header:
+                digest = hashlib.sha256(transfer["preamble"])
+                digest.update(memoryview(transfer["data"]).cast('B'))
+                checksum = digest.hexdigest()
+                if checksum != header["sha256"]:
+                    raise ValueError(
+                        f"artifact {filename} checksum mismatch, expected {header['sha256']} but got {checksum}"
+                    )
+            # 沒有 shard index 的舊 artifact 只下載部分資料時，無法以整個 object 的校驗碼驗證
+
+            self.report(transfer["bucket_name"], filename, transfer["data"].nbytes,
+                        transfer["finished"] - transfer["started"])
+            results.append((transfer["data"], header))
+
+        return results
+
+    def verify_shards(self, transfer: dict):
+        """平行驗證下載的每個 shard 的校驗碼
+
+        Args:
+            transfer (dict): download_artifacts 中單一 artifact 的傳輸狀態
+        """
+
+        view = memoryview(transfer["data"]).cast('B')
+
+        def verify(shard: dict):
+            begin = shard["offset"] - transfer["data_offset"]
+            checksum = hashlib.sha256(view[begin:begin + shard["length"]]).hexdigest()
+            if checksum != shard["sha256"]:
+                raise ValueError(
+                    f"artifact {transfer['filename']} shard [{shard['start']}, {shard['stop']}) checksum mismatch, "
+                    f"expected {shard['sha256']} but got {checksum}"
+                )
+
+        list(self.executor.map(verify, transfer["shards"]))
+
+    def _get_range(self, bucket_name: str, object_name: str, offset: int, buffer):
+        if not buffer.nbytes:
+            return
+
+        response = self.client.get_object(bucket_name, object_name, offset=offset, length=buffer.nbytes)
+        try:
+            read_exactly(response, buffer)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _mark_finished(self, transfer: dict):
+        with self.lock:
+            transfer["finished"] = time.perf_counter()
+
+
+class RunReport:
+    """記錄單次 pipeline 執行中本階段各 phase 的耗時、peak RSS 與傳輸量
+
+    每個 phase 同時更新 Prometheus metrics，執行結束後整份報告以 JSON 寫入 MinIO。
+    """
+
+    def __init__(self, run_id: str, worker_index: int = 0, num_workers: int = 1):
+        """
+        Args:
+            run_id (str): pipeline 執行的 run ID
+            worker_index (int): 多 worker 訓練時的 worker 編號
+            num_workers (int): 多 worker 訓練的 worker 數量
+        """
+
+        self.run_id = run_id
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+        self.started_at = time.time()
+        self.phases = []
+        self.cold_start = is_cold_start()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """量測一個 phase，可以在 with 區塊內設定 record["bytes"] 記錄傳輸量
+
+        Args:
+            name (str): phase 名稱
+        """
+
+        record = {"phase": name, "bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            record["peak_rss_bytes"] = peak_rss_bytes()
+            self.record(record)
+
+    def record(self, record: dict):
+        """加入一筆 phase 紀錄並更新 Prometheus metrics
+
+        Args:
+            record (dict): 包含 phase、seconds、bytes、peak_rss_bytes 的紀錄
+        """
+
+        self.phases.append(record)
+        PHASE_SECONDS.labels(STAGE_NAME, record["phase"]).observe(record["seconds"])
+        PHASE_BYTES.labels(STAGE_NAME, record["phase"]).inc(record["bytes"])
+        PHASE_PEAK_RSS_BYTES.labels(STAGE_NAME, record["phase"]).set(record["peak_rss_bytes"])
+        print(f"[Phase] {record['phase']}: {record['seconds']:.2f}s, {record['bytes']} bytes, "
+              f"peak RSS {record['peak_rss_bytes'] / (1024 * 1024):.1f} MiB")
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "stage": STAGE_NAME,
+            "worker_index": self.worker_index,
+            "num_workers": self.num_workers,
+            "started_at": self.started_at,
+            "seconds": time.time() - self.started_at,
+            "peak_rss_bytes": peak_rss_bytes(),
+            "cold_start": self.cold_start,
+            "phases": self.phases,
+        }
+
+
+class EpochReportCallback(Callback):
+    """將 model.fit 每個 epoch 的耗時與指標記錄到 RunReport"""
+
+    def __init__(self, report: RunReport):
+        """
+        Args:
+            report (RunReport): 本階段的 run report
+        """
+
+        super().__init__()
+        self.report = report
+        self.epoch_started = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_started = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.report.record({
+            "phase": "fit_epoch",
+            "epoch": epoch + 1,
+            "bytes": 0,
+            "seconds": time.perf_counter() - self.epoch_started,
+            "peak_rss_bytes": peak_rss_bytes(),
+            **{name: float(value) for name, value in (logs or {}).items()},
+        })
+
+
+class ParameterAveragingCallback(Callback):
+    """多 worker 訓練時，透過 MinIO 同步每個 worker 的模型參數
+
+    訓練開始前所有 worker 採用 worker 0 的初始參數，每個 epoch 結束後各自上傳參數，
+    等待所有 worker 到齊，再依照各 worker 的資料筆數加權平均。
+    """
+
+    def __init__(self, client, bucket_name: str, run_id: str, worker_index: int, num_workers: int, samples: int):
+        """
+        Args:
+            client: MinIO Client instance
+            bucket_name (str): 交換參數用的 MinIO Bucket 名稱
+            run_id (str): pipeline 執行的 run ID
+            worker_index (int): worker 編號
+            num_workers (int): worker 數量
+            samples (int): 本 worker 的訓練資料筆數
+        """
+
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.run_id = run_id
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+        self.samples = samples
+        self.previous_object = None
+
+    def on_train_begin(self, logs=None):
+        initial = self.round_prefix("initial")
+        if self.worker_index == 0:
+            self.put_weights(f"{initial}worker-0.npz", self.model.get_weights())
+        weights, _ = self.get_weights(self.wait_for_round(initial, 1)[0])
+        self.model.set_weights(weights)
+
+    def on_epoch_end(self, epoch, logs=None):
+        prefix = self.round_prefix(f"epoch-{epoch + 1}")
+        object_name = f"{prefix}worker-{self.worker_index}.npz"
+        self.put_weights(object_name, self.model.get_weights())
+
+        total_samples = 0
+        averaged = None
+        for name in self.wait_for_round(prefix, self.num_workers):
+            weights, samples = self.get_weights(name)
+            total_samples += samples
+            if averaged is None:
+                averaged = [w * samples for w in weights]
+            else:
+                for total, w in zip(averaged, weights):
+                    total += w * samples
+        self.model.set_weights([total / total_samples for total in averaged])
+
+        # 所有 worker 都已經上傳這一輪的參數，代表上一輪的參數已經沒有人需要讀取
+        if self.previous_object is not None:
+            self.client.remove_object(self.bucket_name, self.previous_object)
+        self.previous_object = object_name
+
+    def round_prefix(self, name: str):
+        return f"{DISTRIBUTED_PREFIX}/{self.run_id}/{name}/"
+
+    def put_weights(self, object_name: str, weights: list):
+        buffer = io.BytesIO()
+        np.savez(buffer, *weights, samples=np.int64(self.samples))
+        length = buffer.tell()
+        buffer.seek(0)
+        self.client.put_object(bucket_name=self.bucket_name,
+                               object_name=object_name,
+                               data=buffer,
+                               length=length)
+
+    def get_weights(self, object_name: str):
+        response = self.client.get_object(self.bucket_name, object_name)
+        try:
+            with np.load(io.BytesIO(response.read())) as archive:
+                weights = [archive[f"arr_{i}"] for i in range(len(archive.files) - 1)]
+                return weights, int(archive["samples"])
+        finally:
+            response.close()
+            response.release_conn()
+
+    def wait_for_round(self, prefix: str, expected: int):
+        """等待指定數量的 worker 上傳參數，回傳 object 名稱
+
+        Args:
+            prefix (str): 這一輪參數的 object prefix
+            expected (int): 要等待的 worker 數量
+        """
+
+        deadline = time.monotonic() + DISTRIBUTED_SYNC_TIMEOUT_SECONDS
+        while True:
+            names = sorted(obj.object_name for obj in self.client.list_objects(self.bucket_name, prefix=prefix))
+            if len(names) >= expected:
+                return names
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"worker {self.worker_index} waited {DISTRIBUTED_SYNC_TIMEOUT_SECONDS}s for "
+                                   f"{prefix}, only {len(names)}/{expected} workers arrived")
+            time.sleep(DISTRIBUTED_POLL_SECONDS)
+
+
+class CheckpointCallback(Callback):
+    """每隔固定的 epoch 或 batch 將模型參數與 optimizer 狀態寫入 MinIO，並在訓練開始時還原 checkpoint
+
+    在 callback 中只複製一份參數，序列化與上傳在背景 thread 進行，不會卡住 model.fit；
+    上一個 checkpoint 還沒上傳完時跳過這一次，所以最多只有一個 checkpoint 在上傳。
+    """
+
+    def __init__(self, client, bucket_name: str, run_id: str, every_epochs: int = 1, every_batches: int = 0,
+                 checkpoint: dict = None):
+        """
+        Args:
+            client: MinIO Client instance
+            bucket_name (str): 儲存 checkpoint 的 MinIO Bucket 名稱
+            run_id (str): pipeline 執行的 run ID
+            every_epochs (int): 每幾個 epoch 寫入一次，0 表示不依照 epoch 寫入
+            every_batches (int): 每幾個 batch 寫入一次，0 表示不依照 batch 寫入
+            checkpoint (dict): load_checkpoint 取得的 checkpoint，訓練開始時還原
+        """
+
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.run_id = run_id
+        self.every_epochs = every_epochs
+        self.every_batches = every_batches
+        self.checkpoint = checkpoint
+        self.epoch = checkpoint["epoch"] if checkpoint else 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.previous_object = checkpoint["object_name"] if checkpoint else None
+        self.saved_epoch = self.epoch
+        self.completed_epoch = self.epoch
+
+    def on_train_begin(self, logs=None):
+        if self.checkpoint is None:
+            return
+
+        optimizer = self.model.optimizer
+        if not optimizer.built:
+            optimizer.build(self.model.trainable_variables)
+        if len(self.checkpoint["optimizer"]) != len(optimizer.variables):
+            raise ValueError(f"checkpoint {self.checkpoint['object_name']} does not match the optimizer, "
+                             f"expected {len(optimizer.variables)} variables but got {len(self.checkpoint['optimizer'])}")
+        self.model.set_weights(self.checkpoint["weights"])
+        for variable, value in zip(optimizer.variables, self.checkpoint["optimizer"]):
+            variable.assign(value)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.every_batches and (batch + 1) % self.every_batches == 0:
+            self.save(self.epoch, batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.completed_epoch = epoch + 1
+        if self.every_epochs and (epoch + 1) % self.every_epochs == 0:
+            self.save(epoch + 1, 0)
+
+    def on_train_end(self, logs=None):
+        if self.pending is not None:
+            self.pending.result()
+        # 最後一個 epoch 的 checkpoint 可能因為上一個還在上傳而被跳過，結束前補上，
+        # 之後以更多 epoch 接續訓練時 (例如 sweep 的下一輪) 才會從最後一個 epoch 開始
+        if self.every_epochs and self.completed_epoch > self.saved_epoch:
+            self.save(self.completed_epoch, 0)
+            self.pending.result()
+        self.executor.shutdown(wait=True)
+
+    def save(self, epoch: int, batch: int):
+        """複製目前的參數與 optimizer 狀態，在背景上傳
+
+        Args:
+            epoch (int): 已經完成的 epoch 數
+            batch (int): 目前 epoch 中已經完成的 batch 數
+        """
+
+        if self.pending is not None and not self.pending.done():
+            print(f"checkpoint at epoch {epoch} batch {batch} skipped, previous checkpoint still uploading")
+            return
+
+        weights = self.model.get_weights()
+        optimizer = [np.array(variable) for variable in self.model.optimizer.variables]
+        self.saved_epoch = epoch
+        self.pending = self.executor.submit(self.upload, epoch, batch, weights, optimizer)
+
+    def upload(self, epoch: int, batch: int, weights: list, optimizer: list):
+        prefix = checkpoint_prefix(self.run_id)
+        object_name = f"{prefix}epoch-{epoch:04d}-batch-{batch:06d}.npz"
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 **{f"weight_{i}": value for i, value in enumerate(weights)},
+                 **{f"optimizer_{i}": value for i, value in enumerate(optimizer)})
+        length = buffer.tell()
+        buffer.seek(0)
+
+        try:
+            self.client.put_object(bucket_name=self.bucket_name,
+                                   object_name=object_name,
+                                   data=buffer,
+                                   length=length)
+            # 資料上傳完成後才更新 latest.json，重新執行時不會讀到不完整的 checkpoint
+            put_json_to_bucket(self.client, self.bucket_name, f"{prefix}latest.json", {
+                "object_name": object_name,
+                "epoch": epoch,
+                "batch": batch,
+                "weights": len(weights),
+                "optimizer": len(optimizer),
+            })
+            if self.previous_object is not None and self.previous_object != object_name:
+                self.client.remove_object(self.bucket_name, self.previous_object)
+        except S3Error as err:
+            print(f"upload checkpoint {object_name} to MinIO bucket {self.bucket_name} occurs error. Error: {err}")
+            return
+
+        self.previous_object = object_name
+        print(f"checkpoint at epoch {epoch} batch {batch} uploaded ({length} bytes)")
+
+
+def checkpoint_prefix(run_id: str):
+    """取得 run 的 checkpoint object prefix
+
+    Args:
+        run_id (str): pipeline 執行的 run ID
+    """
+
+    return f"{CHECKPOINT_PREFIX}/{run_id}/"
+
+
+def load_checkpoint(client, bucket_name: str, run_id: str):
+    """取得 run 最新的 checkpoint，沒有的話回傳 None
+
+    batch 不為 0 時表示 checkpoint 在 epoch 中途寫入，接續訓練時該 epoch 會從頭開始，
+    但參數已經包含前面 batch 的更新。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): 儲存 checkpoint 的 MinIO Bucket 名稱
+        run_id (str): pipeline 執行的 run ID
+    """
+
+    prefix = checkpoint_prefix(run_id)
+    try:
+        latest = get_json_from_bucket(client, bucket_name, f"{prefix}latest.json")
+        response = client.get_object(bucket_name, latest["object_name"])
+        try:
+            body = response.read()
+        finally:
+            response.close()
+            response.release_conn()
+    except S3Error as err:
+        if err.code != "NoSuchKey":
+            print(f"load checkpoint of run {run_id} occurs error. Error: {err}")
+        return None
+
+    with np.load(io.BytesIO(body)) as archive:
+        weights = [archive[f"weight_{i}"] for i in range(latest["weights"])]
+        optimizer = [archive[f"optimizer_{i}"] for i in range(latest["optimizer"])]
+    return dict(latest, weights=weights, optimizer=optimizer, bytes=len(body))
+
+
+def load_segment_manifest(client, bucket_name: str):
+    """讀取 mnist-preprocess 的所有 segment 紀錄，依照建立時間排序組成 manifest，還沒有任何 segment 時回傳空的 manifest
+
+    與 mnist-preprocess 相同，包含已經被較早的 segment 加入過的 object 的 segment 整個忽略。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): segment 紀錄所在的 MinIO Bucket 名稱
+    """
+
+    if not client.bucket_exists(bucket_name):
+        return {"segments": []}
+
+    entries = [
+        get_json_from_bucket(client, bucket_name, obj.object_name)
+        for obj in client.list_objects(bucket_name, prefix=SEGMENT_ENTRY_PREFIX, recursive=True)
+        if obj.object_name.endswith(".json")
+    ]
+    segments, ingested = [], set()
+    for entry in sorted(entries, key=lambda entry: (entry["created_at"], entry["segment"])):
+        if ingested.isdisjoint(entry["objects"]):
+            segments.append(entry)
+            ingested.update(entry["objects"])
+    return {"segments": segments}
+
+
+def load_previous_model(client, bucket_name: str, record: dict = None):
+    """取得上一次訓練的模型與訓練設定，回傳 (模型, 訓練設定)，沒有的話回傳 None
+
+    沒有訓練設定時無法得知模型訓練過哪些 segment，也視為沒有上一次的模型。
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): 儲存模型的 MinIO Bucket 名稱
+        record (dict): RunReport 的 phase 紀錄，用來記錄下載的位元組數
+    """
+
+    try:
+        settings = get_json_from_bucket(client, bucket_name, TRAINED_MODEL_SETTINGS_FILENAME)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, TRAINED_MODEL_KERAS_FILENAME)
+            response = client.get_object(bucket_name, TRAINED_MODEL_KERAS_FILENAME)
+            try:
+                with open(file_path, 'wb') as f:
+                    for chunk in response.stream(ARTIFACT_CHUNK_SIZE):
+                        f.write(chunk)
+            finally:
+                response.close()
+                response.release_conn()
+
+            if record is not None:
+                record["bytes"] = os.path.getsize(file_path)
+            return load_model(file_path), settings
+    except S3Error as err:
+        if err.code != "NoSuchKey":
+            print(f"load previous model from MinIO bucket {bucket_name} occurs error. Error: {err}")
+        return None
+
+
+def delete_checkpoints(client, bucket_name: str, run_id: str):
+    """刪除 run 的所有 checkpoint
+
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): 儲存 checkpoint 的 MinIO Bucket 名稱
+        run_id (str): pipeline 執行的 run ID
+    """
+
+    try:
+        for obj in client.list_objects(bucket_name, prefix=checkpoint_prefix(run_id), recursive=True):
+            client.remove_object(bucket_name, obj.object_name)
+    except S3Error as err:
+        print(f"delete checkpoints of run {run_id} occurs error. Error: {err}")
+
+
+def is_cold_start():
+    """是否為 process 啟動後的第一個請求，只有第一次呼叫回傳 True"""
+
+    global COLD_START
+    with COLD_START_LOCK:
+        cold_start, COLD_START = COLD_START, False
+    return cold_start
+
+
+def peak_rss_bytes():
+    """取得目前 process 的 peak RSS (bytes)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def start_metrics_server():
+    """啟動 Prometheus metrics HTTP server，每個 process 只會啟動一次"""
+
+    global METRICS_SERVER_STARTED
+    with METRICS_LOCK:
+        if METRICS_SERVER_STARTED:
+            return
+        try:
+            start_http_server(METRICS_PORT, registry=METRICS_REGISTRY)
+            METRICS_SERVER_STARTED = True
+        except OSError as err:
+            print(f"start metrics server on port {METRICS_PORT} occurs error. Error: {err}")
+
+
+def get_run_id(req):
+    """從 request body 取得 run ID，沒有的話就產生新的 run ID
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and data.get("run_id"):
+        return str(data["run_id"])
+    return uuid.uuid4().hex
+
+
+def get_worker(req):
+    """從 request body 取得多 worker 訓練的 worker 編號與 worker 數量，不是整數或超出範圍時 raise ValueError
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    num_workers = max(int(data.get("num_workers", 1)), 1)
+    worker_index = int(data.get("worker_index", 0))
+    if not 0 <= worker_index < num_workers:
+        raise ValueError(f"worker_index {worker_index} out of range for {num_workers} workers")
+    return worker_index, num_workers
+
+
+def get_sweep_trial(req):
+    """從 request body 取得 hyperparameter sweep 的 trial 名稱 ("<sweep ID>/<trial>")，不是 sweep 時回傳 None
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and data.get("sweep_trial"):
+        return str(data["sweep_trial"]).strip("/")
+    return None
+
+
+def shard_rows(rows: int, shard_index: int, num_shards: int):
+    """計算 shard 在第一個維度上的 [start, stop) 範圍，各 shard 筆數最多相差 1
+
+    Args:
+        rows (int): 資料筆數
+        shard_index (int): shard 編號
+        num_shards (int): shard 數量
+    """
+
+    return rows * shard_index // num_shards, rows * (shard_index + 1) // num_shards
+
+
+def select_shards(header: dict, shard: tuple = None):
+    """依照 header 的 shard index 選出要下載的資料範圍，回傳 (start, stop, shard index 的 list)
+
+    多 worker 時以整個 shard 為單位分配，才能逐一驗證校驗碼；沒有 shard index 的舊 artifact
+    或 shard 數量比 worker 少時改為依照筆數切分，這時不回傳 shard index。
+
+    Args:
+        header (dict): artifact 的 JSON header
+        shard (tuple): (shard index, shard 數量)，None 表示下載全部資料
+    """
+
+    rows = header["shape"][0]
+    shards = header.get("shards")
+    if shard is None:
+        return 0, rows, shards
+
+    if shards and len(shards) >= shard[1]:
+        first, last = shard_rows(len(shards), *shard)
+        selected = shards[first:last]
+        return selected[0]["start"], selected[-1]["stop"], selected
+
+    start, stop = shard_rows(rows, *shard)
+    return start, stop, None
+
+
+def training_artifacts(segments: list = None, base: bool = True):
+    """取得訓練資料 artifact 的 (bucket_name, filename) list，依序為影像與標籤
+
+    Args:
+        segments (list[dict]): 要一起訓練的 segment，來自 segment manifest
+        base (bool): 是否包含 mnist-preprocess 輸出的原本訓練資料
+    """
+
+    artifacts = []
+    if base:
+        artifacts += [("mnist-normalize", X_TRAIN4D_NORMALIZE_NPY_FILENAME),
+                      ("mnist-onehot-encoding", Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME)]
+    for segment in segments or []:
+        artifacts += [("mnist-normalize", f"{segment['prefix']}{X_TRAIN4D_NORMALIZE_NPY_FILENAME}"),
+                      ("mnist-onehot-encoding", f"{segment['prefix']}{Y_TRAIN_ONE_HOT_ENCODING_NPY_FILENAME}")]
+    return artifacts
+
+
+def concat_artifacts(parts: list):
+    """將下載的多個 artifact 依序接成一個，回傳 (numpy.ndarray, header)
+
+    解碼資訊都相同時直接接在一起，compact artifact 仍然維持 uint8；
+    否則 (例如 segment 與原本的資料 compact_artifacts 設定不同) 先各自解碼成 float32。
+
+    Args:
+        parts (list): download_artifacts 回傳的 (numpy.ndarray, header) list
+    """
+
+    if len(parts) == 1:
+        return parts[0]
+
+    headers = [header for _, header in parts]
+    if len({(header["dtype"], header.get("scale"), header.get("num_classes")) for header in headers}) == 1:
+        data = np.concatenate([data for data, _ in parts])
+        header = {name: value for name, value in headers[0].items() if name in ("dtype", "scale", "num_classes", "labels")}
+    else:
+        data = np.concatenate([decode_labels(data, header) if header.get("labels") else decode_images(data, header)
+                               for data, header in parts])
+        header = {"dtype": data.dtype.str, "labels": headers[0].get("labels", False)}
+    header["shape"] = list(data.shape)
+    return data, header
+
+
+def download_finetune_data(transfer_manager, new_segments: list, old_segments: list, replay_ratio: float = REPLAY_RATIO):
+    """下載微調用的資料，回傳打亂順序後的 ((影像, header), (標籤, header), 回放的筆數)
+
+    除了還沒訓練過的 segment 之外，另外從已經訓練過的資料 (原本的訓練資料與舊的 segment) 依照筆數比例
+    各自隨機取出連續的一段回放，避免模型忘記舊資料。回放以 ranged GET 下載，不會讀取整個 artifact。
+
+    Args:
+        transfer_manager (TransferManager): 下載使用的 TransferManager
+        new_segments (list[dict]): 還沒訓練過的 segment
+        old_segments (list[dict]): 已經訓練過的 segment
+        replay_ratio (float): 回放筆數與新資料筆數的比例
+    """
+
+    parts = transfer_manager.download_artifacts(training_artifacts(new_segments, base=False))
+    new_rows = sum(len(data) for data, _ in parts[0::2])
+
+    base_header = get_json_from_bucket(transfer_manager.client, "mnist-normalize",
+                                       artifact_header_filename(X_TRAIN4D_NORMALIZE_NPY_FILENAME))
+    sources = [(training_artifacts(), base_header["shape"][0])] + \
+        [(training_artifacts([segment], base=False), segment["rows"]) for segment in old_segments]
+    old_rows = sum(rows for _, rows in sources)
+    replay_rows = min(int(new_rows * replay_ratio), old_rows)
+
+    rng = np.random.default_rng()
+    for artifacts, rows in sources:
+        share = round(replay_rows * rows / old_rows) if old_rows else 0
+        if not share:
+            continue
+        # 將 artifact 切成每段至少 share 筆，隨機下載其中一段
+        num_shards = max(rows // share, 1)
+        parts += transfer_manager.download_artifacts(artifacts, shard=(int(rng.integers(num_shards)), num_shards))
+
+    (images, image_header), (labels, label_header) = concat_artifacts(parts[0::2]), concat_artifacts(parts[1::2])
+    # validation_split 取最後的資料作為驗證資料，打亂順序讓新資料與回放的資料都有
+    order = rng.permutation(len(images))
+    return (images[order], image_header), (labels[order], label_header), len(images) - new_rows
+
+
+def is_scheduled(req):
+    """是否由 mnist-faas-trigger 的 pipeline scheduler 呼叫，是的話由 scheduler 觸發之後的階段
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    return isinstance(data, dict) and data.get("scheduled") is True
+
+
+def is_incremental(req):
+    """是否以新的 segment 微調上一次的模型，request body 的 "incremental" 優先於 incremental 環境變數
+
+    Args:
+        req (str): request body
+    """
+
+    try:
+        data = json.loads(req) if req else {}
+    except ValueError:
+        data = {}
+    if isinstance(data, dict) and isinstance(data.get("incremental"), bool):
+        return data["incremental"]
+    return os.environ.get("incremental", "false") == "true"
+
+
+def write_run_report(client, report: RunReport):
+    """將本階段的 run report 以 JSON 寫入 MinIO
+
+    Args:
+        client: MinIO Client instance
+        report (RunReport): 本階段的 run report
+    """
+
+    try:
+        create_buckets(client, [RUN_REPORT_BUCKET_NAME])
+        # worker 0 沿用原本的 report 名稱，其他 worker 各自一份
+        report_name = STAGE_NAME if report.worker_index == 0 else f"{STAGE_NAME}-worker-{report.worker_index}"
+        put_json_to_bucket(client, RUN_REPORT_BUCKET_NAME, f"{report.run_id}/{report_name}.json", report.to_dict())
+    except S3Error as err:
+        print(f"write run report {report.run_id} occurs error. Error: {err}")
+
+
 def connect_minio():
-    """連接 MinIO Server"""
+    """取得 process 共用的 MinIO client，第一次呼叫時才建立
+
+    warm container 的請求之間重複使用同一個 urllib3 connection pool 的 keep-alive 連線，
+    pool 的連線數量不少於平行傳輸的 thread 數量，連線才不會用完就被丟棄。
+    """
+
+    global MINIO_CLIENT
+    with MINIO_CLIENT_LOCK:
+        if MINIO_CLIENT is None:
+            MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
+            MINIO_ACCESS_KEY = os.environ["minio_access_key"]
+            MINIO_SECRET_KEY = os.environ["minio_secret_key"]
 
-    MINIO_API_ENDPOINT = os.environ["minio_api_endpoint"]
-    MINIO_ACCESS_KEY = os.environ["minio_access_key"]
-    MINIO_SECRET_KEY = os.environ["minio_secret_key"]
+            http_client = PoolManager(
+                maxsize=max(MINIO_MAX_CONNECTIONS, TRANSFER_MAX_WORKERS),
+                timeout=Timeout(connect=MINIO_CONNECT_TIMEOUT_SECONDS, read=MINIO_READ_TIMEOUT_SECONDS),
+                retries=Retry(total=5, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+            )
+            MINIO_CLIENT = Minio(
+                MINIO_API_ENDPOINT,
+                access_key=MINIO_ACCESS_KEY,
+                secret_key=MINIO_SECRET_KEY,
+                secure=False,
+                http_client=http_client
+            )
+    return MINIO_CLIENT
 
-    return Minio(
-        MINIO_API_ENDPOINT,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=False
-    )
+
+def get_gateway_endpoint():
+    """從環境變數中取得 OpenFaaS gateway endpoint，觸發下一個階段時才讀取"""
+
+    return os.environ["openfaas_gateway_endpoint"]
 
 
 def get_bucket_names():
@@ -200,73 +1739,185 @@ def create_buckets(client, bucket_names: list):
         bucket_names (list): 要建立的 MinIO Bucket 名稱
     """
 
-    for name in bucket_names:
-        if client.bucket_exists(name):
-            print(f"Bucket {name} already exists")
-        else:
-            client.make_bucket(name)
-            print(f"Bucket {name} created")
+    with KNOWN_BUCKETS_LOCK:
+        for name in bucket_names:
+            # warm container 已經確認過的 bucket 不需要再詢問 MinIO
+            if name in KNOWN_BUCKETS:
+                continue
+            if client.bucket_exists(name):
+                print(f"Bucket {name} already exists")
+            else:
+                client.make_bucket(name)
+                print(f"Bucket {name} created")
+            KNOWN_BUCKETS.add(name)
 
 
-def get_file_from_bucket(client, bucket_name: str, object_name: str, file_path: str):
-    """取得 MinIO Bucket 內的資料
+def artifact_header_filename(filename: str):
+    """取得 artifact 對應的 JSON header 檔名
+
+    Args:
+        filename (str): artifact 檔名 (.npy)
+    """
+
+    return f"{os.path.splitext(filename)[0]}.json"
+
+
+def get_json_from_bucket(client, bucket_name: str, object_name: str):
+    """取得 MinIO Bucket 內的 JSON object
 
     Args:
         client: MinIO Client instance
         bucket_name (str): MinIO Bucket 名稱
         object_name (str): 要取得的 object 名稱
-        file_path (str): 下載後的檔案路徑
     """
 
-    client.fget_object(bucket_name, object_name, file_path)
+    response = client.get_object(bucket_name, object_name)
+    try:
+        return json.loads(response.read())
+    finally:
+        response.close()
+        response.release_conn()
 
 
-def upload_file_to_bucket(client, bucket_name: str, object_name: str, file_path: str):
-    """上傳資料到 MinIO Bucket 內
+def put_json_to_bucket(client, bucket_name: str, object_name: str, data: dict):
+    """上傳 JSON object 到 MinIO Bucket 內
 
     Args:
         client: MinIO Client instance
         bucket_name (str): MinIO Bucket 名稱
-        object_name (str): 要上傳到 MinIO Bucket 的 object 檔案名稱
-        file_path (str): 要上傳到 MinIO Bucket 的檔案路徑
+        object_name (str): 要上傳的 object 名稱
+        data (dict): 要上傳的資料
     """
 
-    try:
-        client.fput_object(bucket_name=bucket_name,
-                           object_name=object_name,
-                           file_path=file_path)
-    except S3Error as err:
-        print(
-            f"upload file {file_path} to MinIO bucket {bucket_name} occurs error. Error: {err}"
-        )
+    body = json.dumps(data).encode()
+    client.put_object(bucket_name=bucket_name,
+                      object_name=object_name,
+                      data=io.BytesIO(body),
+                      length=len(body),
+                      content_type="application/json")
+
+
+def read_exactly(stream, buffer):
+    """從 stream 分段讀滿整個 buffer
+
+    Args:
+        stream: 支援 readinto 的 stream，例如 get_object 的 response
+        buffer: 預先配置好的 buffer (bytearray、memoryview 或 C-contiguous 的 numpy.ndarray)
+    """
 
+    view = memoryview(buffer).cast('B')
+    position = 0
+    while position < view.nbytes:
+        size = stream.readinto(view[position:position + ARTIFACT_CHUNK_SIZE])
+        if not size:
+            raise ValueError(f"stream ended after {position} of {view.nbytes} bytes")
+        position += size
 
-def convert_pkl_to_data(filename: str):
-    """將 pkl 檔案轉換回原始資料
+
+def check_npy_preamble(preamble: bytes, header: dict, filename: str):
+    """確認 .npy preamble 與 JSON header 描述的 dtype、shape 一致
 
     Args:
-        filename (str): pkl 檔案名稱
+        preamble (bytes): .npy 檔案開頭的 magic 與 header
+        header (dict): artifact 的 JSON header
+        filename (str): artifact 檔名 (.npy)
     """
 
-    with open(filename, 'rb') as f:
-        data = pickle.load(f)
-    return data
+    stream = io.BytesIO(preamble)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+
+    if fortran_order or dtype.str != header["dtype"] or list(shape) != header["shape"]:
+        raise ValueError(
+            f"artifact {filename} does not match its header, "
+            f"expected {header['dtype']}{header['shape']} but got {dtype.str}{list(shape)}"
+        )
+
+
+def upload_model_to_bucket(client, bucket_name: str, object_name: str, model):
+    """將模型串流上傳到 MinIO Bucket 內，回傳上傳的位元組數
+
+    Keras 只能將模型儲存成檔案，所以模型先寫到暫存目錄後再上傳，不佔用 /home/app。
 
+    Args:
+        client: MinIO Client instance
+        bucket_name (str): MinIO Bucket 名稱
+        object_name (str): 要上傳到 MinIO Bucket 的 object 檔案名稱
+        model (keras.models.Sequential): 訓練好的模型
+    """
 
-def trigger(next_stage: str):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # object 名稱可能包含 prefix，暫存檔只取最後的檔名
+        file_path = os.path.join(tmp_dir, os.path.basename(object_name))
+        save_trained_model(model, file_path)
+        try:
+            with open(file_path, 'rb') as f:
+                client.put_object(bucket_name=bucket_name,
+                                  object_name=object_name,
+                                  data=f,
+                                  length=os.path.getsize(file_path),
+                                  part_size=ARTIFACT_PART_SIZE)
+        except S3Error as err:
+            print(
+                f"upload model {object_name} to MinIO bucket {bucket_name} occurs error. Error: {err}"
+            )
+            return 0
+
+        return os.path.getsize(file_path)
+
+
+def trigger(next_stage: str, run_id: str = None):
     """觸發下一個階段
 
     Args:
         next_stage (str): 下一個階段的名稱
+        run_id (str): pipeline 執行的 run ID
     """
 
     req_body = {
         "next_stage": next_stage
     }
-    _ = requests.post(
-        f"http://{OPENFAAS_GATEWAY_ENDPOINT}/function/mnist-faas-trigger",
-        json=req_body
-    )
+    if run_id is not None:
+        req_body["run_id"] = run_id
+
+    try:
+        resp = get_http_session().post(
+            f"http://{get_gateway_endpoint()}/function/mnist-faas-trigger",
+            json=req_body,
+            timeout=TRIGGER_TIMEOUT_SECONDS
+        )
+        resp.raise_for_status()
+    except requests.RequestException as err:
+        print(f"trigger {next_stage} occurs error. Error: {err}")
+        return False
+    return True
+
+
+def get_http_session():
+    """取得共用的 HTTP session，重複使用與 gateway 之間的連線
+
+    連線失敗或 gateway 回應 429、503 時，以 exponential backoff 重試
+    """
+
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is None:
+            # 只在請求沒有送到下一個階段時重試：連線錯誤、429 與 503
+            # read timeout 與 502 時下一個階段可能已經在執行，重試會讓它執行兩次
+            retry = Retry(total=TRIGGER_MAX_RETRIES, read=0,
+                          backoff_factor=TRIGGER_BACKOFF_SECONDS,
+                          status_forcelist=(429, 503),
+                          allowed_methods=None,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            HTTP_SESSION = session
+    return HTTP_SESSION
 
 
 def response(statusCode: int, message: str):
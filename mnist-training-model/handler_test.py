@@ -1,4 +1,13 @@
-from .handler import handle
+import hashlib
+import io
+import json
+
+import numpy as np
+import pytest
+
+from . import handler
+from .handler import (DEFAULT_HYPERPARAMETERS, TransferManager, artifact_header_filename, get_hyperparameters, get_worker,
+                      handle, select_shards, shard_rows)
 
 # Test your handler here
 
@@ -9,3 +18,189 @@ from .handler import handle
 def test_handle():
     # assert handle("input") == "input"
     pass
+
+
+class FakeResponse(io.BytesIO):
+    def release_conn(self):
+        pass
+
+
+class InMemoryClient:
+    """以 dict 保存 object 的 MinIO client，支援 ranged GET"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, bucket_name: str, object_name: str, offset: int = 0, length: int = 0):
+        body = self.objects[(bucket_name, object_name)]
+        return FakeResponse(body[offset:offset + length] if length else body[offset:])
+
+
+def put_artifact(client, bucket_name: str, filename: str, data, shard_samples: int = None):
+    """以 preprocess 的格式寫入 .npy artifact 與 JSON header，shard_samples 為 None 時不建立 shard index"""
+
+    stream = io.BytesIO()
+    np.save(stream, data)
+    body = stream.getvalue()
+    data_offset = len(body) - data.nbytes
+    row_bytes = data.nbytes // len(data)
+    header = {
+        "format": "npy",
+        "dtype": data.dtype.str,
+        "shape": list(data.shape),
+        "data_offset": data_offset,
+        "sha256": hashlib.sha256(body).hexdigest(),
+    }
+    if shard_samples:
+        header["shard_samples"] = shard_samples
+        header["shards"] = [
+            {
+                "start": start,
+                "stop": min(start + shard_samples, len(data)),
+                "offset": data_offset + start * row_bytes,
+                "length": (min(start + shard_samples, len(data)) - start) * row_bytes,
+                "sha256": hashlib.sha256(data[start:start + shard_samples].tobytes()).hexdigest(),
+            }
+            for start in range(0, len(data), shard_samples)
+        ]
+
+    client.objects[(bucket_name, filename)] = body
+    client.objects[(bucket_name, artifact_header_filename(filename))] = json.dumps(header).encode()
+    return header
+
+
+def corrupt(client, bucket_name: str, filename: str, offset: int):
+    body = bytearray(client.objects[(bucket_name, filename)])
+    body[offset] ^= 0xFF
+    client.objects[(bucket_name, filename)] = bytes(body)
+
+
+def test_shard_rows_cover_all_rows():
+    for rows, num_shards in [(10, 3), (7, 7), (3, 5), (0, 2)]:
+        ranges = [shard_rows(rows, index, num_shards) for index in range(num_shards)]
+
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == rows
+        assert all(stop == next_start for (_, stop), (next_start, _) in zip(ranges, ranges[1:]))
+        sizes = [stop - start for start, stop in ranges]
+        assert max(sizes) - min(sizes) <= 1
+
+
+def test_select_shards_without_worker_shard_returns_everything():
+    header = {"shape": [10, 4], "shards": [{"start": 0, "stop": 5}, {"start": 5, "stop": 10}]}
+
+    assert select_shards(header) == (0, 10, header["shards"])
+
+
+def test_select_shards_assigns_whole_shards_to_workers():
+    shards = [{"start": start, "stop": min(start + 3, 10)} for start in range(0, 10, 3)]
+    header = {"shape": [10, 4], "shards": shards}
+
+    assert select_shards(header, (0, 2)) == (0, 6, shards[0:2])
+    assert select_shards(header, (1, 2)) == (6, 10, shards[2:4])
+    assert select_shards(header, (3, 4)) == (9, 10, shards[3:4])
+
+
+def test_select_shards_falls_back_to_rows():
+    # shard 比 worker 少，或是沒有 shard index 的舊 artifact，依照筆數切分且不回傳 shard index
+    two_shards = {"shape": [10, 4], "shards": [{"start": 0, "stop": 5}, {"start": 5, "stop": 10}]}
+    legacy = {"shape": [10, 4]}
+
+    assert select_shards(two_shards, (2, 3)) == (6, 10, None)
+    assert select_shards(legacy, (0, 3)) == (0, 3, None)
+
+
+def test_download_artifacts_verifies_worker_shards():
+    client = InMemoryClient()
+    data = np.arange(10 * 6, dtype='float32').reshape(10, 6)
+    put_artifact(client, "mnist", "images.npy", data, shard_samples=3)
+
+    with TransferManager(client, max_workers=2, part_size=16) as transfer_manager:
+        (images, header), = transfer_manager.download_artifacts([("mnist", "images.npy")], shard=(1, 2))
+
+    np.testing.assert_array_equal(images, data[6:10])
+    assert header["shard_rows"] == [6, 10]
+
+
+def test_download_artifacts_rejects_corrupted_shard():
+    client = InMemoryClient()
+    data = np.arange(10 * 6, dtype='float32').reshape(10, 6)
+    header = put_artifact(client, "mnist", "images.npy", data, shard_samples=3)
+    corrupt(client, "mnist", "images.npy", header["shards"][3]["offset"])
+
+    with TransferManager(client, max_workers=2) as transfer_manager:
+        # 只下載未損毀 shard 的 worker 不受影響
+        (images, _), = transfer_manager.download_artifacts([("mnist", "images.npy")], shard=(0, 2))
+        np.testing.assert_array_equal(images, data[0:6])
+
+        with pytest.raises(ValueError, match=r"shard \[9, 10\) checksum mismatch"):
+            transfer_manager.download_artifacts([("mnist", "images.npy")], shard=(1, 2))
+
+
+def test_download_artifacts_verifies_whole_object_without_shard_index():
+    client = InMemoryClient()
+    data = np.arange(8, dtype='uint8')
+    header = put_artifact(client, "mnist", "labels.npy", data)
+
+    with TransferManager(client) as transfer_manager:
+        (labels, _), = transfer_manager.download_artifacts([("mnist", "labels.npy")])
+        np.testing.assert_array_equal(labels, data)
+
+        corrupt(client, "mnist", "labels.npy", header["data_offset"])
+        with pytest.raises(ValueError, match="labels.npy checksum mismatch"):
+            transfer_manager.download_artifacts([("mnist", "labels.npy")])
+
+
+def test_get_worker():
+    assert get_worker("") == (0, 1)
+    assert get_worker(json.dumps({"worker_index": 2, "num_workers": 3})) == (2, 3)
+    with pytest.raises(ValueError, match="out of range"):
+        get_worker(json.dumps({"worker_index": 3, "num_workers": 3}))
+
+
+@pytest.mark.parametrize("body", [
+    {"worker_index": 4, "num_workers": 2},
+    {"worker_index": -1, "num_workers": 2},
+    {"worker_index": "first", "num_workers": 2},
+    {"num_workers": [2]},
+])
+def test_handle_rejects_invalid_worker(body, monkeypatch):
+    monkeypatch.setattr(handler, "start_metrics_server", lambda: None)
+
+    result = handle(json.dumps(body))
+
+    assert result["statusCode"] == 400
+    assert result["message"].startswith("invalid worker")
+
+
+def test_get_hyperparameters_converts_overrides():
+    hyperparameters = get_hyperparameters(json.dumps({"hyperparameters": {"epochs": 2.0, "learning_rate": 1}}))
+
+    assert hyperparameters == dict(DEFAULT_HYPERPARAMETERS, epochs=2, learning_rate=1.0)
+    assert isinstance(hyperparameters["epochs"], int)
+    assert isinstance(hyperparameters["learning_rate"], float)
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"epochs": 2.5}, "epochs must be an integer"),
+    ({"batch_size": True}, "batch_size must be an integer"),
+    ({"epochs": 0}, "epochs must be positive"),
+    ({"batch_size": 0}, "batch_size must be positive"),
+    ({"dense_units": -8}, "dense_units must be positive"),
+    ({"learning_rate": 0}, "learning_rate must be positive"),
+    ({"reduce_lr_patience": -1}, "reduce_lr_patience must not be negative"),
+    ({"reduce_lr_factor": 1.0}, "reduce_lr_factor must be in"),
+    ({"validation_split": 1.0}, "validation_split must be in"),
+    ({"momentum": 0.9}, "unknown hyperparameters: momentum"),
+])
+def test_get_hyperparameters_rejects_invalid_values(overrides, message):
+    with pytest.raises(ValueError, match=message):
+        get_hyperparameters(json.dumps({"hyperparameters": overrides}))
+
+
+def test_handle_rejects_invalid_hyperparameters(monkeypatch):
+    monkeypatch.setattr(handler, "start_metrics_server", lambda: None)
+
+    result = handle(json.dumps({"hyperparameters": {"batch_size": 0}}))
+
+    assert result == {"statusCode": 400, "message": "invalid hyperparameters. Error: batch_size must be positive, got 0"}